@@ -17,3 +17,89 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
+
+import importlib
+
+# backends are imported lazily,
+# so the C extension isn't loaded unless it is used
+BACKENDS = {
+    "native": "distributedflock.ZKeeperAPI.zkapi",
+    "python": "distributedflock.ZKeeperAPI.pyzk",
+}
+
+
+class Null(object):
+    """This class does nothing as logger"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __getattribute__(self, name):
+        return self
+
+    def __setattribute__(self, name, value):
+        pass
+
+    def __delattribute__(self, name):
+        pass
+
+
+def get_backend(name=None):
+    """Returns a module providing ZKeeperClient.
+    The C binding is preferred when no backend is requested"""
+    if name is not None:
+        return importlib.import_module(BACKENDS[name])
+    try:
+        return importlib.import_module(BACKENDS["native"])
+    except ImportError:
+        return importlib.import_module(BACKENDS["python"])
+
+
+class InstrumentedClient(object):
+    """Proxy measuring latency of synchronous Zookeeper calls.
+    It's used only if metrics are enabled"""
+
+    OPERATIONS = (
+        "write",
+        "create",
+        "create2",
+        "read",
+        "get",
+        "get_many",
+        "list",
+        "list_many",
+        "exists",
+        "modify",
+        "modify_if",
+        "delete",
+        "multi",
+        "create_multi",
+    )
+
+    def __init__(self, client, registry):
+        self._client = client
+        self._registry = registry
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in self.OPERATIONS:
+            return attr
+
+        def timed(*args, **kwargs):
+            with self._registry.timer("zk_op_seconds", op=name):
+                return attr(*args, **kwargs)
+
+        return timed
+
+
+def new_client(**config):
+    """Returns a ZKeeperClient of the configured backend"""
+    from distributedflock import metrics
+
+    client = get_backend(config.get("backend")).ZKeeperClient(**config)
+    if metrics.registry.enabled:
+        return InstrumentedClient(client, metrics.registry)
+    return client
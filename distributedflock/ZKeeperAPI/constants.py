@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of Combaine.
+#
+# Combaine is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Combaine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Values are the same as in the C client,
+# so they can be used with any backend.
+
+ZK_ACL = {"perms": 0x1F, "scheme": "world", "id": "anyone"}
+
+DEFAULT_ERRNO = -9999
+
+# requests of get_many/list_many sent without waiting for replies,
+# so neither side fills the socket buffers with replies nobody reads
+MAX_PIPELINE = 512
+
+# Error codes
+OK = 0
+SYSTEMERROR = -1
+RUNTIMEINCONSISTENCY = -2
+DATAINCONSISTENCY = -3
+CONNECTIONLOSS = -4
+MARSHALLINGERROR = -5
+UNIMPLEMENTED = -6
+OPERATIONTIMEOUT = -7
+BADARGUMENTS = -8
+INVALIDSTATE = -9
+APIERROR = -100
+NONODE = -101
+NOAUTH = -102
+BADVERSION = -103
+NOCHILDRENFOREPHEMERALS = -108
+NODEEXISTS = -110
+NOTEMPTY = -111
+SESSIONEXPIRED = -112
+INVALIDCALLBACK = -113
+INVALIDACL = -114
+AUTHFAILED = -115
+CLOSING = -116
+NOTHING = -117
+SESSIONMOVED = -118
+
+ERRORS = {
+    OK: "ok",
+    SYSTEMERROR: "system error",
+    RUNTIMEINCONSISTENCY: "run time inconsistency",
+    DATAINCONSISTENCY: "data inconsistency",
+    CONNECTIONLOSS: "connection loss",
+    MARSHALLINGERROR: "marshalling error",
+    UNIMPLEMENTED: "unimplemented",
+    OPERATIONTIMEOUT: "operation timeout",
+    BADARGUMENTS: "bad arguments",
+    INVALIDSTATE: "invalid zhandle state",
+    APIERROR: "api error",
+    NONODE: "no node",
+    NOAUTH: "not authenticated",
+    BADVERSION: "bad version",
+    NOCHILDRENFOREPHEMERALS: "no children for ephemerals",
+    NODEEXISTS: "node exists",
+    NOTEMPTY: "not empty",
+    SESSIONEXPIRED: "session expired",
+    INVALIDCALLBACK: "invalid callback",
+    INVALIDACL: "invalid acl",
+    AUTHFAILED: "authentication failed",
+    CLOSING: "zookeeper is closing",
+    NOTHING: "(not error) no server responses to process",
+    SESSIONMOVED: "session moved to another server, so operation is ignored",
+}
+
+# Node flags
+EPHEMERAL = 1
+SEQUENCE = 2
+
+# Event types
+CREATED_EVENT = 1
+DELETED_EVENT = 2
+CHANGED_EVENT = 3
+CHILD_EVENT = 4
+SESSION_EVENT = -1
+NOTWATCHING_EVENT = -2
+
+# Session states
+CONNECTING_STATE = 1
+ASSOCIATING_STATE = 2
+CONNECTED_STATE = 3
+EXPIRED_SESSION_STATE = -112
+AUTH_FAILED_STATE = -113
+
+STATE_NAMES = {
+    CONNECTING_STATE: "connecting",
+    ASSOCIATING_STATE: "associating",
+    CONNECTED_STATE: "connected",
+    EXPIRED_SESSION_STATE: "expired",
+    AUTH_FAILED_STATE: "auth_failed",
+}
+
+
+def zerror(errno):
+    return ERRORS.get(errno, "unknown error")
+
+
+class ZKError(Exception):
+    """Zookeeper error carrying one of the error codes above"""
+
+    def __init__(self, errno, msg=""):
+        self.errno = errno
+        Exception.__init__(self, msg or zerror(errno))
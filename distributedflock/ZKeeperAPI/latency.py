@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of python-flock.
+#
+# python-flock is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-flock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Zookeeper hosts ordered by round trip time.
+
+A host is probed with the srvr four letter command, which is allowed
+by default since Zookeeper 3.5 and tells whether the server is serving
+requests. RTTs are cached in a file for the given time, so most runs
+don't probe at all.
+"""
+
+import os
+import random
+import socket
+import threading
+import time
+
+from distributedflock import cache as cachefile
+
+PROBE_COMMAND = b"srvr"
+# the reply of a server which is serving requests
+PROBE_SERVING = b"Zookeeper version"
+PROBE_TIMEOUT = 1
+# hosts which are this close to each other are taken for equally
+# near ones and shuffled, so sessions are spread among them, sec
+RTT_TOLERANCE = 0.002
+
+
+def probe(host, timeout=PROBE_TIMEOUT):
+    """Returns RTT of host:port in seconds or None if it's unreachable
+    or isn't serving requests"""
+    hostname, _, port = host.rpartition(":")
+    started = time.time()
+    try:
+        sock = socket.create_connection((hostname, int(port)), timeout)
+    except (socket.error, ValueError):
+        return None
+    try:
+        sock.settimeout(max(0.001, started + timeout - time.time()))
+        sock.sendall(PROBE_COMMAND)
+        reply = b""
+        while len(reply) < len(PROBE_SERVING):
+            chunk = sock.recv(len(PROBE_SERVING) - len(reply))
+            if not chunk:
+                break
+            reply += chunk
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+    if not reply.startswith(PROBE_SERVING):
+        return None
+    return time.time() - started
+
+
+def probe_all(hosts, timeout=PROBE_TIMEOUT):
+    """Probe the hosts at once. Returns {host: RTT or None}"""
+    rtts = {}
+
+    def run(host):
+        rtts[host] = probe(host, timeout)
+
+    threads = [threading.Thread(target=run, args=(host,)) for host in hosts]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return rtts
+
+
+def cache_path():
+    return os.path.join(cachefile.user_dir(), "rtt.marshal")
+
+
+def load_cache(path):
+    """Returns {host: (RTT or None, measured at)}"""
+    try:
+        return dict((host, tuple(entry)) for host, entry in cachefile.load(path).items())
+    except (TypeError, ValueError, AttributeError):
+        return {}
+
+
+def save_cache(path, rtts):
+    try:
+        cachefile.dump(path, rtts)
+    except (IOError, OSError, ValueError):
+        pass
+
+
+def measure(hosts, ttl, path=None):
+    """Returns {host: RTT or None}, hosts whose RTT has been
+    measured more than ttl seconds ago are probed again"""
+    path = path or cache_path()
+    cache = load_cache(path)
+    now = time.time()
+    stale = [host for host in hosts if host not in cache or now - cache[host][1] > ttl]
+    if stale:
+        for host, rtt in probe_all(stale).items():
+            cache[host] = (rtt, now)
+        save_cache(path, cache)
+    return dict((host, cache[host][0]) for host in hosts)
+
+
+def order_hosts(hosts, ttl, path=None):
+    """Hosts sorted by RTT, the nearest one goes first and unreachable
+    ones go last. Hosts within RTT_TOLERANCE are in random order."""
+    rtts = measure(hosts, ttl, path)
+
+    def key(host):
+        if rtts[host] is None:
+            return float("inf")
+        return rtts[host] + random.uniform(0, RTT_TOLERANCE)
+
+    return sorted(hosts, key=key)
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of Combaine.
+#
+# Combaine is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Combaine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Zookeeper wire protocol (jute serialization) for the pure python backend.
+
+Every packet is prefixed with its length. Requests start with
+(xid, opcode), replies with (xid, zxid, err).
+"""
+
+import struct
+import sys
+
+PY2 = sys.version_info[0] == 2
+
+# opcodes
+NOTIFICATION = 0
+CREATE = 1
+DELETE = 2
+EXISTS = 3
+GETDATA = 4
+SETDATA = 5
+GETCHILDREN = 8
+SYNC = 9
+PING = 11
+GETCHILDREN2 = 12
+CHECK = 13
+MULTI = 14
+CREATE2 = 15
+AUTH = 100
+SETWATCHES = 101
+CLOSE = -11
+
+# special xids
+WATCH_XID = -1
+PING_XID = -2
+AUTH_XID = -4
+SETWATCHES_XID = -8
+
+# wire values of the watcher events
+EVENT_NONE = -1
+EVENT_NODE_CREATED = 1
+EVENT_NODE_DELETED = 2
+EVENT_NODE_DATA_CHANGED = 3
+EVENT_NODE_CHILDREN_CHANGED = 4
+
+# wire values of the session states
+STATE_DISCONNECTED = 0
+STATE_SYNC_CONNECTED = 3
+STATE_AUTH_FAILED = 4
+STATE_EXPIRED = -112
+
+STAT_FIELDS = (
+    ("czxid", "q"),
+    ("mzxid", "q"),
+    ("ctime", "q"),
+    ("mtime", "q"),
+    ("version", "i"),
+    ("cversion", "i"),
+    ("aversion", "i"),
+    ("ephemeralOwner", "q"),
+    ("dataLength", "i"),
+    ("numChildren", "i"),
+    ("pzxid", "q"),
+)
+STAT_FORMAT = ">" + "".join(fmt for _, fmt in STAT_FIELDS)
+STAT_SIZE = struct.calcsize(STAT_FORMAT)
+
+
+def to_bytes(value):
+    if value is None or isinstance(value, bytes):
+        return value
+    return value.encode("utf-8")
+
+
+def to_str(value):
+    if value is None or PY2:
+        return value
+    return value.decode("utf-8", "replace")
+
+
+class Writer(object):
+    def __init__(self):
+        self.chunks = []
+
+    def int(self, value):
+        self.chunks.append(struct.pack(">i", value))
+        return self
+
+    def long(self, value):
+        self.chunks.append(struct.pack(">q", value))
+        return self
+
+    def bool(self, value):
+        self.chunks.append(struct.pack(">?", value))
+        return self
+
+    def buffer(self, value):
+        value = to_bytes(value)
+        if value is None:
+            return self.int(-1)
+        self.int(len(value))
+        self.chunks.append(value)
+        return self
+
+    string = buffer
+
+    def strings(self, values):
+        self.int(len(values))
+        for value in values:
+            self.string(value)
+        return self
+
+    def acls(self, acls):
+        self.int(len(acls))
+        for acl in acls:
+            self.int(acl["perms"]).string(acl["scheme"]).string(acl["id"])
+        return self
+
+    def stat(self, stat):
+        self.chunks.append(
+            struct.pack(STAT_FORMAT, *[stat[name] for name, _ in STAT_FIELDS])
+        )
+        return self
+
+    def getvalue(self):
+        return b"".join(self.chunks)
+
+    def packet(self):
+        body = self.getvalue()
+        return struct.pack(">i", len(body)) + body
+
+
+class Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def _unpack(self, fmt):
+        size = struct.calcsize(fmt)
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += size
+        return values
+
+    def int(self):
+        return self._unpack(">i")[0]
+
+    def long(self):
+        return self._unpack(">q")[0]
+
+    def bool(self):
+        return self._unpack(">?")[0]
+
+    def buffer(self):
+        size = self.int()
+        if size < 0:
+            return None
+        value = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return value
+
+    def string(self):
+        return to_str(self.buffer())
+
+    def strings(self):
+        return [self.string() for _ in range(self.int())]
+
+    def acls(self):
+        return [
+            {"perms": self.int(), "scheme": self.string(), "id": self.string()}
+            for _ in range(self.int())
+        ]
+
+    def stat(self):
+        values = self._unpack(STAT_FORMAT)
+        return dict(zip([name for name, _ in STAT_FIELDS], values))
+
+    def remaining(self):
+        return len(self.data) - self.offset
+
+
+# Bodies of requests
+
+
+def connect_request(last_zxid, timeout, session_id, passwd):
+    return (
+        Writer()
+        .int(0)
+        .long(last_zxid)
+        .int(timeout)
+        .long(session_id)
+        .buffer(passwd)
+        .bool(False)
+    )
+
+
+def create_request(path, data, acls, flags):
+    return Writer().string(path).buffer(data).acls(acls).int(flags)
+
+
+def delete_request(path, version=-1):
+    return Writer().string(path).int(version)
+
+
+def path_watch_request(path, watch):
+    # exists, getData and getChildren share the layout
+    return Writer().string(path).bool(watch)
+
+
+def setdata_request(path, data, version=-1):
+    return Writer().string(path).buffer(data).int(version)
+
+
+def check_request(path, version):
+    return Writer().string(path).int(version)
+
+
+def auth_request(scheme, auth):
+    return Writer().int(0).string(scheme).buffer(auth)
+
+
+def setwatches_request(relative_zxid, data, exist, child):
+    return Writer().long(relative_zxid).strings(data).strings(exist).strings(child)
+
+
+MULTI_REQUESTS = {
+    CREATE: lambda op: create_request(*op[1:]),
+    DELETE: lambda op: delete_request(*op[1:]),
+    SETDATA: lambda op: setdata_request(*op[1:]),
+    CHECK: lambda op: check_request(*op[1:]),
+}
+
+
+def multi_request(ops):
+    """ops is a list of tuples (opcode, args...)"""
+    w = Writer()
+    for op in ops:
+        w.int(op[0]).bool(False).int(-1)
+        w.chunks.append(MULTI_REQUESTS[op[0]](op).getvalue())
+    return w.int(-1).bool(True).int(-1)
+
+
+# Replies
+
+
+def read_multi_response(r):
+    """Returns a list of (err, result) for every operation"""
+    results = []
+    while True:
+        optype, done, err = r.int(), r.bool(), r.int()
+        if done:
+            break
+        if optype == -1:
+            # the error is repeated in the body
+            results.append((r.int() or err, None))
+        elif optype in (CREATE, CREATE2):
+            results.append((err, r.string()))
+        elif optype == SETDATA:
+            results.append((err, r.stat()))
+        else:
+            results.append((err, None))
+    return results
+
+
+def read_reply(opcode, r):
+    if opcode == CREATE:
+        return r.string()
+    elif opcode == CREATE2:
+        # servers before 3.5 reply to unknown requests with an empty body
+        if not r.remaining():
+            return None
+        return r.string(), r.stat()
+    elif opcode in (EXISTS, SETDATA):
+        return r.stat()
+    elif opcode == GETDATA:
+        return to_str(r.buffer()), r.stat()
+    elif opcode == GETCHILDREN:
+        return r.strings()
+    elif opcode == GETCHILDREN2:
+        return r.strings(), r.stat()
+    elif opcode == MULTI:
+        return read_multi_response(r)
+    return None
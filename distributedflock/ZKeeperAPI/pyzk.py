@@ -0,0 +1,645 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of Combaine.
+#
+# Combaine is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Combaine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Pure python Zookeeper backend.
+
+It speaks the wire protocol itself, so neither the C extension nor its
+threads are needed. Requests are written by the calling thread and may
+be pipelined; replies and pings are handled by a single I/O thread.
+Watchers and asynchronous completions run in an event thread, so they
+are allowed to make synchronous calls, like in the C client.
+"""
+
+import collections
+import logging
+import random
+import select
+import socket
+import struct
+import threading
+import time
+from functools import partial
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue  # noqa: N813
+
+from distributedflock import metrics, tracing
+from distributedflock.ZKeeperAPI import Null, latency, protocol
+from distributedflock.ZKeeperAPI import constants as zk
+from distributedflock.ZKeeperAPI.constants import MAX_PIPELINE, ZKError, ZK_ACL
+
+# wire states/events -> C client values
+STATES = {
+    protocol.STATE_DISCONNECTED: zk.CONNECTING_STATE,
+    protocol.STATE_SYNC_CONNECTED: zk.CONNECTED_STATE,
+    protocol.STATE_AUTH_FAILED: zk.AUTH_FAILED_STATE,
+    protocol.STATE_EXPIRED: zk.EXPIRED_SESSION_STATE,
+}
+EVENTS = {
+    protocol.EVENT_NODE_CREATED: zk.CREATED_EVENT,
+    protocol.EVENT_NODE_DELETED: zk.DELETED_EVENT,
+    protocol.EVENT_NODE_DATA_CHANGED: zk.CHANGED_EVENT,
+    protocol.EVENT_NODE_CHILDREN_CHANGED: zk.CHILD_EVENT,
+}
+
+
+def parse_host(host):
+    hostname, _, port = host.rpartition(":")
+    return hostname, int(port)
+
+
+class ConnectionDroppedError(Exception):
+    pass
+
+
+class ZKeeperClient(object):
+    supports_multi = True
+    # it's reset if the server turns out to be older than 3.5
+    supports_create2 = True
+
+    def __init__(self, **config):
+        logger_name = config.get("logger_name")
+        self.logger = logging.getLogger(logger_name) if logger_name else Null()
+        try:
+            auth_config = config.get("auth")
+            self.auth = None
+            if auth_config is not None:
+                self.auth = (auth_config["scheme"], auth_config["data"])
+            self.connection_timeout = config["timeout"]
+            hosts = config["host"]
+        except KeyError as err:
+            self.logger.exception("Missing configuration option: %s", err)
+            raise
+        rtt_ttl = config.get("rtt_ttl")
+        if rtt_ttl:
+            # the nearest host goes first and the others
+            # are the fallbacks in the order of RTT
+            hosts = latency.order_hosts(hosts, rtt_ttl)
+            self.logger.debug("Hosts in the order of RTT: %s", ", ".join(hosts))
+        self.zkhosts = [parse_host(host) for host in hosts]
+        if not rtt_ttl:
+            # spread sessions among the servers like the C client does
+            random.shuffle(self.zkhosts)
+        self.host_index = -1
+
+        self.lock = threading.RLock()
+        self.sock = None
+        self.state = zk.CONNECTING_STATE
+        self.closed = False
+        self.closing = False
+        self.xid = 0
+        self.last_zxid = 0
+        self.session_id = 0
+        self.passwd = b"\0" * 16
+        self.session_timeout = int(self.connection_timeout * 1e3)
+        # time of the last packet from the server
+        self.last_recv = 0
+        # requests the caller has waited for, including handshakes
+        self.round_trips = 0
+        self.pending = collections.deque()
+        self.data_watches = {}
+        self.exist_watches = {}
+        self.child_watches = {}
+        self.events = queue.Queue()
+
+        self.connect()
+        tracing.tracer.mark("connect")
+
+        self.io_thread = threading.Thread(target=self._io_loop, name="zk-io")
+        self.io_thread.daemon = True
+        self.io_thread.start()
+        self.event_thread = threading.Thread(target=self._event_loop, name="zk-event")
+        self.event_thread.daemon = True
+        self.event_thread.start()
+
+        if self.auth:
+            self.logger.info("Auth using %s", self.auth[0])
+            rc, _ = self._call(
+                protocol.AUTH,
+                protocol.auth_request(*self.auth),
+                xid=protocol.AUTH_XID,
+            )
+            if rc != zk.OK:
+                self.logger.error(zk.zerror(rc))
+                self.state = zk.AUTH_FAILED_STATE
+                self.disconnect()
+                raise ZKError(rc, "authentication failed")
+            tracing.tracer.mark("auth")
+
+    # Connection
+
+    def connect(self):
+        # start with the host next to the one we have lost, and give
+        # every host its share of the timeout, so a blackholed host
+        # doesn't eat the whole session timeout
+        hosts = self.zkhosts[self.host_index + 1:] + self.zkhosts[:self.host_index + 1]
+        attempt_timeout = float(self.connection_timeout) / len(hosts)
+        limit_time = time.time() + self.connection_timeout
+        for host in hosts:
+            time_to_wait = limit_time - time.time()
+            if time_to_wait <= 0:
+                break
+            try:
+                self._handshake(host, min(time_to_wait, attempt_timeout))
+            except (socket.error, ConnectionDroppedError, struct.error) as err:
+                self.logger.debug("Unable to connect to %s:%d: %s", host[0], host[1], err)
+                continue
+            if self.state == zk.CONNECTED_STATE:
+                self.host_index = self.zkhosts.index(host)
+                self.logger.info("Connected to Zookeeper successfully")
+                return
+            if self.state == zk.EXPIRED_SESSION_STATE:
+                break
+        if self.session_id == 0:
+            raise ZKError(zk.CONNECTIONLOSS, "Unable to connect to Zookeeper")
+
+    def _handshake(self, host, timeout):
+        self.round_trips += 1
+        sock = socket.create_connection(host, timeout)
+        try:
+            sock.settimeout(timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            request = protocol.connect_request(
+                self.last_zxid, self.session_timeout, self.session_id, self.passwd
+            )
+            sock.sendall(request.packet())
+            r = protocol.Reader(self._read_packet(sock))
+            r.int()  # protocol version
+            timeout_ms, session_id, passwd = r.int(), r.long(), r.buffer()
+        except Exception:
+            sock.close()
+            raise
+
+        if timeout_ms <= 0:
+            sock.close()
+            self.logger.error("Session has expired")
+            self._set_state(zk.EXPIRED_SESSION_STATE)
+            return
+
+        self.session_timeout = timeout_ms
+        self.session_id = session_id
+        self.passwd = passwd
+        self.last_recv = time.time()
+        sock.settimeout(self.read_timeout)
+        with self.lock:
+            self.sock = sock
+            self._restore_watches()
+        self._set_state(zk.CONNECTED_STATE)
+        self.logger.debug("Session 0x%x on %s:%d", session_id, host[0], host[1])
+
+    def _restore_watches(self):
+        if not (self.data_watches or self.exist_watches or self.child_watches):
+            return
+        request = protocol.setwatches_request(
+            self.last_zxid,
+            list(self.data_watches),
+            list(self.exist_watches),
+            list(self.child_watches),
+        )
+        self._send(protocol.SETWATCHES, request, protocol.SETWATCHES_XID)
+        self.pending.append((protocol.SETWATCHES_XID, protocol.SETWATCHES, None, None, False))
+
+    @staticmethod
+    def _read_exactly(sock, size):
+        chunks = []
+        while size > 0:
+            chunk = sock.recv(size)
+            if not chunk:
+                raise ConnectionDroppedError("connection closed by server")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def _read_packet(self, sock):
+        size = struct.unpack(">i", self._read_exactly(sock, 4))[0]
+        return self._read_exactly(sock, size)
+
+    @property
+    def read_timeout(self):
+        return self.session_timeout * 2.0 / 3 / 1e3
+
+    def _io_loop(self):
+        while not self.closed:
+            sock = self.sock
+            if sock is None:
+                if self.state == zk.EXPIRED_SESSION_STATE or self.closing:
+                    return
+                self.connect()
+                if self.sock is None:
+                    time.sleep(0.1)
+                continue
+
+            ping_interval = self.read_timeout / 2
+            try:
+                if self._readable(sock, ping_interval):
+                    self._handle_packet(self._read_packet(sock))
+                elif time.time() - self.last_recv > self.read_timeout:
+                    raise ConnectionDroppedError("no response for %f sec" % self.read_timeout)
+                else:
+                    with self.lock:
+                        if self.sock is sock:
+                            self._send(protocol.PING, protocol.Writer(), protocol.PING_XID)
+            except (socket.error, select.error, ConnectionDroppedError, struct.error, ValueError) as err:
+                if self.closed or self.closing:
+                    # CLOSE won't be answered, disconnect() mustn't wait for it
+                    self._close_socket()
+                    return
+                self.logger.error("Connection to Zookeeper has been lost: %s", err)
+                self._drop_connection()
+
+    @staticmethod
+    def _readable(sock, timeout):
+        # select() can't handle descriptors above FD_SETSIZE,
+        # which is easy to hit with many sessions in one process
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
+            return bool(poller.poll(timeout * 1e3))
+        return bool(select.select([sock], [], [], timeout)[0])
+
+    def _drop_connection(self):
+        self._close_socket()
+        self._set_state(zk.CONNECTING_STATE)
+
+    def _close_socket(self):
+        """Requests waiting for replies fail with CONNECTIONLOSS"""
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+            self.sock = None
+            pending, self.pending = self.pending, collections.deque()
+        for _, _, completion, _, sync in pending:
+            if completion is not None:
+                self._complete(completion, sync, zk.CONNECTIONLOSS, None)
+
+    def _set_state(self, state):
+        if self.state == state:
+            return
+        self.state = state
+        metrics.registry.inc(
+            "connection_state_changes_total", state=zk.STATE_NAMES.get(state, state)
+        )
+        with self.lock:
+            watchers = set()
+            for watches in (self.data_watches, self.exist_watches, self.child_watches):
+                for callbacks in watches.values():
+                    watchers.update(callbacks)
+                if state == zk.EXPIRED_SESSION_STATE:
+                    watches.clear()
+        for watcher in watchers:
+            self.events.put((watcher, (zk.SESSION_EVENT, state, "")))
+
+    def _event_loop(self):
+        while True:
+            callback, args = self.events.get()
+            if callback is None:
+                return
+            try:
+                callback(*args)
+            except Exception as err:
+                self.logger.exception("Callback failed: %s", err)
+
+    # Requests
+
+    def _send(self, opcode, request, xid=None):
+        # self.lock must be held
+        if xid is None:
+            self.xid += 1
+            xid = self.xid
+        header = struct.pack(">ii", xid, opcode)
+        body = request.getvalue()
+        self.sock.sendall(struct.pack(">i", len(header) + len(body)) + header + body)
+        return xid
+
+    def _submit(self, opcode, request, completion, watch=None, xid=None, sync=False):
+        with self.lock:
+            if self.sock is None or self.closed:
+                rc = zk.SESSIONEXPIRED if self.state == zk.EXPIRED_SESSION_STATE else zk.CONNECTIONLOSS
+                self._complete(completion, sync, rc, None)
+                return False
+            try:
+                xid = self._send(opcode, request, xid)
+            except socket.error as err:
+                self.logger.error("Unable to send request: %s", err)
+                self._complete(completion, sync, zk.CONNECTIONLOSS, None)
+                return False
+            self.pending.append((xid, opcode, completion, watch, sync))
+        return True
+
+    def _call(self, opcode, request, watch=None, xid=None, timeout=None):
+        # CONNECTIONLOSS if there is no reply within timeout
+        done = threading.Event()
+        result = []
+
+        def completion(rc, value):
+            result.append((rc, value))
+            done.set()
+
+        self.round_trips += 1
+        self._submit(opcode, request, completion, watch, xid, sync=True)
+        if not done.wait(timeout):
+            return zk.CONNECTIONLOSS, None
+        return result[0]
+
+    def _call_many(self, opcode, requests):
+        """Send the requests without waiting for replies, up to
+        MAX_PIPELINE of them at once. Returns [(rc, value)]
+        in the order of requests"""
+        results = [None] * len(requests)
+        window = threading.Semaphore(MAX_PIPELINE)
+        cv = threading.Condition()
+        left = [len(requests)]
+
+        def completion(i, rc, value):
+            results[i] = (rc, value)
+            window.release()
+            with cv:
+                left[0] -= 1
+                cv.notify()
+
+        self.round_trips += 1
+        for i, request in enumerate(requests):
+            window.acquire()
+            self._submit(opcode, request, partial(completion, i), sync=True)
+        with cv:
+            while left[0]:
+                cv.wait()
+        return results
+
+    def _complete(self, completion, sync, rc, value):
+        if completion is None:
+            return
+        if sync:
+            completion(rc, value)
+        else:
+            self.events.put((completion, (rc, value)))
+
+    def _handle_packet(self, data):
+        self.last_recv = time.time()
+        r = protocol.Reader(data)
+        xid, zxid, err = r.int(), r.long(), r.int()
+        if zxid > 0:
+            self.last_zxid = zxid
+
+        if xid == protocol.PING_XID:
+            return
+        if xid == protocol.WATCH_XID:
+            self._handle_event(r.int(), r.int(), r.string())
+            return
+
+        with self.lock:
+            if not self.pending:
+                raise ConnectionDroppedError("unexpected reply xid %d" % xid)
+            pending_xid, opcode, completion, watch, sync = self.pending.popleft()
+            if pending_xid != xid:
+                raise ConnectionDroppedError("xid %d is out of order" % xid)
+            value = None
+            if err == zk.OK or (opcode == protocol.MULTI and r.remaining()):
+                value = protocol.read_reply(opcode, r)
+            if watch is not None:
+                self._register_watch(opcode, err, watch)
+        self._complete(completion, sync, err, value)
+
+    def _register_watch(self, opcode, err, watch):
+        path, callback = watch
+        if opcode == protocol.EXISTS and err == zk.NONODE:
+            watches = self.exist_watches
+        elif err != zk.OK:
+            return
+        elif opcode in (protocol.GETCHILDREN, protocol.GETCHILDREN2):
+            watches = self.child_watches
+        else:
+            watches = self.data_watches
+        watches.setdefault(path, set()).add(callback)
+
+    def _handle_event(self, event, state, path):
+        event = EVENTS.get(event, event)
+        if event == zk.CHILD_EVENT:
+            tables = (self.child_watches,)
+        elif event == zk.DELETED_EVENT:
+            tables = (self.data_watches, self.exist_watches, self.child_watches)
+        else:
+            tables = (self.data_watches, self.exist_watches)
+        watchers = set()
+        with self.lock:
+            for watches in tables:
+                watchers.update(watches.pop(path, ()))
+        for watcher in watchers:
+            self.events.put((watcher, (event, STATES.get(state, state), path)))
+
+    # API
+
+    @property
+    def connected(self):
+        return self.sock is not None and self.state == zk.CONNECTED_STATE
+
+    def disconnect(self):
+        if self.closed:
+            return zk.OK
+        self.closing = True
+        if self.sock is not None:
+            self._call(protocol.CLOSE, protocol.Writer(), timeout=self.read_timeout)
+        with self.lock:
+            self.closed = True
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+        self.events.put((None, None))
+        return zk.OK
+
+    def write(self, absname, value, typeofnode=0, acl=ZK_ACL):
+        return self.create(absname, value, typeofnode, acl)[1]
+
+    def create(self, absname, value, typeofnode=0, acl=ZK_ACL):
+        rc, path = self._call(
+            protocol.CREATE,
+            protocol.create_request(absname, value, [acl], typeofnode),
+        )
+        if rc != zk.OK and rc != zk.NODEEXISTS:
+            self.logger.error("Unable to create %s: %s", absname, zk.zerror(rc))
+        return path, rc
+
+    def create2(self, absname, value, typeofnode=0, acl=ZK_ACL):
+        """Like create, but the stat of the created node comes in the
+        same reply. Returns (path, errno, stat)"""
+        if self.supports_create2:
+            rc, result = self._call(
+                protocol.CREATE2,
+                protocol.create_request(absname, value, [acl], typeofnode),
+            )
+            if rc != zk.UNIMPLEMENTED and not (rc == zk.OK and result is None):
+                if rc != zk.OK:
+                    if rc not in (zk.NODEEXISTS, zk.NONODE):
+                        self.logger.error("Unable to create %s: %s", absname, zk.zerror(rc))
+                    return None, rc, None
+                return result[0], rc, result[1]
+            self.logger.info("Server doesn't support create2")
+            self.supports_create2 = False
+
+        path, rc = self.create(absname, value, typeofnode, acl)
+        stat = None
+        if rc == zk.OK:
+            try:
+                stat = self.exists(path)
+            except ZKError as err:
+                self.logger.error("Unable to stat %s: %s", path, err)
+        return path, rc, stat
+
+    def _check(self, rc, value):
+        if rc != zk.OK:
+            raise ZKError(rc)
+        return value
+
+    def read(self, absname):
+        rc, value = self._call(
+            protocol.GETDATA, protocol.path_watch_request(absname, False)
+        )
+        return self._check(rc, value)[0]
+
+    def get(self, absname):
+        """Returns (value, errno, stat), errno is NONODE
+        if there is no such node"""
+        rc, value = self._call(
+            protocol.GETDATA, protocol.path_watch_request(absname, False)
+        )
+        if rc != zk.OK:
+            return None, rc, None
+        return value[0], rc, value[1]
+
+    def get_many(self, paths):
+        """Read all of the nodes at once, see get.
+        Returns [(value, errno, stat)]"""
+        results = self._call_many(
+            protocol.GETDATA, [protocol.path_watch_request(path, False) for path in paths]
+        )
+        return [
+            (value[0], rc, value[1]) if rc == zk.OK else (None, rc, None)
+            for rc, value in results
+        ]
+
+    def list_many(self, paths):
+        """List children of all of the nodes at once.
+        Returns [(children, errno)]"""
+        results = self._call_many(
+            protocol.GETCHILDREN, [protocol.path_watch_request(path, False) for path in paths]
+        )
+        return [(value if rc == zk.OK else None, rc) for rc, value in results]
+
+    def list(self, absname, watcher=None):
+        # watcher is invoked once the list of children changes
+        watch = None
+        if watcher is not None:
+            assert callable(watcher), "watcher must be callable"
+            watch = (absname, watcher)
+        rc, value = self._call(
+            protocol.GETCHILDREN,
+            protocol.path_watch_request(absname, watch is not None),
+            watch,
+        )
+        return self._check(rc, value)
+
+    def exists(self, absname):
+        # returns stat of the node or None if it doesn't exist
+        rc, stat = self._call(protocol.EXISTS, protocol.path_watch_request(absname, False))
+        if rc == zk.NONODE:
+            return None
+        return self._check(rc, stat)
+
+    def modify(self, absname, value):
+        rc, _ = self._call(protocol.SETDATA, protocol.setdata_request(absname, value))
+        return self._check(rc, rc)
+
+    def modify_if(self, absname, value, version):
+        """Set the value only if the node has the version.
+        Returns (errno, stat), errno is BADVERSION otherwise"""
+        rc, stat = self._call(
+            protocol.SETDATA, protocol.setdata_request(absname, value, version)
+        )
+        if rc != zk.OK:
+            return rc, None
+        return rc, stat
+
+    def delete(self, absname):
+        rc, _ = self._call(protocol.DELETE, protocol.delete_request(absname))
+        return self._check(rc, rc)
+
+    def multi(self, ops):
+        """Run ops as one transaction. ops is a list of
+        (opcode, args...) tuples, see protocol.multi_request.
+        Returns (rc, [(rc, result) for every op])"""
+        rc, results = self._call(protocol.MULTI, protocol.multi_request(ops))
+        if results is None:
+            results = []
+        # the reply header carries ok, the failed op carries the error
+        for op_rc, _ in results:
+            if op_rc not in (zk.OK, zk.RUNTIMEINCONSISTENCY):
+                rc = op_rc
+                break
+        return rc, results
+
+    def create_multi(self, nodes, typeofnode=0, acl=ZK_ACL):
+        """Create all of the nodes [(path, value)] in one transaction
+        or none of them. Returns (errno, index of the failed node)"""
+        rc, results = self.multi(
+            [(protocol.CREATE, path, value, [acl], typeofnode) for path, value in nodes]
+        )
+        for i, (op_rc, _) in enumerate(results):
+            if op_rc not in (zk.OK, zk.RUNTIMEINCONSISTENCY):
+                return op_rc, i
+        return rc, None
+
+    # Async API
+    def aget(self, node, callback, rccallback=None):
+        # callback is invoked when the watcher triggers
+        # rccallback is invoked when the result of attaching
+        # becomes available (OK, NONODE and so on)
+        assert callable(callback), "callback must be callable"
+        if rccallback is not None:
+            assert callable(rccallback), "rccallback must be callable"
+
+        def watcher(event, state, path):
+            self.logger.info("Node state has been changed")
+            if event == zk.CHANGED_EVENT:
+                self.logger.debug("Node %s has been modified", path)
+            elif event == zk.CREATED_EVENT:
+                self.logger.debug("Node %s has been created", path)
+            elif event == zk.DELETED_EVENT:
+                self.logger.warning("Node %s has been deleted", path)
+
+            if state == zk.EXPIRED_SESSION_STATE:
+                self.logger.error("Session has expired")
+            callback(event, state, path)
+
+        def rc_handler(rc, value):
+            if zk.OK == rc:
+                self.logger.debug("Callback has been attached succesfully")
+            elif zk.NONODE == rc:
+                self.logger.warning("Watched node doesn't exists")
+            if rccallback is not None:
+                rccallback(rc)
+
+        return self._submit(
+            protocol.GETDATA,
+            protocol.path_watch_request(node, True),
+            rc_handler,
+            (node, watcher),
+        )
@@ -22,16 +22,22 @@ from __future__ import with_statement
 
 import logging
 import threading
+import time
 from functools import partial
 
-import zookeeper
+from distributedflock import metrics, tracing
+from distributedflock.ZKeeperAPI import Null
+from distributedflock.ZKeeperAPI.constants import (  # noqa
+    DEFAULT_ERRNO,
+    MAX_PIPELINE,
+    STATE_NAMES,
+    ZK_ACL,
+)
 
-ZK_ACL = {"perms": 0x1F, "scheme": "world", "id": "anyone"}
+import zookeeper
 
 zookeeper.set_log_stream(open("/dev/null", "w"))
 
-DEFAULT_ERRNO = -9999
-
 # JFYI
 LOG_LEVELS = {
     "DEBUG": zookeeper.LOG_LEVEL_DEBUG,
@@ -41,25 +47,6 @@ LOG_LEVELS = {
 }
 
 
-class Null(object):
-    """This class does nothing as logger"""
-
-    def __init__(self, *args, **kwargs):
-        pass
-
-    def __call__(self, *args, **kwargs):
-        return self
-
-    def __getattribute__(self, name):
-        return self
-
-    def __setattribute__(self, name, value):
-        pass
-
-    def __delattribute__(self, name):
-        pass
-
-
 def handling_error(zkfunc, logger=Null()):
     def wrapper(*args, **kwargs):
         ret = None
@@ -72,6 +59,12 @@ def handling_error(zkfunc, logger=Null()):
         except zookeeper.NodeExistsException as err:
             logger.debug("Node exists: %s", str(err))
             errno = zookeeper.NODEEXISTS
+        except zookeeper.NoNodeException as err:
+            logger.debug("No node: %s", str(err))
+            errno = zookeeper.NONODE
+        except zookeeper.BadVersionException as err:
+            logger.debug("Bad version: %s", str(err))
+            errno = zookeeper.BADVERSION
         except zookeeper.OperationTimeoutException as err:
             logger.error("Operation timeout: %s", str(err))
             errno = zookeeper.OPERATIONTIMEOUT
@@ -94,12 +87,19 @@ def handling_error(zkfunc, logger=Null()):
 
 
 class ZKeeperClient(object):
+    # zkpython doesn't provide multi
+    supports_multi = False
+
     def __init__(self, **config):
         logger_name = config.get("logger_name")
         self.logger = logging.getLogger(logger_name) if logger_name else Null()
         self.zkhandle = None
         self.auth = None
         self.cv = threading.Condition()
+        # when the connection has been lost, None while connected
+        self.disconnected_at = None
+        # requests the caller has waited for, including the handshake
+        self.round_trips = 0
 
         try:
             auth_config = config.get("auth")
@@ -134,6 +134,7 @@ class ZKeeperClient(object):
             self.logger.info("Connected to Zookeeper successfully")
         else:
             raise zookeeper.ZooKeeperException("Unable to connect " "to Zookeeper")
+        tracing.tracer.mark("connect")
 
         def on_auth_callback(state, result):
             with self.cv:
@@ -144,6 +145,7 @@ class ZKeeperClient(object):
 
         if self.auth:
             self.logger.info("Auth using %s", self.auth[0])
+            self.round_trips += 1
             with self.cv:
                 res = zookeeper.add_auth(
                     self.zkhandle, self.auth[0], self.auth[1], on_auth_callback
@@ -155,17 +157,25 @@ class ZKeeperClient(object):
 
             if zookeeper.state(self.zkhandle) == zookeeper.AUTH_FAILED_STATE:
                 raise zookeeper.ZooKeeperException("authentication failed")
+            tracing.tracer.mark("auth")
 
     def connect(self):
         def connect_watcher(handle, w_type, state, path):
             """Callback for connect()"""
+            metrics.registry.inc(
+                "connection_state_changes_total", state=STATE_NAMES.get(state, state)
+            )
             with self.cv:
                 if state == zookeeper.CONNECTED_STATE:
                     self.logger.debug("connect_watcher: CONNECTED_STATE")
+                    self.disconnected_at = None
                 else:
                     self.logger.debug("connect_watcher: state %d", state)
+                    if self.disconnected_at is None:
+                        self.disconnected_at = time.time()
                 self.cv.notify()
 
+        self.round_trips += 1
         with self.cv:
             try:
                 # zookeeper.init accepts timeout in ms
@@ -189,25 +199,179 @@ class ZKeeperClient(object):
     def connected(self):
         return self.zkhandle is not None and zookeeper.state(self.zkhandle) == zookeeper.CONNECTED_STATE
 
+    @property
+    def session_id(self):
+        return zookeeper.client_id(self.zkhandle)[0]
+
+    @property
+    def state(self):
+        return zookeeper.state(self.zkhandle)
+
+    @property
+    def session_timeout(self):
+        # negotiated with the server, ms
+        return zookeeper.recv_timeout(self.zkhandle)
+
+    @property
+    def last_recv(self):
+        # the C client doesn't tell when the server has answered last,
+        # but it drops a connection silent for 2/3 of the session timeout
+        if self.disconnected_at is None:
+            return time.time()
+        return self.disconnected_at - self.session_timeout * 2.0 / 3 / 1e3
+
     def disconnect(self):
         return zookeeper.close(self.zkhandle)
 
     def write(self, absname, value, typeofnode=0, acl=ZK_ACL):
+        return self.create(absname, value, typeofnode, acl)[1]
+
+    def create(self, absname, value, typeofnode=0, acl=ZK_ACL):
+        # returns (path, errno), as the real path of
+        # a sequential node is known only after creation
+        self.round_trips += 1
         return handling_error(zookeeper.create, self.logger)(
             self.zkhandle, absname, value, [acl], typeofnode
-        )[1]
+        )
+
+    def create2(self, absname, value, typeofnode=0, acl=ZK_ACL):
+        """Like create, but returns the stat of the created node too:
+        (path, errno, stat). zkpython has no create2, so exists is sent
+        right after create without waiting for it. The path of a
+        sequential node isn't known in advance, so it takes two round
+        trips for them."""
+        if typeofnode & zookeeper.SEQUENCE:
+            path, errno = self.create(absname, value, typeofnode, acl)
+            stat = None
+            if errno == 0:
+                self.round_trips += 1
+                stat = handling_error(zookeeper.exists, self.logger)(self.zkhandle, path)[0]
+            return path, errno, stat
+
+        cv = threading.Condition()
+        results = {}
+
+        def completion(name, zh, rc, value):
+            with cv:
+                results[name] = (rc, value)
+                cv.notify()
+
+        self.round_trips += 1
+        with cv:
+            try:
+                zookeeper.acreate(
+                    self.zkhandle, absname, value, [acl], typeofnode,
+                    partial(completion, "create"),
+                )
+                zookeeper.aexists(
+                    self.zkhandle, absname, None, partial(completion, "exists")
+                )
+            except zookeeper.ZooKeeperException as err:
+                self.logger.error("Unable to create %s: %s", absname, err)
+                return None, DEFAULT_ERRNO, None
+            while len(results) < 2:
+                cv.wait()
+
+        errno, path = results["create"]
+        if errno != zookeeper.OK:
+            if errno not in (zookeeper.NODEEXISTS, zookeeper.NONODE):
+                self.logger.error("Unable to create %s: %s", absname, zookeeper.zerror(errno))
+            return None, errno, None
+        return path, errno, results["exists"][1]
 
     def read(self, absname):
+        self.round_trips += 1
         res = zookeeper.get(self.zkhandle, absname)
         return res[0]
 
-    def list(self, absname):
-        return zookeeper.get_children(self.zkhandle, absname)
+    def get(self, absname):
+        """Returns (value, errno, stat), errno is NONODE
+        if there is no such node"""
+        self.round_trips += 1
+        res, errno = handling_error(zookeeper.get, self.logger)(self.zkhandle, absname)
+        if errno != 0:
+            return None, errno, None
+        return res[0], errno, res[1]
+
+    def _call_many(self, func, paths):
+        """Call the asynchronous func for every path without waiting,
+        up to MAX_PIPELINE at once. Returns the arguments of completions
+        without the handle, in the order of paths"""
+        results = [None] * len(paths)
+        window = threading.Semaphore(MAX_PIPELINE)
+        cv = threading.Condition()
+        left = [len(paths)]
+
+        def completion(i, zh, rc, *value):
+            results[i] = (rc,) + value
+            window.release()
+            with cv:
+                left[0] -= 1
+                cv.notify()
+
+        self.round_trips += 1
+        for i, path in enumerate(paths):
+            window.acquire()
+            try:
+                func(self.zkhandle, path, None, partial(completion, i))
+            except zookeeper.ZooKeeperException as err:
+                self.logger.error("Unable to read %s: %s", path, err)
+                completion(i, self.zkhandle, DEFAULT_ERRNO, None, None)
+        with cv:
+            while left[0]:
+                cv.wait()
+        return results
+
+    def get_many(self, paths):
+        """Read all of the nodes at once, see get.
+        Returns [(value, errno, stat)]"""
+        return [
+            (value, rc, stat) if rc == zookeeper.OK else (None, rc, None)
+            for rc, value, stat in self._call_many(zookeeper.aget, paths)
+        ]
+
+    def list_many(self, paths):
+        """List children of all of the nodes at once.
+        Returns [(children, errno)]"""
+        return [
+            (result[1] if result[0] == zookeeper.OK else None, result[0])
+            for result in self._call_many(zookeeper.aget_children, paths)
+        ]
+
+    def list(self, absname, watcher=None):
+        # watcher is invoked once the list of children changes
+        self.round_trips += 1
+        if watcher is None:
+            return zookeeper.get_children(self.zkhandle, absname)
+
+        assert callable(watcher), "watcher must be callable"
+
+        def children_watcher(zh, event, state, path):
+            self.logger.debug("Children of %s have been changed", path)
+            watcher(event, state, path)
+
+        return zookeeper.get_children(self.zkhandle, absname, children_watcher)
+
+    def exists(self, absname):
+        # returns stat of the node or None if it doesn't exist
+        self.round_trips += 1
+        return zookeeper.exists(self.zkhandle, absname)
 
     def modify(self, absname, value):
+        self.round_trips += 1
         return zookeeper.set(self.zkhandle, absname, value)
 
+    def modify_if(self, absname, value, version):
+        """Set the value only if the node has the version.
+        Returns (errno, stat), errno is BADVERSION otherwise"""
+        self.round_trips += 1
+        stat, errno = handling_error(zookeeper.set2, self.logger)(
+            self.zkhandle, absname, value, version
+        )
+        return errno, stat
+
     def delete(self, absname):
+        self.round_trips += 1
         return zookeeper.delete(self.zkhandle, absname)
 
     # Async API
@@ -19,33 +19,150 @@
 #
 
 
+import binascii
 import logging
+import os
 import socket
-import uuid
+import threading
+import time
+from functools import partial
 
-from ZKeeperAPI import zkapi
+from distributedflock import ZKeeperAPI, metrics
+from distributedflock.ZKeeperAPI import constants as zk
+
+QUEUE_SUFFIX = ".queue"
+QUEUE_NODE_PREFIX = "lock-"
+SEMAPHORE_SUFFIX = ".semaphore"
+SEMAPHORE_NODE_PREFIX = "slot-"
+ELECTION_SUFFIX = ".election"
+CANDIDATE_NODE_PREFIX = "candidate-"
+BUCKET_SUFFIX = ".bucket"
+HOLDER_SUFFIX = ".holder"
+RWLOCK_SUFFIX = ".rwlock"
+READ_NODE_PREFIX = "read-"
+WRITE_NODE_PREFIX = "write-"
+MEMBERS_SUFFIX = ".members"
+MEMBER_NODE_PREFIX = "member-"
+PRIORITY_SUFFIX = ".priority"
+WAITER_NODE_PREFIX = "waiter-"
+# how often a watched listing is read again after a failed read, sec
+WATCH_RETRY_INTERVAL = 1
+
+# results of lock_state()
+LOCK_HELD = "held"
+LOCK_LOST = "lost"
+# Zookeeper is unreachable, but the session may be still alive
+LOCK_UNKNOWN = "unknown"
+
+# while Zookeeper is unreachable the lock is kept for this share of the
+# session timeout since its last reply: the session can't expire earlier
+# than the whole timeout after it, so nobody else can take the lock meanwhile
+LOST_LOCK_SHARE = 0.8
+
+
+def sequence_number(name):
+    # Zookeeper appends a 10 digit counter to sequential nodes
+    return int(name[-10:])
+
+
+def candidate_key(name):
+    # candidate-<score>-<sequence>, the best candidate goes first
+    score = float(name[len(CANDIDATE_NODE_PREFIX):-11])
+    return score, sequence_number(name)
+
+
+def waiter_key(name):
+    # waiter-<priority>-<sequence>, the most urgent waiter goes
+    # first, waiters of the same priority in the order of arrival
+    priority = int(name[len(WAITER_NODE_PREFIX):-11])
+    return -priority, sequence_number(name)
+
+
+def parse_bucket(value):
+    # "<tokens> <time they have been counted at>", a broken
+    # bucket is taken for a full one
+    try:
+        tokens, counted_at = value.split()
+        return float(tokens), float(counted_at)
+    except (AttributeError, ValueError):
+        return 0.0, 0.0
+
+
+def format_bucket(tokens, counted_at):
+    return "%f %f" % (tokens, counted_at)
+
+
+def partition_weight(member, partition):
+    # hashlib is imported only in the partitions mode
+    import hashlib
+
+    return hashlib.md5(("%s:%d" % (member, partition)).encode("utf-8")).hexdigest()
+
+
+def assign_partitions(members, count):
+    """Rendezvous hashing of partitions 0..count-1 over members with
+    bounded load: every partition goes to the member that ranks it
+    highest among those with less than ceil(count / members) partitions.
+    A member that joins or leaves moves few partitions of the others,
+    and every host computes the same. Returns {member: [partitions]}"""
+    owned = dict((member, []) for member in members)
+    if not members:
+        return owned
+    capacity = -(-count // len(members))
+    for partition in range(count):
+        ranked = sorted(members, key=lambda member: partition_weight(member, partition))
+        for member in reversed(ranked):
+            if len(owned[member]) < capacity:
+                owned[member].append(partition)
+                break
+    return owned
 
 
 class ZKLockServer(object):
-    def __init__(self, **config):
+    def __init__(self, zkclient=None, **config):
+        # zkclient allows to share one Zookeeper session
+        # between many locks (see distributedflock.agent)
         try:
             self.log = logging.getLogger(config.get("logger_name", "combaine"))
-            self.zkclient = zkapi.ZKeeperClient(**config)
+            self.own_client = zkclient is None
+            if self.own_client:
+                zkclient = ZKeeperAPI.new_client(**config)
+            self.zkclient = zkclient
             self.id = config["app_id"]
-            res = self.zkclient.write("/%s" % self.id, "Rootnode")
-            if (res != zkapi.zookeeper.NODEEXISTS) and (res < 0):
-                if res == zkapi.DEFAULT_ERRNO:
-                    self.log.error("Unexpectable error")
-                    raise Exception("Unexpectable error. See Zookeeper logs")
-                else:
-                    msg = "Zookeeper error: %s" % zkapi.zookeeper.zerror(res)
-                    self.log.error(msg)
-                    raise Exception(msg)
+            # the root node is created along with the first lock,
+            # see _create
+            self.rootnode = ("/%s" % self.id, "Rootnode")
 
             self.lock = config["name"]
             self.lockpath = "/{}/{}".format(self.id, self.lock)
             self.locked = False
-            self.lock_content = socket.gethostname() + str(uuid.uuid4())
+            self.slot = None
+            # node of a queue which is kept while the plain lock
+            # node is held, it's deleted along with the lock
+            self.ticket = None
+            # owned partitions, see join_partitions
+            self.partitions = None
+            self.partition_count = 0
+            self.members_lock = threading.Lock()
+            # priority of the holder, see getlock_priority
+            self.priority = None
+            # czxid of the lock node is a monotonically increasing token
+            self.czxid = None
+            self.session_id = None
+            self.locked_at = None
+            # callback of set_async_check_lock and whether
+            # the watcher is attached to the lock node now
+            self.lock_watcher = None
+            self.watching = False
+            self.watch_lock = threading.Lock()
+            # there is no need to ask Zookeeper about the lock
+            # until any watcher of the lock node fires
+            self.lock_valid = False
+            self.hostname = socket.gethostname()
+            # uuid4 without importing uuid, which is slow to import
+            self.lock_content = self.hostname + binascii.hexlify(
+                os.urandom(16)
+            ).decode("ascii")
         except Exception as err:
             self.log.error("Failed to init ZKLockServer: %s", err)
             raise
@@ -55,14 +172,718 @@ class ZKLockServer(object):
     def getlock(self):
         if self.locked:
             return True
-        if self.zkclient.write(self.lockpath, self.lock_content, 1) == 0:
-            self.log.info("Lock: success")
-            self.locked = True
+        _, res, stat = self._create(
+            self.lockpath, self.lock_content, zk.EPHEMERAL, [self.rootnode]
+        )
+        if res == 0:
+            metrics.registry.inc("acquire_attempts_total", mode="unique", result="success")
+            self._set_locked(self.lockpath, stat)
+            return True
+        else:
+            metrics.registry.inc("acquire_attempts_total", mode="unique", result="fail")
+            self.log.info("Lock: fail")
+            return False
+
+    def getlock_wait(self, timeout):
+        """Try to acquire the lock during timeout. All waiters watch
+        the lock node itself, see getlock_queued for a fair variant."""
+        if self.getlock():
+            return True
+
+        self.log.info("Try to wait %d sec", timeout)
+        started = time.time()
+        limit_time = started + timeout
+        while limit_time - time.time() > 0.1:
+            time_to_wait = limit_time - time.time()
+            if not self._wait_watch(
+                partial(self.set_node_deleting_watcher, self.lockpath), time_to_wait
+            ):
+                self.log.error("unable to attach delete watcher")
+                break
+
+            if self.getlock():
+                self._waited("wait", started, "success")
+                return True
+        self._waited("wait", started, "fail")
+        return False
+
+    def _waited(self, mode, started, result):
+        metrics.registry.observe(
+            "wait_seconds", time.time() - started, mode=mode, result=result
+        )
+
+    def _wait_watch(self, attach, timeout):
+        """Attach a watcher with attach(callback) and wait until
+        it fires. Returns False if the watcher can't be attached."""
+        cond_var = threading.Condition()
+        fired = []
+
+        def watcher():
+            metrics.registry.inc("watch_fires_total", kind="wait")
+            with cond_var:
+                fired.append(True)
+                cond_var.notify()
+
+        with cond_var:
+            if not attach(watcher):
+                return False
+            if not fired:
+                cond_var.wait(timeout)
+        return True
+
+    def getlock_queued(self, timeout=0):
+        """Acquire the lock through a FIFO queue of ephemeral sequential
+        nodes. Every waiter watches only its predecessor, so a release
+        wakes exactly one waiter."""
+        queuepath = "/{}/{}{}".format(self.id, self.lock, QUEUE_SUFFIX)
+        return self._getlock_ordered("queue", queuepath, QUEUE_NODE_PREFIX, timeout)
+
+    def getlock_shared(self, timeout=0):
+        """Acquire the read side of a read-write lock. Readers wait only
+        for the writers which have come before them, so they hold
+        the lock together."""
+        rwpath = "/{}/{}{}".format(self.id, self.lock, RWLOCK_SUFFIX)
+        return self._getlock_ordered("shared", rwpath, READ_NODE_PREFIX, timeout, shared=True)
+
+    def getlock_exclusive(self, timeout=0):
+        """Acquire the write side of a read-write lock, it waits
+        for everybody who has come before"""
+        rwpath = "/{}/{}{}".format(self.id, self.lock, RWLOCK_SUFFIX)
+        return self._getlock_ordered("exclusive", rwpath, WRITE_NODE_PREFIX, timeout)
+
+    def _getlock_ordered(self, mode, queuepath, prefix, timeout, shared=False):
+        """Acquire the lock by an ephemeral sequential node in queuepath.
+        The lock is ours when no node before ours blocks it: any node
+        does, or only writers if it's shared. Every waiter watches only
+        the nearest blocking node. Unless it's shared, the plain lock
+        node is taken as well, so the holder excludes holders of other
+        modes and of older versions, and the queue node is kept as
+        the ticket until the lock is released."""
+        if self.locked:
+            return True
+
+        started = time.time()
+        lockpath = "/{}/{}".format(self.id, self.lock)
+        node, stat = self._enqueue(queuepath, prefix)
+        if node is None:
+            metrics.registry.inc("acquire_attempts_total", mode=mode, result="fail")
+            self.log.info("Lock: fail")
+            return False
+
+        name = node.rsplit("/", 1)[1]
+        limit_time = started + timeout
+        while True:
+            try:
+                children = sorted(self.zkclient.list(queuepath), key=sequence_number)
+                blocking = children[:children.index(name)]
+            except Exception as err:
+                self.log.error("Unable to read the queue %s: %s", queuepath, err)
+                break
+            if shared:
+                blocking = [child for child in blocking if child.startswith(WRITE_NODE_PREFIX)]
+
+            if not blocking:
+                if not shared:
+                    _, res, stat = self.zkclient.create2(lockpath, self.lock_content, zk.EPHEMERAL)
+                    if res != 0 and res != zk.NODEEXISTS:
+                        self.log.error("Unable to create %s: %d", lockpath, res)
+                        break
+                if shared or res == 0:
+                    metrics.registry.inc("acquire_attempts_total", mode=mode, result="success")
+                    self._waited(mode, started, "success")
+                    if shared:
+                        self._set_locked(node, stat)
+                    else:
+                        self.ticket = node
+                        self._set_locked(lockpath, stat)
+                    return True
+
+            time_to_wait = limit_time - time.time()
+            if time_to_wait <= 0:
+                break
+
+            if blocking:
+                watched = "{}/{}".format(queuepath, blocking[-1])
+            else:
+                # the lock is held outside of the queue
+                watched = lockpath
+            self.log.debug("Queue position %d, watching %s", len(blocking), watched)
+            if not self._wait_watch(
+                partial(self.set_node_deleting_watcher, watched), time_to_wait
+            ):
+                self.log.error("unable to attach delete watcher")
+                break
+
+        # leave the queue, so we don't block the waiters behind us
+        try:
+            self.zkclient.delete(node)
+        except Exception as err:
+            self.log.error("Unable to leave the queue: %s", err)
+        metrics.registry.inc("acquire_attempts_total", mode=mode, result="fail")
+        self._waited(mode, started, "fail")
+        self.log.info("Lock: fail")
+        return False
+
+    def getlock_elected(self, score, window, timeout=0):
+        """Acquire the lock by an election of the least loaded contender.
+        Every contender publishes its score (lower is better) in the name
+        of an ephemeral sequential node, so a single listing tells all
+        the scores. After `window` seconds only the best candidate goes
+        for the lock, the others wait until it's done, within `timeout`
+        seconds overall."""
+        if self.locked:
+            return True
+
+        started = time.time()
+        electionpath = "/{}/{}{}".format(self.id, self.lock, ELECTION_SUFFIX)
+        node, res, _ = self._create(
+            "{}/{}{:f}-".format(electionpath, CANDIDATE_NODE_PREFIX, score),
+            self.lock_content,
+            zk.EPHEMERAL | zk.SEQUENCE,
+            [self.rootnode, (electionpath, "Election")],
+        )
+        if res != 0:
+            self.log.error("Unable to join the election %s: %d", electionpath, res)
+            self._waited("elect", started, "fail")
+            self.log.info("Lock: fail")
+            return False
+
+        name = node.rsplit("/", 1)[1]
+        limit_time = started + max(window, timeout)
+        # let the other contenders publish their scores
+        time.sleep(window)
+        acquired = False
+        while True:
+            try:
+                children = sorted(
+                    (child for child in self.zkclient.list(electionpath)
+                     if child.startswith(CANDIDATE_NODE_PREFIX)),
+                    key=candidate_key,
+                )
+            except Exception as err:
+                self.log.error("Unable to read the election %s: %s", electionpath, err)
+                break
+
+            time_to_wait = limit_time - time.time()
+            if children and children[0] == name:
+                self.log.debug("Candidate %s has won the election", name)
+                if time_to_wait > 0:
+                    acquired = self.getlock_wait(time_to_wait)
+                else:
+                    acquired = self.getlock()
+                break
+            if name not in children or time_to_wait <= 0:
+                break
+
+            best = "{}/{}".format(electionpath, children[0])
+            self.log.debug("Candidate %s is less loaded, watching it", best)
+            if not self._wait_watch(
+                partial(self.set_node_deleting_watcher, best), time_to_wait
+            ):
+                self.log.error("unable to attach delete watcher")
+                break
+
+        # the next best candidate goes for the lock once we are gone
+        try:
+            self.zkclient.delete(node)
+        except Exception as err:
+            self.log.error("Unable to leave the election: %s", err)
+        self._waited("elect", started, "success" if acquired else "fail")
+        if not acquired:
+            self.log.info("Lock: fail")
+        return acquired
+
+    def getlock_priority(self, priority, timeout=0):
+        """Acquire the lock by a queue of waiters ordered by priority
+        (higher is more urgent), then by arrival. The priority is in the
+        name of an ephemeral sequential node, so a single listing tells
+        the order. Only the first waiter goes for the lock node, the
+        others watch the waiter before them. A waiter that comes later
+        with a higher priority goes ahead of everybody waiting, but
+        never preempts the holder, see watch_urgent."""
+        if self.locked:
             return True
+
+        started = time.time()
+        priorpath = "/{}/{}{}".format(self.id, self.lock, PRIORITY_SUFFIX)
+        node, res, _ = self._create(
+            "{}/{}{:d}-".format(priorpath, WAITER_NODE_PREFIX, priority),
+            self.lock_content,
+            zk.EPHEMERAL | zk.SEQUENCE,
+            [self.rootnode, (priorpath, "Priority queue")],
+        )
+        if res != 0:
+            self.log.error("Unable to join the queue %s: %d", priorpath, res)
+            self._waited("priority", started, "fail")
+            self.log.info("Lock: fail")
+            return False
+
+        name = node.rsplit("/", 1)[1]
+        limit_time = started + timeout
+        acquired = False
+        while True:
+            try:
+                children = sorted(
+                    (child for child in self.zkclient.list(priorpath)
+                     if child.startswith(WAITER_NODE_PREFIX)),
+                    key=waiter_key,
+                )
+                position = children.index(name)
+            except Exception as err:
+                self.log.error("Unable to read the queue %s: %s", priorpath, err)
+                break
+
+            # the queue is listed again after every wakeup, so a more
+            # urgent waiter which has come meanwhile takes the turn
+            if position == 0 and self.getlock():
+                acquired = True
+                break
+            time_to_wait = limit_time - time.time()
+            if time_to_wait <= 0:
+                break
+
+            if position == 0:
+                watched = self.lockpath
+            else:
+                watched = "{}/{}".format(priorpath, children[position - 1])
+            self.log.debug("Queue position %d, watching %s", position, watched)
+            if not self._wait_watch(
+                partial(self.set_node_deleting_watcher, watched), time_to_wait
+            ):
+                self.log.error("unable to attach delete watcher")
+                break
+
+        # the next waiter goes for the lock once we are gone
+        try:
+            self.zkclient.delete(node)
+        except Exception as err:
+            self.log.error("Unable to leave the queue: %s", err)
+        self._waited("priority", started, "success" if acquired else "fail")
+        if acquired:
+            self.priority = priority
         else:
             self.log.info("Lock: fail")
+        return acquired
+
+    def getlock_affinity(self, window, timeout=0):
+        """Acquire the lock preferring its last holder, which is recorded
+        in a persistent node. Other hosts back off for `window` seconds
+        whenever the lock is free, so the last holder re-acquires it
+        first, and take it over if it doesn't show up. Waits for the
+        lock up to `timeout` seconds."""
+        if self.locked:
+            return True
+
+        started = time.time()
+        holderpath = "/{}/{}{}".format(self.id, self.lock, HOLDER_SUFFIX)
+        value, res, _ = self.zkclient.get(holderpath)
+        holder = value if res == 0 else None
+        if holder is None or holder == self.hostname:
+            if timeout > 0:
+                acquired = self.getlock_wait(timeout)
+            else:
+                acquired = self.getlock()
+        else:
+            acquired = False
+            limit_time = started + max(window, timeout)
+            backoff_time = started + window
+            while True:
+                self.log.info("Back off in favour of %s", holder)
+                time.sleep(max(0, backoff_time - time.time()))
+                if self.getlock():
+                    acquired = True
+                    break
+                time_to_wait = limit_time - time.time()
+                if time_to_wait <= 0:
+                    break
+                if not self._wait_watch(
+                    partial(self.set_node_deleting_watcher, self.lockpath), time_to_wait
+                ):
+                    self.log.error("unable to attach delete watcher")
+                    break
+                backoff_time = time.time() + window
+                if backoff_time > limit_time:
+                    break
+
+        if acquired and holder != self.hostname:
+            self._record_holder(holderpath)
+        self._waited("affinity", started, "success" if acquired else "fail")
+        return acquired
+
+    def _record_holder(self, holderpath):
+        # it's written only when the lock moves to another host
+        res, _ = self.zkclient.modify_if(holderpath, self.hostname, -1)
+        if res == zk.NONODE:
+            _, res, _ = self._create(holderpath, self.hostname, 0, [self.rootnode])
+        if res != 0:
+            self.log.error("Unable to record the holder in %s: %d", holderpath, res)
+
+    def take_token(self, rate, burst=1, timeout=0):
+        """Take a token from a bucket shared by all contenders, which is
+        refilled at `rate` tokens per second up to `burst` tokens.
+        Waits for a token up to `timeout` seconds."""
+        started = time.time()
+        bucketpath = "/{}/{}{}".format(self.id, self.lock, BUCKET_SUFFIX)
+        taken, refill = False, 0
+        if timeout <= 0 or not self._queued(bucketpath + QUEUE_SUFFIX):
+            taken, refill = self._take_token(bucketpath, rate, burst)
+        if not taken and refill is not None and timeout > 0:
+            taken = self._wait_token(bucketpath, rate, burst, started + timeout)
+        if not taken:
+            return self._token_denied(started)
+
+        metrics.registry.inc("acquire_attempts_total", mode="rate", result="success")
+        self._waited("rate", started, "success")
+        self.log.info("Token has been taken from %s", bucketpath)
+        return True
+
+    def _take_token(self, bucketpath, rate, burst):
+        """The bucket node keeps the number of tokens and the time they
+        have been counted at. It's updated by a set conditional on the
+        version read, so a token costs a read and a write unless
+        somebody takes one in the meantime. Returns (True, 0) if a token
+        has been taken, otherwise (False, seconds until the next token)
+        or (False, None) on errors."""
+        while True:
+            value, res, stat = self.zkclient.get(bucketpath)
+            now = time.time()
+            if res == zk.NONODE:
+                # the bucket is created full
+                _, res, _ = self._create(
+                    bucketpath, format_bucket(burst - 1, now), 0, [self.rootnode]
+                )
+                if res == 0:
+                    return True, 0
+                elif res == zk.NODEEXISTS:
+                    continue
+                self.log.error("Unable to create %s: %d", bucketpath, res)
+                return False, None
+            elif res != 0:
+                self.log.error("Unable to read %s: %d", bucketpath, res)
+                return False, None
+
+            tokens, counted_at = parse_bucket(value)
+            # clocks of the hosts may differ, a host which is
+            # behind mustn't drain the bucket
+            tokens = min(burst, tokens + max(0, now - counted_at) * rate)
+            if tokens < 1:
+                return False, (1 - tokens) / rate
+            res, _ = self.zkclient.modify_if(
+                bucketpath, format_bucket(tokens - 1, now), stat["version"]
+            )
+            if res == 0:
+                return True, 0
+            elif res != zk.BADVERSION:
+                self.log.error("Unable to update %s: %d", bucketpath, res)
+                return False, None
+            # somebody has taken a token in the meantime
+
+    def _queued(self, queuepath):
+        """Whether anybody waits in the queue. Waiters don't race with
+        its head for tokens, which would cost a failed write each and
+        let them jump the queue."""
+        try:
+            stat = self.zkclient.exists(queuepath)
+        except Exception as err:
+            self.log.error("Unable to check the queue %s: %s", queuepath, err)
+            return True
+        return stat is not None and stat["numChildren"] > 0
+
+    def _wait_token(self, bucketpath, rate, burst, limit_time):
+        """Wait for a token in a FIFO queue. Only the head of the queue
+        waits for the refill, so waiters don't race for every token."""
+        queuepath = bucketpath + QUEUE_SUFFIX
+        node, _ = self._enqueue(queuepath)
+        if node is None:
             return False
 
+        name = node.rsplit("/", 1)[1]
+        taken = False
+        while True:
+            try:
+                children = sorted(self.zkclient.list(queuepath), key=sequence_number)
+                position = children.index(name)
+            except Exception as err:
+                self.log.error("Unable to read the queue %s: %s", queuepath, err)
+                break
+
+            time_to_wait = limit_time - time.time()
+            if position == 0:
+                taken, refill = self._take_token(bucketpath, rate, burst)
+                if taken or refill is None or refill > time_to_wait:
+                    break
+                time.sleep(refill)
+                continue
+            if time_to_wait <= 0:
+                break
+
+            predecessor = "{}/{}".format(queuepath, children[position - 1])
+            if not self._wait_watch(
+                partial(self.set_node_deleting_watcher, predecessor), time_to_wait
+            ):
+                self.log.error("unable to attach delete watcher")
+                break
+
+        # let the next waiter go
+        try:
+            self.zkclient.delete(node)
+        except Exception as err:
+            self.log.error("Unable to leave the queue: %s", err)
+        return taken
+
+    def _token_denied(self, started):
+        metrics.registry.inc("acquire_attempts_total", mode="rate", result="fail")
+        self._waited("rate", started, "fail")
+        self.log.info("Lock: fail")
+        return False
+
+    def getlock_semaphore(self, permits, timeout=0):
+        """Acquire one of `permits` slots of a counting semaphore.
+        Busy slots are learned with a single get_children, so the common
+        case costs one list plus two creates: the slot node and the plain
+        node name_<slot>, which older versions take for the slot. Returns
+        the slot number or None."""
+        if self.locked:
+            return self.slot
+
+        started = time.time()
+        semaphorepath = "/{}/{}{}".format(self.id, self.lock, SEMAPHORE_SUFFIX)
+        parents = [self.rootnode, (semaphorepath, "Semaphore")]
+        limit_time = started + timeout
+        cond_var = threading.Condition()
+        while True:
+            time_to_wait = limit_time - time.time()
+            fired = []
+
+            def watcher(*args):
+                metrics.registry.inc("watch_fires_total", kind="wait")
+                with cond_var:
+                    fired.append(True)
+                    cond_var.notify()
+
+            with cond_var:
+                try:
+                    children = self.zkclient.list(
+                        semaphorepath, watcher if time_to_wait > 0 else None
+                    )
+                except Exception as err:
+                    # the semaphore is used for the first time
+                    if parents and self._create_parents(parents):
+                        parents = None
+                        continue
+                    self.log.error("Unable to read %s: %s", semaphorepath, err)
+                    break
+
+                busy = set(
+                    int(child[len(SEMAPHORE_NODE_PREFIX):])
+                    for child in children
+                    if child.startswith(SEMAPHORE_NODE_PREFIX)
+                )
+                # slots held by older versions aren't in the listing
+                legacy = False
+                for slot in range(permits):
+                    if slot in busy:
+                        continue
+                    slotpath = "{}/{}{}".format(
+                        semaphorepath, SEMAPHORE_NODE_PREFIX, slot
+                    )
+                    _, res, stat = self.zkclient.create2(
+                        slotpath, self.lock_content, zk.EPHEMERAL
+                    )
+                    if res == 0:
+                        plainpath = "/{}/{}_{}".format(self.id, self.lock, slot)
+                        _, res, stat = self.zkclient.create2(
+                            plainpath, self.lock_content, zk.EPHEMERAL
+                        )
+                        if res == 0:
+                            metrics.registry.inc(
+                                "acquire_attempts_total", mode="semaphore", result="success"
+                            )
+                            self._waited("semaphore", started, "success")
+                            self.slot = slot
+                            self.ticket = slotpath
+                            self._set_locked(plainpath, stat)
+                            return slot
+                        try:
+                            self.zkclient.delete(slotpath)
+                        except Exception as err:
+                            self.log.error("Unable to free %s: %s", slotpath, err)
+                        slotpath = plainpath
+                        legacy = True
+                    if res != 0 and res != zk.NODEEXISTS:
+                        self.log.error("Unable to create %s: %d", slotpath, res)
+                        time_to_wait = 0
+                        break
+
+                if time_to_wait <= 0:
+                    break
+                if legacy:
+                    # our own slot nodes have fired the watcher, and
+                    # nobody tells when an older version frees its slot
+                    cond_var.wait(min(time_to_wait, WATCH_RETRY_INTERVAL))
+                elif not fired:
+                    cond_var.wait(time_to_wait)
+
+        metrics.registry.inc("acquire_attempts_total", mode="semaphore", result="fail")
+        self._waited("semaphore", started, "fail")
+        self.log.info("Lock: fail")
+        return None
+
+    def join_partitions(self, count):
+        """Register this worker by an ephemeral sequential node, which is
+        held as the lock, and take its share of `count` partitions, see
+        assign_partitions. Returns the owned partitions or None."""
+        if self.locked:
+            return self.partitions
+
+        started = time.time()
+        memberspath = "/{}/{}{}".format(self.id, self.lock, MEMBERS_SUFFIX)
+        node, stat = self._enqueue(memberspath, MEMBER_NODE_PREFIX)
+        if node is None:
+            metrics.registry.inc("acquire_attempts_total", mode="partitions", result="fail")
+            self.log.info("Lock: fail")
+            return None
+        try:
+            members = self.zkclient.list(memberspath)
+        except Exception as err:
+            self.log.error("Unable to read the members %s: %s", memberspath, err)
+            try:
+                self.zkclient.delete(node)
+            except Exception as err:
+                self.log.error("Unable to leave the members: %s", err)
+            metrics.registry.inc("acquire_attempts_total", mode="partitions", result="fail")
+            return None
+
+        metrics.registry.inc("acquire_attempts_total", mode="partitions", result="success")
+        self._waited("partitions", started, "success")
+        self._set_locked(node, stat)
+        self.partition_count = count
+        self.partitions = self._own_partitions(members)
+        self.log.info("Partitions %s of %d members", self.partitions, len(members))
+        return self.partitions
+
+    def _own_partitions(self, members):
+        name = self.lockpath.rsplit("/", 1)[1]
+        return assign_partitions(members, self.partition_count).get(name, [])
+
+    def watch_partitions(self, callback):
+        """callback(partitions) is called from Zookeeper threads
+        whenever the owned partitions change as members come and go"""
+        assert callable(callback), "callback must be callable"
+        memberspath = self.lockpath.rsplit("/", 1)[0]
+
+        def watcher(*args):
+            metrics.registry.inc("watch_fires_total", kind="members")
+            self.watch_partitions(callback)
+
+        if not self.locked:
+            return False
+        with self.members_lock:
+            try:
+                members = self.zkclient.list(memberspath, watcher)
+            except Exception as err:
+                # the watcher hasn't been attached, so nobody
+                # is going to tell us about the members
+                self.log.error("Unable to read the members %s: %s", memberspath, err)
+                retry = threading.Timer(WATCH_RETRY_INTERVAL, watcher)
+                retry.daemon = True
+                retry.start()
+                return False
+            partitions = self._own_partitions(members)
+            if partitions == self.partitions:
+                return True
+            self.log.info("Partitions %s of %d members", partitions, len(members))
+            self.partitions = partitions
+            callback(partitions)
+        return True
+
+    def watch_urgent(self, callback):
+        """callback() is called once from a Zookeeper thread as soon
+        as a waiter with a higher priority than ours joins the queue
+        of getlock_priority, so the holder may yield the lock"""
+        assert callable(callback), "callback must be callable"
+        priorpath = self.lockpath + PRIORITY_SUFFIX
+
+        def watcher(*args):
+            metrics.registry.inc("watch_fires_total", kind="priority")
+            self.watch_urgent(callback)
+
+        if not self.locked or self.priority is None:
+            return False
+        try:
+            children = self.zkclient.list(priorpath, watcher)
+        except Exception as err:
+            # the watcher hasn't been attached, so nobody
+            # is going to tell us about the waiters
+            self.log.error("Unable to read the queue %s: %s", priorpath, err)
+            retry = threading.Timer(WATCH_RETRY_INTERVAL, watcher)
+            retry.daemon = True
+            retry.start()
+            return False
+        urgent = [
+            child for child in children
+            if child.startswith(WAITER_NODE_PREFIX) and -waiter_key(child)[0] > self.priority
+        ]
+        if urgent:
+            self.log.info("%d waiters are more urgent than priority %d", len(urgent), self.priority)
+            # the queue isn't watched anymore, the holder is asked once
+            self.priority = None
+            callback()
+        return True
+
+    def _set_locked(self, lockpath, stat=None):
+        """stat is the one returned by create2, it's asked
+        for if the backend hasn't provided it"""
+        self.lockpath = lockpath
+        self.locked = True
+        self.locked_at = time.time()
+        self.log.info("Lock: success %s", lockpath)
+        try:
+            self.session_id = self.zkclient.session_id
+            if stat is None:
+                stat = self.zkclient.exists(lockpath)
+        except Exception as err:
+            self.log.error("Unable to stat the lock %s", repr(err))
+            return
+        if stat is not None:
+            self.czxid = stat["czxid"]
+            self.lock_valid = True
+
+    def _create(self, path, content, flags, parents):
+        """Create the node assuming its parents exist, so it takes one
+        round trip. parents are (path, content) from the root down,
+        they are created only if Zookeeper says they are missing.
+        Returns (path, errno, stat)"""
+        node, res, stat = self.zkclient.create2(path, content, flags)
+        if res == zk.NONODE and self._create_parents(parents):
+            node, res, stat = self.zkclient.create2(path, content, flags)
+        return node, res, stat
+
+    def _create_parents(self, parents):
+        for path, content in parents:
+            res = self.zkclient.write(path, content)
+            if res != zk.NODEEXISTS and res < 0:
+                self.log.error("Unable to create %s: %d", path, res)
+                return False
+        return True
+
+    @property
+    def round_trips(self):
+        """Requests this process has waited for since it connected"""
+        return self.zkclient.round_trips
+
+    def _enqueue(self, queuepath, prefix=QUEUE_NODE_PREFIX):
+        node, res, stat = self._create(
+            "{}/{}".format(queuepath, prefix),
+            self.lock_content,
+            zk.EPHEMERAL | zk.SEQUENCE,
+            [self.rootnode, (queuepath, "Queue")],
+        )
+        if res != 0:
+            self.log.error("Unable to join the queue %s: %d", queuepath, res)
+            return None, None
+        return node, stat
+
     def set_lock_name(self, name):
         self.lock = name
         self.lockpath = "/{}/{}".format(self.id, self.lock)
@@ -70,32 +891,115 @@ class ZKLockServer(object):
     def releaselock(self):
         try:
             self.zkclient.delete(self.lockpath)
-            self.log.info("Unlocked successfully")
-            self.locked = False
-            return True
         except Exception as err:
             self.log.error("Unlocking failed %s", err)
-        return False
+            # the delete may have reached the server before the
+            # connection was lost, so the node is checked there
+            self.lock_valid = False
+            if self.lock_state() != LOCK_LOST:
+                return False
+        self.log.info("Unlocked successfully")
+        self._leave_ticket()
+        self._observe_hold()
+        self.locked = False
+        self.lock_valid = False
+        self.lock_watcher = None
+        return True
 
-    def check_lock(self):
+    def _leave_ticket(self):
+        # the next waiter in the queue goes once the ticket is gone
+        if self.ticket is None:
+            return
+        try:
+            self.zkclient.delete(self.ticket)
+        except Exception as err:
+            self.log.error("Unable to leave the queue: %s", err)
+        self.ticket = None
+
+    def _observe_hold(self):
+        if self.locked:
+            metrics.registry.observe("hold_seconds", time.time() - self.locked_at)
+
+    @property
+    def session_timeout(self):
+        """Negotiated session timeout, sec"""
+        return self.zkclient.session_timeout / 1e3
+
+    def lock_deadline(self):
+        """Time until which the lock is surely ours while Zookeeper is unreachable"""
+        return self.zkclient.last_recv + self.session_timeout * LOST_LOCK_SHARE
+
+    def lock_state(self):
+        """The lock is held while the lock node is the one we have created
+        and it's owned by our session. Until any watcher of the lock
+        fires it's answered locally. While Zookeeper is unreachable
+        the session may be still alive, so the answer is LOCK_UNKNOWN."""
+        if not self.locked:
+            return LOCK_LOST
+        if self.zkclient.state in (zk.EXPIRED_SESSION_STATE, zk.AUTH_FAILED_STATE):
+            return LOCK_LOST
+        if self.lock_valid and self.zkclient.connected:
+            return LOCK_HELD
         try:
-            content = self.zkclient.read(self.lockpath)
-            return content == self.lock_content
+            stat = self.zkclient.exists(self.lockpath)
         except Exception as err:
+            if self.zkclient.state == zk.EXPIRED_SESSION_STATE:
+                return LOCK_LOST
+            if not self.zkclient.connected:
+                self.log.debug("Unable to check lock: %s", repr(err))
+                return LOCK_UNKNOWN
             self.log.error("Unable to check lock %s", repr(err))
-        return False
+            return LOCK_LOST
+        owner = stat is not None and (stat["ephemeralOwner"], stat["czxid"])
+        self.lock_valid = owner == (self.session_id, self.czxid)
+        if not self.lock_valid:
+            return LOCK_LOST
+        self._watch_lock()
+        return LOCK_HELD
+
+    def check_lock(self):
+        return self.lock_state() == LOCK_HELD
 
     def set_async_check_lock(self, callback):
         assert callable(callback), "callback must be callable"
         if not self.locked:
             return False
+        self.lock_watcher = callback
+        return self._watch_lock()
+
+    def _watch_lock(self):
+        """Attach the watcher of set_async_check_lock unless it's attached.
+        A watcher that failed to attach is attached again as soon as
+        the lock is confirmed by lock_state."""
+        with self.watch_lock:
+            if self.watching or self.lock_watcher is None:
+                return True
+            self.watching = True
+        callback = self.lock_watcher
 
-        def callback_wrapper(*args):
+        def callback_wrapper(event=None, state=None, path=None):
+            metrics.registry.inc("watch_fires_total", kind="lock")
+            if event == zk.SESSION_EVENT and state != zk.EXPIRED_SESSION_STATE:
+                # the watcher stays attached while the session is alive,
+                # changes missed while disconnected are delivered later
+                callback()
+                return
+            self.watching = False
+            self.lock_valid = False
             callback()
-            if self.check_lock():
-                self.zkclient.aget(self.lockpath, callback_wrapper)
+            # attach it again if the lock is still ours
+            self.lock_state()
 
-        return self.zkclient.aget(self.lockpath, callback_wrapper)
+        def callback_rc_wrapper(rc):
+            # the watcher hasn't been attached, so nobody
+            # is going to tell us about the lock
+            if rc != 0:
+                callback_wrapper()
+
+        if not self.zkclient.aget(self.lockpath, callback_wrapper, callback_rc_wrapper):
+            self.watching = False
+            return False
+        return True
 
     def set_node_deleting_watcher(self, path, callback):
         assert callable(callback), "callback must be callable"
@@ -111,6 +1015,159 @@ class ZKLockServer(object):
         return self.zkclient.aget(path, callback_wrapper, callback_rc_wrapper)
 
     def destroy(self):
+        if not self.own_client:
+            # the session is shared, so only our lock has to go
+            return not self.locked or self.releaselock()
+        # the ephemeral lock node goes away with the session
+        self._observe_hold()
+        self.locked = False
+        try:
+            self.zkclient.disconnect()
+            self.log.info("Disconnected successfully")
+            return True
+        except Exception as err:
+            self.log.error("Disconnection error %s", err)
+        return False
+
+
+class MultiLockServer(object):
+    """Several locks taken all at once in one session. They are created
+    in one multi transaction if the backend supports it, otherwise one
+    by one in the order of names, so jobs taking the same locks don't
+    deadlock, and released if any of them is busy. The interface is
+    the one of ZKLockServer for the unique lock."""
+
+    def __init__(self, names, zkclient=None, **config):
+        try:
+            self.log = logging.getLogger(config.get("logger_name", "combaine"))
+            self.own_client = zkclient is None
+            if self.own_client:
+                zkclient = ZKeeperAPI.new_client(**config)
+            self.zkclient = zkclient
+            self.locks = [
+                ZKLockServer(zkclient=zkclient, **dict(config, name=name))
+                for name in sorted(set(names))
+            ]
+            self.lock = ",".join(z.lock for z in self.locks)
+        except Exception as err:
+            self.log.error("Failed to init MultiLockServer: %s", err)
+            raise
+
+    @property
+    def locked(self):
+        return all(z.locked for z in self.locks)
+
+    @property
+    def czxid(self):
+        # nodes created by one transaction share the czxid, otherwise
+        # the latest one is a token growing with every acquisition
+        if not self.locked:
+            return None
+        return max(z.czxid for z in self.locks)
+
+    @property
+    def round_trips(self):
+        return self.zkclient.round_trips
+
+    @property
+    def session_timeout(self):
+        return self.zkclient.session_timeout / 1e3
+
+    def lock_deadline(self):
+        return self.zkclient.last_recv + self.session_timeout * LOST_LOCK_SHARE
+
+    def getlock(self):
+        return self.getlock_wait(0)
+
+    def getlock_wait(self, timeout):
+        """Try to acquire all of the locks during timeout,
+        waiting for the lock which is busy"""
+        if self.locked:
+            return True
+
+        started = time.time()
+        limit_time = started + timeout
+        while True:
+            if getattr(self.zkclient, "supports_multi", False):
+                acquired, blocking = self._lock_multi()
+            else:
+                acquired, blocking = self._lock_ordered()
+            if acquired:
+                metrics.registry.inc("acquire_attempts_total", mode="multi", result="success")
+                self._waited(started, "success")
+                return True
+
+            time_to_wait = limit_time - time.time()
+            if blocking is None or time_to_wait <= 0:
+                break
+            self.log.debug("Lock %s is busy, waiting for it", blocking.lockpath)
+            if not blocking._wait_watch(
+                partial(blocking.set_node_deleting_watcher, blocking.lockpath), time_to_wait
+            ):
+                self.log.error("unable to attach delete watcher")
+                break
+
+        metrics.registry.inc("acquire_attempts_total", mode="multi", result="fail")
+        self._waited(started, "fail")
+        self.log.info("Lock: fail")
+        return False
+
+    def _waited(self, started, result):
+        metrics.registry.observe(
+            "wait_seconds", time.time() - started, mode="multi", result=result
+        )
+
+    def _lock_multi(self):
+        """Returns (acquired, the busy lock)"""
+        nodes = [(z.lockpath, z.lock_content) for z in self.locks]
+        res, failed = self.zkclient.create_multi(nodes, zk.EPHEMERAL)
+        if res == zk.NONODE and self.locks[0]._create_parents([self.locks[0].rootnode]):
+            res, failed = self.zkclient.create_multi(nodes, zk.EPHEMERAL)
+        if res == 0:
+            for z in self.locks:
+                z._set_locked(z.lockpath)
+            return True, None
+        elif res == zk.NODEEXISTS and failed is not None:
+            return False, self.locks[failed]
+        self.log.error("Unable to create locks %s: %d", self.lock, res)
+        return False, None
+
+    def _lock_ordered(self):
+        for i, z in enumerate(self.locks):
+            if not z.getlock():
+                # nothing is held while waiting
+                for taken in self.locks[:i]:
+                    taken.releaselock()
+                return False, z
+        return True, None
+
+    def releaselock(self):
+        return all([z.releaselock() for z in self.locks if z.locked])
+
+    def lock_state(self):
+        """The worst of the states of the locks"""
+        states = [z.lock_state() for z in self.locks]
+        if LOCK_LOST in states:
+            return LOCK_LOST
+        elif LOCK_UNKNOWN in states:
+            return LOCK_UNKNOWN
+        return LOCK_HELD
+
+    def check_lock(self):
+        return self.lock_state() == LOCK_HELD
+
+    def set_async_check_lock(self, callback):
+        if not self.locked:
+            return False
+        return all([z.set_async_check_lock(callback) for z in self.locks])
+
+    def destroy(self):
+        if not self.own_client:
+            return all([z.destroy() for z in self.locks])
+        # the ephemeral lock nodes go away with the session
+        for z in self.locks:
+            z._observe_hold()
+            z.locked = False
         try:
             self.zkclient.disconnect()
             self.log.info("Disconnected successfully")
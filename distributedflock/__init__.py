@@ -71,3 +71,8 @@ class Daemon(object):
 
     def run(self, *args):
         pass
+
+
+from distributedflock.api import Lock, LockError, close, configure, lock  # noqa: E402
+
+__all__ = ["Daemon", "Lock", "LockError", "close", "configure", "lock"]
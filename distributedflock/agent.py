@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of python-flock.
+#
+# python-flock is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-flock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Per-host lock agent.
+
+The agent keeps one authenticated Zookeeper session and serves lock
+requests over a Unix socket, so zk-flock invocations don't have to
+establish a session of their own. The protocol is newline delimited JSON:
+
+    -> {"id": 1, "op": "getlock", "args": []}
+    <- {"id": 1, "result": true, "state": {...}}
+    <- {"event": 1}  # a watcher attached by request 1 has fired
+
+Locks of a connection are released when the connection is closed.
+Once the session expires, the connections which have used it are
+closed, so the clients know their locks are lost, and a new session
+is established for the next ones.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from functools import partial
+
+try:
+    import socketserver
+except ImportError:  # python 2
+    import SocketServer as socketserver  # noqa: N813
+
+from distributedflock import Zookeeper
+from distributedflock.ZKeeperAPI import constants as zk
+
+DEFAULT_AGENT_SOCKET = "/var/run/zk-flock.sock"
+# only the owner of the agent may take locks through it by default
+DEFAULT_AGENT_MODE = 0o600
+# how often the agent checks that its session is alive, sec
+SESSION_CHECK_INTERVAL = 1
+
+# ZKLockServer methods available to the clients
+METHODS = (
+    "getlock",
+    "getlock_wait",
+    "getlock_queued",
+    "getlock_shared",
+    "getlock_exclusive",
+    "getlock_elected",
+    "getlock_affinity",
+    "getlock_priority",
+    "getlock_semaphore",
+    "take_token",
+    "check_lock",
+    "lock_state",
+    "lock_deadline",
+    "releaselock",
+    "set_lock_name",
+)
+# methods accepting a callback as the last argument
+WATCHERS = ("set_async_check_lock", "set_node_deleting_watcher")
+
+
+class AgentError(Exception):
+    pass
+
+
+def reply_state(lockserver):
+    return {
+        "lockpath": lockserver.lockpath,
+        "locked": lockserver.locked,
+        "slot": lockserver.slot,
+        "czxid": lockserver.czxid,
+        "session_timeout": lockserver.session_timeout,
+    }
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.wlock = threading.Lock()
+        self.lockserver = None
+        self.server.attach(self)
+
+    def send(self, msg):
+        data = (json.dumps(msg) + "\n").encode("utf-8")
+        with self.wlock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except (IOError, socket.error) as err:
+                self.server.log.debug("Unable to reply: %s", err)
+
+    def handle(self):
+        for line in iter(self.rfile.readline, b""):
+            try:
+                request = json.loads(line.decode("utf-8"))
+            except ValueError as err:
+                self.server.log.error("Malformed request: %s", err)
+                break
+            self.send(self.dispatch(request))
+
+    def dispatch(self, request):
+        op = request.get("op")
+        args = request.get("args", [])
+        reply = {"id": request.get("id")}
+        try:
+            if op == "open":
+                app_id, name = args
+                self.lockserver = Zookeeper.ZKLockServer(
+                    zkclient=self.server.client(),
+                    logger_name=self.server.log.name,
+                    app_id=app_id,
+                    name=name,
+                )
+                result = True
+            elif self.lockserver is None:
+                raise AgentError("lock has not been opened")
+            elif op in METHODS:
+                result = getattr(self.lockserver, op)(*args)
+            elif op in WATCHERS:
+                callback = partial(self.send, {"event": request["id"]})
+                result = getattr(self.lockserver, op)(*(args + [callback]))
+            else:
+                raise AgentError("unknown operation %s" % op)
+        except Exception as err:
+            self.server.log.error("Request %s failed: %s", op, err)
+            reply["error"] = str(err)
+        else:
+            reply["result"] = result
+            reply["state"] = reply_state(self.lockserver)
+        return reply
+
+    def close(self):
+        # the client finds out that its lock is lost
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except socket.error as err:
+            self.server.log.debug("Unable to close connection: %s", err)
+
+    def finish(self):
+        self.server.detach(self)
+        if self.lockserver is not None:
+            self.lockserver.destroy()
+        socketserver.StreamRequestHandler.finish(self)
+
+
+def session_alive(zkclient):
+    return zkclient.state not in (zk.EXPIRED_SESSION_STATE, zk.AUTH_FAILED_STATE)
+
+
+class LockAgent(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """connect() returns a new Zookeeper client, it's called again
+    once the session has expired"""
+
+    daemon_threads = True
+
+    def __init__(self, path, connect, logger_name="zk-flock", mode=DEFAULT_AGENT_MODE, group=None):
+        self.log = logging.getLogger(logger_name)
+        self.connect = connect
+        self.zkclient = connect()
+        self.session_lock = threading.Lock()
+        self.handlers = set()
+        if os.path.exists(path):
+            # stale socket of the previous agent
+            os.unlink(path)
+        # nobody may connect before the mode is set
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, AgentHandler)
+        finally:
+            os.umask(umask)
+        if group is not None:
+            import grp
+
+            os.chown(path, -1, grp.getgrnam(group).gr_gid)
+        os.chmod(path, mode)
+        self.log.info("Agent is listening on %s", path)
+
+        watchdog = threading.Thread(target=self._watch_session)
+        watchdog.daemon = True
+        watchdog.start()
+
+    def attach(self, handler):
+        with self.session_lock:
+            self.handlers.add(handler)
+
+    def detach(self, handler):
+        with self.session_lock:
+            self.handlers.discard(handler)
+
+    def client(self):
+        """Returns the shared client, a new session is established
+        if the current one has expired. Raises AgentError if it can't."""
+        with self.session_lock:
+            if session_alive(self.zkclient):
+                return self.zkclient
+            self.log.error("Session has expired, establishing a new one")
+            dead = self.zkclient
+            try:
+                self.zkclient = self.connect()
+            except Exception as err:
+                self.log.error("Unable to establish a session: %s", err)
+            # locks of the dead session are lost
+            for handler in self.handlers:
+                if handler.lockserver is not None and handler.lockserver.zkclient is dead:
+                    handler.close()
+            if self.zkclient is dead:
+                raise AgentError("session has expired")
+        try:
+            dead.disconnect()
+        except Exception as err:
+            self.log.debug("Unable to close the expired session: %s", err)
+        return self.zkclient
+
+    def _watch_session(self):
+        while True:
+            time.sleep(SESSION_CHECK_INTERVAL)
+            try:
+                self.client()
+            except AgentError:
+                pass
+
+
+class AgentLockServer(object):
+    """Client side of the agent. It mimics ZKLockServer."""
+
+    def __init__(self, agent_path, **config):
+        # config of zk-flock has its own "path", the one of the log
+        self.log = logging.getLogger(config.get("logger_name", "combaine"))
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(agent_path)
+        self.rfile = self.sock.makefile("rb")
+        self.cv = threading.Condition()
+        self.replies = {}
+        self.watchers = {}
+        self.next_id = 0
+        self.closed = False
+        # requests to the agent, it has its own session
+        self.round_trips = 0
+
+        self.id = config["app_id"]
+        self.lock = config["name"]
+        self.lockpath = "/{}/{}".format(self.id, self.lock)
+        self.locked = False
+        self.slot = None
+        self.czxid = None
+        self.session_timeout = config.get("timeout", 0)
+
+        reader = threading.Thread(target=self._read_loop)
+        reader.daemon = True
+        reader.start()
+        try:
+            self._call("open", self.id, self.lock)
+        except AgentError:
+            # e.g. the agent has no session, zk-flock falls back to its own
+            self.sock.close()
+            raise
+        self.log.debug("Connected to the agent %s", agent_path)
+
+    def _read_loop(self):
+        try:
+            for line in iter(self.rfile.readline, b""):
+                msg = json.loads(line.decode("utf-8"))
+                if "event" in msg:
+                    watcher = self.watchers.get(msg["event"])
+                    if watcher is not None:
+                        watcher()
+                    continue
+                with self.cv:
+                    self.replies[msg["id"]] = msg
+                    self.cv.notify_all()
+        except (IOError, ValueError, socket.error) as err:
+            self.log.debug("Agent connection error: %s", err)
+
+        self.log.error("Connection to the agent has been lost")
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+        # let the watchers find out that the lock is lost
+        for watcher in list(self.watchers.values()):
+            watcher()
+
+    def _call(self, op, *args, **kwargs):
+        self.round_trips += 1
+        with self.cv:
+            self.next_id += 1
+            request_id = self.next_id
+            if "watcher" in kwargs:
+                self.watchers[request_id] = kwargs["watcher"]
+            request = {"id": request_id, "op": op, "args": list(args)}
+            try:
+                self.sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+            except socket.error as err:
+                raise AgentError("Unable to send request: %s" % err)
+            while request_id not in self.replies:
+                if self.closed:
+                    raise AgentError("Connection to the agent has been lost")
+                self.cv.wait()
+            reply = self.replies.pop(request_id)
+
+        if "error" in reply:
+            raise AgentError(reply["error"])
+        state = reply["state"]
+        self.lockpath = state["lockpath"]
+        self.locked = state["locked"]
+        self.slot = state["slot"]
+        self.czxid = state["czxid"]
+        self.session_timeout = state["session_timeout"]
+        return reply["result"]
+
+    def _safe_call(self, default, op, *args, **kwargs):
+        try:
+            return self._call(op, *args, **kwargs)
+        except AgentError as err:
+            self.log.error("Agent request %s failed: %s", op, err)
+        return default
+
+    def getlock(self):
+        return self._safe_call(False, "getlock")
+
+    def getlock_wait(self, timeout):
+        return self._safe_call(False, "getlock_wait", timeout)
+
+    def getlock_queued(self, timeout=0):
+        return self._safe_call(False, "getlock_queued", timeout)
+
+    def getlock_shared(self, timeout=0):
+        return self._safe_call(False, "getlock_shared", timeout)
+
+    def getlock_exclusive(self, timeout=0):
+        return self._safe_call(False, "getlock_exclusive", timeout)
+
+    def getlock_elected(self, score, window, timeout=0):
+        return self._safe_call(False, "getlock_elected", score, window, timeout)
+
+    def getlock_affinity(self, window, timeout=0):
+        return self._safe_call(False, "getlock_affinity", window, timeout)
+
+    def getlock_priority(self, priority, timeout=0):
+        return self._safe_call(False, "getlock_priority", priority, timeout)
+
+    def getlock_semaphore(self, permits, timeout=0):
+        return self._safe_call(None, "getlock_semaphore", permits, timeout)
+
+    def take_token(self, rate, burst=1, timeout=0):
+        return self._safe_call(False, "take_token", rate, burst, timeout)
+
+    def set_lock_name(self, name):
+        self._safe_call(None, "set_lock_name", name)
+
+    def releaselock(self):
+        return self._safe_call(False, "releaselock")
+
+    def check_lock(self):
+        return self._safe_call(False, "check_lock")
+
+    def lock_state(self):
+        # the agent releases our locks once the connection is lost
+        return self._safe_call(Zookeeper.LOCK_LOST, "lock_state")
+
+    def lock_deadline(self):
+        return self._safe_call(time.time(), "lock_deadline")
+
+    def set_async_check_lock(self, callback):
+        assert callable(callback), "callback must be callable"
+        return self._safe_call(False, "set_async_check_lock", watcher=callback)
+
+    def set_node_deleting_watcher(self, path, callback):
+        assert callable(callback), "callback must be callable"
+        return self._safe_call(
+            False, "set_node_deleting_watcher", path, watcher=callback
+        )
+
+    def destroy(self):
+        # the agent releases our locks once the connection is closed
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+            self.log.info("Disconnected from the agent successfully")
+            return True
+        except socket.error as err:
+            self.log.error("Disconnection error %s", err)
+        return False
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of python-flock.
+#
+# python-flock is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-flock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""In-process lock API.
+
+All locks of the process share one Zookeeper session, which is
+established on the first acquisition:
+
+    import distributedflock
+
+    distributedflock.configure(host=["zk1:2181"], timeout=5, app_id="myapp")
+
+    with distributedflock.lock("name", wait=10):
+        ...
+
+    @distributedflock.lock("name")
+    def job():
+        ...
+
+    async with distributedflock.lock("name", wait=10):
+        ...
+
+Without configure() the config of zk-flock is used.
+"""
+
+import atexit
+import functools
+import threading
+import time
+
+from distributedflock import ZKeeperAPI, Zookeeper
+from distributedflock.ZKeeperAPI import constants as zk
+
+DEFAULT_CONFIG_PATH = "/etc/distributed-flock.json"
+# how often a failed release is retried, sec
+RELEASE_RETRY_INTERVAL = 0.2
+
+_config = None
+_client = None
+_client_lock = threading.Lock()
+
+
+class LockError(Exception):
+    pass
+
+
+def configure(**config):
+    """Set the config of the shared session (host, timeout, app_id,
+    auth, backend, logger_name). The current session is closed."""
+    global _config
+    close()
+    _config = dict(config)
+    _config.setdefault("logger_name", "zk-flock")
+
+
+def get_client():
+    """Returns the shared Zookeeper client, (re)connecting if needed"""
+    global _config, _client
+    with _client_lock:
+        if _client is not None and _client.state != zk.EXPIRED_SESSION_STATE:
+            return _client
+        if _config is None:
+            import json
+
+            with open(DEFAULT_CONFIG_PATH) as f:
+                _config = json.load(f)
+            _config.setdefault("logger_name", "zk-flock")
+        if _client is not None:
+            _client.disconnect()
+        _client = ZKeeperAPI.new_client(**_config)
+        return _client
+
+
+def close():
+    """Close the shared session, all locks are released"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.disconnect()
+            _client = None
+
+
+def reset_client(client):
+    """Close the shared session if it's still the given one,
+    the next lock gets a new one"""
+    global _client
+    with _client_lock:
+        if _client is not client:
+            return
+        _client = None
+    client.disconnect()
+
+
+# ephemeral nodes of a closed session disappear at once,
+# otherwise they would stay for the session timeout
+atexit.register(close)
+
+
+class Lock(object):
+    """A Zookeeper lock which is used like threading.Lock.
+
+    Threads of the process wait for each other locally, so only one of
+    them at a time competes for the lock in Zookeeper.
+    wait=None makes a single attempt, otherwise the lock is awaited
+    for `wait` seconds; queue=True waits in a FIFO queue.
+    """
+
+    def __init__(self, name, wait=None, queue=False, app_id=None):
+        self.name = name
+        self.wait = wait
+        self.queue = queue
+        self.app_id = app_id
+        self.lockserver = None
+        self.cv = threading.Condition()
+        self.busy = False
+
+    def _acquire_local(self, timeout):
+        limit_time = time.time() + timeout
+        with self.cv:
+            while self.busy:
+                time_to_wait = limit_time - time.time()
+                if time_to_wait <= 0:
+                    return False
+                self.cv.wait(time_to_wait)
+            self.busy = True
+        return True
+
+    def _release_local(self):
+        with self.cv:
+            self.busy = False
+            self.cv.notify()
+
+    def acquire(self):
+        """Returns True if the lock has been acquired"""
+        limit_time = time.time() + (self.wait or 0)
+        if not self._acquire_local(self.wait or 0):
+            return False
+        try:
+            client = get_client()
+            lockserver = Zookeeper.ZKLockServer(
+                zkclient=client,
+                app_id=self.app_id or _config["app_id"],
+                name=self.name,
+                logger_name=_config["logger_name"],
+            )
+            timeout = max(0, limit_time - time.time())
+            if self.queue:
+                acquired = lockserver.getlock_queued(timeout)
+            elif self.wait is not None:
+                acquired = lockserver.getlock_wait(timeout)
+            else:
+                acquired = lockserver.getlock()
+        except Exception:
+            self._release_local()
+            raise
+        if not acquired:
+            self._release_local()
+            return False
+        self.lockserver = lockserver
+        return True
+
+    def release(self):
+        lockserver, self.lockserver = self.lockserver, None
+        if lockserver is None:
+            raise LockError("lock %s is not acquired" % self.name)
+        try:
+            if not self._release_node(lockserver):
+                # otherwise the node would stay for the life of the shared
+                # session, so the session goes away and the node with it
+                reset_client(lockserver.zkclient)
+                raise LockError(
+                    "unable to release lock %s, the session has been closed" % self.name
+                )
+        finally:
+            self._release_local()
+
+    @staticmethod
+    def _release_node(lockserver):
+        """The delete is retried for the session timeout, Zookeeper
+        may come back meanwhile. Returns False if the node is still there."""
+        limit_time = time.time() + lockserver.session_timeout
+        while not lockserver.destroy():
+            if time.time() >= limit_time:
+                return False
+            time.sleep(RELEASE_RETRY_INTERVAL)
+        return True
+
+    def check(self):
+        """Whether the lock is still ours"""
+        lockserver = self.lockserver
+        return lockserver is not None and lockserver.check_lock()
+
+    @property
+    def czxid(self):
+        """Fencing token of the held lock"""
+        return self.lockserver.czxid if self.lockserver is not None else None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockError("unable to acquire lock %s" % self.name)
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+        return False
+
+    # asyncio: the lock is taken in the default executor, so the event
+    # loop isn't blocked. These are plain functions returning futures,
+    # which keeps the module importable by python 2.
+
+    def __aenter__(self):
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        acquiring = loop.run_in_executor(None, self.__enter__)
+
+        def release_acquired(future):
+            # not in the executor: it's shut down if the loop is closing
+            if not future.cancelled() and future.exception() is None:
+                threading.Thread(target=self.release).start()
+
+        def on_done(waiter):
+            # the executor call can't be cancelled along with the awaiting
+            # task, so a lock acquired after that has nobody to release it
+            if waiter.cancelled():
+                acquiring.add_done_callback(release_acquired)
+
+        waiter = asyncio.shield(acquiring)
+        waiter.add_done_callback(on_done)
+        return waiter
+
+    def __aexit__(self, *args):
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(None, self.__exit__, *args)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+def lock(name, wait=None, queue=False, app_id=None):
+    """Returns a Lock to be used as a context manager
+    (with or async with) or a decorator"""
+    return Lock(name, wait, queue, app_id)
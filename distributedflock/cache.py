@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of python-flock.
+#
+# python-flock is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-flock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Per user cache files in marshal format.
+
+The cache directory lives in /tmp unless XDG_RUNTIME_DIR is set, so
+another user may have created it in advance. It's used only while it's
+ours and closed to others, then nobody else can forge a cache file or
+plant a symlink which we would write through.
+"""
+
+import errno
+import marshal
+import os
+import stat
+
+
+def user_dir():
+    base = os.environ.get("XDG_RUNTIME_DIR") or "/tmp"
+    return os.path.join(base, "zk-flock-%d" % os.getuid())
+
+
+def is_private(path):
+    """Returns True if path is a directory (not a symlink) owned by us
+    and closed to others"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def load(path):
+    """Returns the content of the cache file or None if it's missing,
+    broken or may have been forged"""
+    if not is_private(os.path.dirname(path)):
+        return None
+    try:
+        with open(path, "rb") as f:
+            return marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def dump(path, data):
+    """Atomically replaces the cache file. Raises OSError if the
+    directory can't be created or isn't private."""
+    import tempfile
+
+    directory = os.path.dirname(path)
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    if not is_private(directory):
+        raise OSError(errno.EPERM, "%s isn't a private directory" % directory)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump(data, f)
+        os.rename(tmp, path)
+    finally:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
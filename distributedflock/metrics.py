@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of python-flock.
+#
+# python-flock is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-flock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Counters and histograms of zk-flock.
+
+Metrics are disabled by default: `registry` is a NullRegistry, whose
+methods do nothing. configure() enables them with the "metrics" section
+of the config:
+
+    "metrics": {
+        "textfile": "/var/lib/node_exporter/zk-flock.prom",
+        "statsd": "127.0.0.1:8125",
+        "prefix": "zk_flock"
+    }
+
+Every zk-flock process adds its values to the textfile on exit, so the
+file accumulates counters across runs. Statsd gets every event as it
+happens.
+"""
+
+import fcntl
+import logging
+import os
+import socket
+import threading
+import time
+
+DEFAULT_PREFIX = "zk_flock"
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 600, 3600)
+
+log = logging.getLogger("zk-flock")
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class NullRegistry(object):
+    enabled = False
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return NULL_TIMER
+
+    def flush(self):
+        pass
+
+    def flush_every(self, interval):
+        pass
+
+
+class Timer(object):
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.registry.observe(self.name, time.time() - self.start, **self.labels)
+        return False
+
+
+class StatsdClient(object):
+    def __init__(self, address, prefix):
+        host, _, port = address.rpartition(":")
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, kind, labels):
+        metric = ".".join(
+            [self.prefix, name] + [str(labels[k]) for k in sorted(labels)]
+        )
+        try:
+            self.sock.sendto(("%s:%s|%s" % (metric, value, kind)).encode("utf-8"), self.address)
+        except socket.error as err:
+            log.debug("Unable to send %s to statsd: %s", metric, err)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, labels[k]) for k in sorted(labels))
+
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Registry(object):
+    enabled = True
+
+    def __init__(self, textfile=None, statsd=None, prefix=DEFAULT_PREFIX):
+        self.lock = threading.Lock()
+        self.prefix = prefix
+        self.textfile = textfile
+        self.statsd = StatsdClient(statsd, prefix) if statsd else None
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        if self.statsd is not None:
+            self.statsd.send(name, value, "c", labels)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            # counts of every bucket, sum and count
+            hist = self.histograms.setdefault(key, [0] * len(DEFAULT_BUCKETS) + [0, 0])
+            for i, bound in enumerate(DEFAULT_BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+        if self.statsd is not None:
+            self.statsd.send(name, int(value * 1e3), "ms", labels)
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def series(self):
+        """Returns {metric name: type} and {series: value} collected
+        since the previous call"""
+        types, series = {}, {}
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            histograms, self.histograms = self.histograms, {}
+        for (name, labels), value in counters.items():
+            name = "%s_%s" % (self.prefix, name)
+            types[name] = "counter"
+            series[name + format_labels(dict(labels))] = value
+        for (name, labels), hist in histograms.items():
+            name = "%s_%s" % (self.prefix, name)
+            types[name] = "histogram"
+            labels = dict(labels)
+            for bound, count in zip(DEFAULT_BUCKETS, hist):
+                series[name + "_bucket" + format_labels(dict(labels, le=bound))] = count
+            series[name + "_bucket" + format_labels(dict(labels, le="+Inf"))] = hist[-1]
+            series[name + "_sum" + format_labels(labels)] = hist[-2]
+            series[name + "_count" + format_labels(labels)] = hist[-1]
+        return types, series
+
+    def flush(self):
+        if self.textfile is None:
+            return
+        try:
+            self._write_textfile()
+        except (IOError, OSError) as err:
+            log.error("Unable to write metrics to %s: %s", self.textfile, err)
+
+    def _write_textfile(self):
+        types, series = self.series()
+        # every series is either a counter or a part of a histogram,
+        # so values of the previous runs are just added up
+        with open(self.textfile + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.textfile):
+                with open(self.textfile) as f:
+                    for line in f:
+                        if line.startswith("# TYPE "):
+                            _, _, name, kind = line.split()
+                            types.setdefault(name, kind)
+                        elif line.strip() and not line.startswith("#"):
+                            key, value = line.rsplit(" ", 1)
+                            series[key] = series.get(key, 0) + float(value)
+
+            tmp = "%s.%d" % (self.textfile, os.getpid())
+            with open(tmp, "w") as f:
+                for name in sorted(types):
+                    f.write("# TYPE %s %s\n" % (name, types[name]))
+                    for key in sorted(series):
+                        if key.split("{")[0] in (name, name + "_bucket", name + "_sum", name + "_count"):
+                            f.write("%s %s\n" % (key, format_value(series[key])))
+            os.rename(tmp, self.textfile)
+
+    def flush_every(self, interval):
+        """Flush from a background thread, for long running processes"""
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.flush()
+
+        t = threading.Thread(target=loop)
+        t.daemon = True
+        t.start()
+
+
+registry = NullRegistry()
+
+
+def configure(config):
+    """Enable metrics if the config has any exporter"""
+    global registry
+    if not config or not (config.get("textfile") or config.get("statsd")):
+        registry = NullRegistry()
+    else:
+        registry = Registry(
+            config.get("textfile"),
+            config.get("statsd"),
+            config.get("prefix", DEFAULT_PREFIX),
+        )
+    return registry
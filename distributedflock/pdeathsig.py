@@ -24,9 +24,14 @@ import sys
 # https://docs.python.org/2/library/sys.html#sys.platform
 if sys.platform.startswith("linux"):
     import ctypes
-    from ctypes.util import find_library
 
-    libc = ctypes.CDLL(find_library("c"))
+    # libc is already loaded into the process, and find_library
+    # runs ldconfig, which takes tens of milliseconds on every start
+    libc = ctypes.CDLL(None)
+    if not hasattr(libc, "prctl"):
+        from ctypes.util import find_library
+
+        libc = ctypes.CDLL(find_library("c"))
 
     PR_SET_PDEATHSIG = 1  # <sys/prctl.h>
 
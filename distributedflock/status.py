@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of python-flock.
+#
+# python-flock is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-flock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Locks held under an app_id (zk-flock status).
+
+The namespace is read in a fixed number of steps whatever the number
+of locks: the listing of /app_id, the nodes in it, the children of the
+queues and the holders in them. Every step is a single pipelined batch,
+see get_many and list_many of the backends.
+"""
+
+import time
+
+from distributedflock.Zookeeper import (
+    BUCKET_SUFFIX,
+    ELECTION_SUFFIX,
+    HOLDER_SUFFIX,
+    MEMBERS_SUFFIX,
+    PRIORITY_SUFFIX,
+    QUEUE_SUFFIX,
+    RWLOCK_SUFFIX,
+    SEMAPHORE_NODE_PREFIX,
+    SEMAPHORE_SUFFIX,
+    WRITE_NODE_PREFIX,
+    sequence_number,
+)
+
+# suffix of the node -> mode, the longest suffixes go first
+MODES = (
+    (BUCKET_SUFFIX + QUEUE_SUFFIX, "rate"),
+    (QUEUE_SUFFIX, "queue"),
+    (SEMAPHORE_SUFFIX, "semaphore"),
+    (RWLOCK_SUFFIX, "rwlock"),
+    (ELECTION_SUFFIX, "election"),
+    (HOLDER_SUFFIX, "affinity"),
+    (MEMBERS_SUFFIX, "partitions"),
+    (PRIORITY_SUFFIX, "priority"),
+    (BUCKET_SUFFIX, None),
+)
+
+# modes whose children all hold the lock, nobody waits in them
+SHARED_MODES = ("semaphore", "partitions")
+
+# lock content is the hostname followed by 32 hex digits
+CONTENT_SUFFIX_LENGTH = 32
+
+
+def split_name(name):
+    """Returns (lock name, mode), mode is "unique" for plain nodes"""
+    for suffix, mode in MODES:
+        if name.endswith(suffix):
+            return name[: -len(suffix)], mode
+    return name, "unique"
+
+
+def holder_host(content):
+    if content and len(content) > CONTENT_SUFFIX_LENGTH:
+        return content[:-CONTENT_SUFFIX_LENGTH]
+    return content
+
+
+def holding(mode, children):
+    """Children holding the lock, sorted by sequence number"""
+    if mode in SHARED_MODES:
+        return sorted(children)
+    if mode in ("election", "rate", "priority"):
+        return []
+    children = sorted(children, key=sequence_number)
+    if mode == "queue" or not children:
+        return children[:1]
+    # readers before the first writer hold the rwlock together
+    if children[0].startswith(WRITE_NODE_PREFIX):
+        return children[:1]
+    holders = []
+    for child in children:
+        if child.startswith(WRITE_NODE_PREFIX):
+            break
+        holders.append(child)
+    return holders
+
+
+def plain_names(lockname, mode, held):
+    """Names of the plain lock nodes which the holders of a queue
+    take as well, they aren't listed as locks of their own"""
+    if mode == "semaphore":
+        return ["%s_%s" % (lockname, child[len(SEMAPHORE_NODE_PREFIX):]) for child in held]
+    if mode == "queue" or held and held[0].startswith(WRITE_NODE_PREFIX):
+        return [lockname]
+    return []
+
+
+def row(name, mode, value=None, stat=None, waiters=None, now=None):
+    now = time.time() if now is None else now
+    return {
+        "name": name,
+        "mode": mode,
+        "host": holder_host(value) if stat and stat["ephemeralOwner"] else value,
+        "age": now - stat["ctime"] / 1e3 if stat else None,
+        "session": "0x%x" % stat["ephemeralOwner"] if stat and stat["ephemeralOwner"] else None,
+        "waiters": waiters,
+    }
+
+
+def collect(zkclient, app_id):
+    """Returns a row for every holder of a lock under app_id,
+    and for waiters that aren't attributed to any holder"""
+    root = "/%s" % app_id
+    names = sorted(zkclient.list(root))
+    nodes = zkclient.get_many(["%s/%s" % (root, name) for name in names])
+
+    rows = []
+    dirs = []
+    for name, (value, rc, stat) in zip(names, nodes):
+        if rc != 0:
+            # it has gone since the listing
+            continue
+        lockname, mode = split_name(name)
+        if mode == "unique":
+            # a plain node is a lock while it's ephemeral
+            if stat["ephemeralOwner"]:
+                rows.append(row(lockname, mode, value, stat))
+        elif mode == "affinity":
+            rows.append(row(lockname, mode, value))
+        elif mode is not None and stat["numChildren"]:
+            dirs.append((name, lockname, mode))
+
+    listings = zkclient.list_many(["%s/%s" % (root, name) for name, _, _ in dirs])
+    holders = []
+    # plain nodes which are held along with a queue, see plain_names
+    covered = set()
+    for (name, lockname, mode), (children, rc) in zip(dirs, listings):
+        if rc != 0 or not children:
+            continue
+        held = holding(mode, children)
+        waiters = None if mode in SHARED_MODES else len(children) - len(held)
+        if not held:
+            rows.append(row(lockname, mode, waiters=waiters))
+        for child in held:
+            holders.append(("%s/%s/%s" % (root, name, child), lockname, mode, waiters))
+        covered.update(plain_names(lockname, mode, held))
+
+    now = time.time()
+    contents = zkclient.get_many([path for path, _, _, _ in holders])
+    for (path, lockname, mode, waiters), (value, rc, stat) in zip(holders, contents):
+        if rc == 0:
+            rows.append(row(lockname, mode, value, stat, waiters, now))
+    rows = [r for r in rows if r["mode"] != "unique" or r["name"] not in covered]
+    rows.sort(key=lambda r: (r["name"], r["mode"]))
+    return rows
+
+
+def format_rows(rows):
+    lines = ["%-32s %-9s %-24s %9s %18s %7s" % ("NAME", "MODE", "HOST", "AGE", "SESSION", "WAITERS")]
+    for r in rows:
+        lines.append(
+            "%-32s %-9s %-24s %9s %18s %7s"
+            % (
+                r["name"],
+                r["mode"],
+                r["host"] or "-",
+                "%.1f" % r["age"] if r["age"] is not None else "-",
+                r["session"] or "-",
+                r["waiters"] if r["waiters"] is not None else "-",
+            )
+        )
+    return "\n".join(lines)
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of python-flock.
+#
+# python-flock is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-flock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import threading
+import time
+
+from distributedflock import metrics
+from distributedflock.Zookeeper import LOCK_HELD, LOCK_LOST
+
+# time between SIGTERM and SIGKILL
+KILL_TIMEOUT = 1
+# a child which has run this long isn't crash looping,
+# so its failures and backoff are reset, sec
+RESPAWN_RESET_TIME = 60
+# the backoff is doubled on every failure up to this, sec
+RESPAWN_MAX_BACKOFF = 60
+# how often the rest of the process group is checked once the child
+# has exited, there is no notification of exits of grandchildren
+GROUP_POLL_INTERVAL = 0.05
+# how often the lock is checked while Zookeeper is unreachable, sec
+RECHECK_INTERVAL = 1
+
+
+def child_leads_group():
+    """Children get their own process groups, so their whole trees are
+    killed. A child started from a terminal stays in the foreground
+    group though, otherwise it's stopped by SIGTTIN/SIGTTOU once it
+    touches the terminal."""
+    return not os.isatty(0)
+
+
+class Job(object):
+    """A child process run under a lock"""
+
+    def __init__(self, supervisor, lockserver, minlocktime=0, start=None, respawn=0, backoff=1):
+        self.supervisor = supervisor
+        self.lockserver = lockserver
+        self.minlocktime = minlocktime
+        # returns the started child or None, see Supervisor.add
+        self.start = start
+        # a failed child is started again under the same lock
+        # up to `respawn` times in a row, see Supervisor._respawn
+        self.respawn = respawn
+        self.backoff = backoff
+        self.failures = 0
+        self.respawn_time = None
+        self.process = None
+        # minlocktime is counted from the first start,
+        # crash loops from the start of the current child
+        self.start_time = None
+        self.spawn_time = None
+        self.returncode = None
+        self.lock_event = False
+        self.release_time = None
+        # deadline of the lock while Zookeeper is unreachable
+        self.lost_time = None
+
+    def on_lock_event(self):
+        # It's called from Zookeeper threads
+        self.lock_event = True
+        self.supervisor.wakeup()
+
+    def deadline(self):
+        deadlines = [
+            t for t in (self.release_time, self.lost_time, self.respawn_time) if t is not None
+        ]
+        if self.lost_time is not None:
+            deadlines.append(time.time() + RECHECK_INTERVAL)
+        return min(deadlines) if deadlines else None
+
+
+class Supervisor(object):
+    """Watches children and their locks from a single select() loop.
+
+    Signals are delivered through a self-pipe (signal.set_wakeup_fd) and
+    Zookeeper watchers write to the same pipe, so the loop sleeps until
+    something actually happens.
+
+    A lost connection doesn't kill a child: the session survives it
+    for the session timeout, so the lock is rechecked until it's either
+    confirmed or the session timeout passes.
+
+    Every child has its own lock (see Job), so many of them can be
+    supervised at once; a lost lock kills only the child it guards.
+    """
+
+    def __init__(
+        self, lockserver=None, minlocktime=0, logger_name="zk-flock", respawn=0, backoff=1
+    ):
+        self.log = logging.getLogger(logger_name)
+        self.signals = []
+        self.stopping = False
+        self.job = None
+        if lockserver is not None:
+            self.job = Job(self, lockserver, minlocktime, respawn=respawn, backoff=backoff)
+        # jobs which are being started in other threads, see add
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.added = []
+        # functions to be called by supervise, see call
+        self.calls = []
+
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self.wfd)
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        signal.signal(signal.SIGCHLD, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def _handle_signals(self):
+        # children in their own process groups don't get Ctrl-C,
+        # zk-flock stops them as SIGTERM does
+        while self.signals:
+            if self.signals.pop(0) in (signal.SIGTERM, signal.SIGINT):
+                self.stopping = True
+
+    def on_lock_event(self):
+        self.job.on_lock_event()
+
+    def wakeup(self):
+        try:
+            os.write(self.wfd, b"\0")
+        except OSError as err:
+            # the pipe is full, so the loop is going to wake up anyway
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def _wait(self, timeout):
+        try:
+            select.select([self.rfd], [], [], timeout)
+        except (select.error, OSError) as err:
+            if err.args[0] != errno.EINTR:
+                raise
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def standby(self, process, ready):
+        """Wait until ready() returns True, the child has been started
+        in advance. Returns False if the child exits or SIGTERM comes
+        first, the child is killed then."""
+        while not ready():
+            self._wait(None)
+            self._handle_signals()
+            if self.stopping or process.poll() is not None:
+                reason = "SIGTERM" if self.stopping else "SIGCHLD"
+                self.log.info("Stop standby child by %s (PID: %d)", reason, process.pid)
+                self.kill_child(process)
+                return False
+        return True
+
+    def run(self, process):
+        """Supervise the child until it exits, SIGTERM comes
+        or the lock is lost. Returns the exit code."""
+        self.job.process = process
+        self.job.start_time = self.job.spawn_time = time.time()
+        self.supervise([self.job])
+        return self.job.returncode
+
+    def expect(self):
+        """Announce a job which is going to be passed to add"""
+        with self.lock:
+            self.pending += 1
+
+    def add(self, job):
+        """Pass a job announced by expect to supervise. It can be called
+        from any thread once the lock has been acquired, or with
+        job.returncode set if it hasn't. The child is started by
+        job.start in the thread of supervise: the parent death signal
+        is sent as soon as the thread that has forked the child exits."""
+        with self.lock:
+            self.pending -= 1
+            self.added.append(job)
+        self.wakeup()
+
+    def call(self, func):
+        """Call func in the thread of supervise, so Zookeeper threads
+        don't signal children which may have been reaped already"""
+        with self.lock:
+            self.calls.append(func)
+        self.wakeup()
+
+    def supervise(self, jobs=()):
+        """Supervise jobs until all of them are done, including those
+        announced by expect. Returns the done jobs."""
+        running, done = list(jobs), []
+        while True:
+            with self.lock:
+                added, self.added = self.added, []
+                calls, self.calls = self.calls, []
+                pending = self.pending
+            for func in calls:
+                func()
+            for job in added:
+                if job.returncode is None and job.process is None:
+                    job.process = job.start()
+                    job.start_time = job.spawn_time = time.time()
+                    if job.process is None:
+                        job.lockserver.destroy()
+                        job.returncode = 1
+                (running if job.returncode is None else done).append(job)
+            # jobs that are still waiting for their locks
+            # are abandoned on SIGTERM
+            if not running and (not pending or self.stopping):
+                break
+
+            deadlines = [t for t in (job.deadline() for job in running) if t is not None]
+            timeout = None
+            if deadlines:
+                timeout = max(0, min(deadlines) - time.time())
+            self._wait(timeout)
+            self._handle_signals()
+
+            for job in list(running):
+                if self._check(job):
+                    running.remove(job)
+                    done.append(job)
+        return done
+
+    def _check(self, job):
+        """Returns True once the job is done"""
+        if job.lock_event or job.lost_time is not None:
+            job.lock_event = False
+            state = job.lockserver.lock_state()
+            if state == LOCK_HELD:
+                if job.lost_time is not None:
+                    self.log.info("Lock has been confirmed after reconnection")
+                    job.lost_time = None
+            elif state != LOCK_LOST and job.lost_time is None:
+                job.lost_time = job.lockserver.lock_deadline()
+                self.log.warning(
+                    "Connection to Zookeeper has been lost, keep the lock for %.1f sec",
+                    max(0, job.lost_time - time.time()),
+                )
+            if state == LOCK_LOST or (job.lost_time is not None and time.time() >= job.lost_time):
+                self.log.warning("Lock %s lost", job.lockserver.lock)
+                metrics.registry.inc("lock_lost_total")
+                self.kill_child(job.process)
+                job.lockserver.destroy()
+                job.returncode = 1
+                return True
+
+        reason = None
+        if self.stopping:
+            reason = "SIGTERM"
+        elif job.process.poll() is not None and not self._respawn(job):
+            reason = "SIGCHLD"
+
+        if reason is not None and job.release_time is None:
+            self.log.info("Stop work by %s (PID: %d)", reason, job.process.pid)
+            job.respawn_time = None
+            # only the rest of minlocktime is left to wait
+            job.release_time = max(time.time(), job.start_time + job.minlocktime)
+
+        if job.release_time is None or time.time() < job.release_time:
+            return False
+
+        # the lock is released once nothing of the child is left
+        returncode = self.kill_child(job.process)
+        job.lockserver.destroy()
+        if returncode is not None:
+            # Means that child has ended work and return some code
+            job.returncode = returncode
+        else:
+            # Means we kill our child manually
+            job.returncode = 1
+        return True
+
+    def _respawn(self, job):
+        """Start the exited child of the job again if it has failed and
+        there are restarts left. Returns True while it's being restarted,
+        the lock is kept meanwhile."""
+        if job.respawn_time is None:
+            if job.release_time is not None or job.process.returncode == 0:
+                return False
+            if time.time() - job.spawn_time >= RESPAWN_RESET_TIME:
+                job.failures = 0
+            if job.failures >= job.respawn:
+                if job.respawn:
+                    self.log.error("Child has failed %d times in a row, give up", job.failures + 1)
+                return False
+            job.failures += 1
+            backoff = min(RESPAWN_MAX_BACKOFF, job.backoff * 2 ** (job.failures - 1))
+            self.log.warning(
+                "Child exited with code %d (PID: %d), restart it in %.1f sec",
+                job.process.returncode, job.process.pid, backoff,
+            )
+            # whatever it has left in its group goes first
+            self.kill_child(job.process)
+            job.respawn_time = time.time() + backoff
+        if time.time() < job.respawn_time:
+            return True
+
+        job.respawn_time = None
+        process = job.start()
+        if process is None:
+            return False
+        metrics.registry.inc("respawns_total")
+        job.process = process
+        job.spawn_time = time.time()
+        return True
+
+    def wait_child(self, process, timeout):
+        limit_time = time.time() + timeout
+        while process.poll() is None:
+            time_to_wait = limit_time - time.time()
+            if time_to_wait <= 0:
+                break
+            self._wait(time_to_wait)
+        return process.returncode
+
+    def _signal_group(self, pgid, signum):
+        """Returns False if no process of the group is left"""
+        try:
+            os.killpg(pgid, signum)
+        except OSError as err:
+            if err.errno == errno.ESRCH:
+                return False
+            self.log.error("Unable to send signal %d to group %d: %s", signum, pgid, err)
+        return True
+
+    def _wait_group(self, pgid, timeout):
+        limit_time = time.time() + timeout
+        while self._signal_group(pgid, 0):
+            time_to_wait = limit_time - time.time()
+            if time_to_wait <= 0:
+                return False
+            time.sleep(min(GROUP_POLL_INTERVAL, time_to_wait))
+        return True
+
+    def kill_group(self, prcs):
+        """Kill the process group of the child, which is led by it.
+        SIGKILL follows SIGTERM if anything is left after KILL_TIMEOUT.
+        The exit of the child itself is awaited through SIGCHLD, and only
+        then the rest of the group is polled."""
+        if not child_leads_group():
+            self._kill_alone(prcs)
+            return
+        pgid = prcs.pid
+        if not self._signal_group(pgid, signal.SIGTERM):
+            return
+        self.log.info("Send SIGTERM to process group %d", pgid)
+        limit_time = time.time() + KILL_TIMEOUT
+        if self.wait_child(prcs, KILL_TIMEOUT) is not None and self._wait_group(
+            pgid, limit_time - time.time()
+        ):
+            return
+        self.log.info("Send SIGKILL to process group %d", pgid)
+        self._signal_group(pgid, signal.SIGKILL)
+        prcs.wait()
+
+    def _kill_alone(self, prcs):
+        # the child shares the group with zk-flock, so only it is killed
+        if prcs.poll() is not None:
+            return
+        self.log.info("Send SIGTERM to child %d", prcs.pid)
+        prcs.terminate()
+        if self.wait_child(prcs, KILL_TIMEOUT) is None:
+            self.log.info("Send SIGKILL to child %d", prcs.pid)
+            prcs.kill()
+            prcs.wait()
+
+    def kill_child(self, prcs):
+        """Returns the exit code if the child has exited by itself,
+        None if it has been killed"""
+        if prcs.poll() is not None:
+            self.log.info(
+                "Child exited with code: %d (PID: %d)", prcs.returncode, prcs.pid
+            )
+            # whatever it has left in its group mustn't outlive the lock
+            self.kill_group(prcs)
+            return prcs.returncode
+
+        self.kill_group(prcs)
+        self.log.info("Killed child %d successfully", prcs.pid)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of python-flock.
+#
+# python-flock is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-flock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Wall-clock timestamps of zk-flock startup phases (--trace).
+
+Tracing is disabled by default: `tracer` is a NullTracer. Phases are
+marked where they end, so the duration of a phase is the time since
+the previous mark.
+"""
+
+import os
+import sys
+import time
+
+
+def process_start_time():
+    """Returns the time the process has been started at, so the
+    interpreter startup is counted too. None if it's unknown."""
+    try:
+        with open("/proc/self/stat") as f:
+            # the command name may contain spaces, the 22nd field is
+            # the start time in clock ticks since boot
+            starttime = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        now = time.time()
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return now - uptime + starttime / float(os.sysconf("SC_CLK_TCK"))
+
+
+class NullTracer(object):
+    enabled = False
+
+    def mark(self, phase, at=None):
+        pass
+
+    def annotate(self, **fields):
+        pass
+
+    def dump(self):
+        pass
+
+
+class Tracer(object):
+    enabled = True
+
+    def __init__(self, path, start=None):
+        self.path = path
+        self.start = start if start is not None else time.time()
+        self.phases = []
+        self.fields = {}
+
+    def mark(self, phase, at=None):
+        self.phases.append((phase, at if at is not None else time.time()))
+
+    def annotate(self, **fields):
+        """Add fields to the report"""
+        self.fields.update(fields)
+
+    def report(self):
+        phases = []
+        previous = self.start
+        for phase, at in self.phases:
+            phases.append(
+                {
+                    "phase": phase,
+                    "at_ms": round((at - self.start) * 1e3, 3),
+                    "duration_ms": round((at - previous) * 1e3, 3),
+                }
+            )
+            previous = at
+        report = {"pid": os.getpid(), "start": self.start, "phases": phases}
+        report.update(self.fields)
+        return report
+
+    def dump(self):
+        import json
+
+        data = json.dumps(self.report()) + "\n"
+        if self.path == "-":
+            sys.stderr.write(data)
+            sys.stderr.flush()
+            return
+        try:
+            with open(self.path, "a") as f:
+                f.write(data)
+        except (IOError, OSError) as err:
+            sys.stderr.write("Unable to write trace to %s: %s\n" % (self.path, err))
+
+
+tracer = NullTracer()
+
+
+def enable(path, start=None):
+    global tracer
+    if start is None:
+        start = process_start_time()
+    tracer = Tracer(path, start)
+    return tracer
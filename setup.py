@@ -47,7 +47,8 @@ setup(
     download_url=d,
     long_description=open('./README.md').read(),
     scripts=[
-        'zk-flock'
+        'zk-flock',
+        'zk-flock-agent'
     ],
     classifiers=['Development Status :: 4 - Beta',
                  'Intended Audience :: Developers',
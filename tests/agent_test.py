@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from functools import partial
+
+from distributedflock import ZKeeperAPI, Zookeeper, agent
+from tests.fakezk import FakeZookeeper
+
+ZK_FLOCK = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "zk-flock"
+)
+
+
+def refuse():
+    raise IOError("Zookeeper is unreachable")
+
+
+def wait_for(predicate, timeout=15):
+    limit_time = time.time() + timeout
+    while time.time() < limit_time:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+
+class AgentTest(unittest.TestCase):
+    def setUp(self):
+        self.zk = FakeZookeeper().start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "agent.sock")
+        self.cfg = {
+            "host": [self.zk.address],
+            "timeout": 5,
+            "app_id": "app",
+            "backend": "python",
+        }
+        self.agent = agent.LockAgent(self.path, partial(ZKeeperAPI.new_client, **self.cfg))
+        t = threading.Thread(target=self.agent.serve_forever, kwargs={"poll_interval": 0.05})
+        t.daemon = True
+        t.start()
+        self.clients = []
+
+    def tearDown(self):
+        for z in self.clients:
+            z.destroy()
+        self.agent.shutdown()
+        self.agent.server_close()
+        self.agent.zkclient.disconnect()
+        self.zk.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def client(self, name="lock"):
+        z = agent.AgentLockServer(self.path, app_id="app", name=name)
+        self.clients.append(z)
+        return z
+
+    def test_socket_mode(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), agent.DEFAULT_AGENT_MODE)
+
+    def test_disconnect_releases_lock(self):
+        holder, waiter = self.client(), self.client()
+        self.assertTrue(holder.getlock())
+        self.assertFalse(waiter.getlock())
+        holder.destroy()
+        self.assertTrue(wait_for(waiter.getlock))
+
+    def test_session_expiry(self):
+        holder = self.client()
+        self.assertTrue(holder.getlock())
+        expired = self.agent.zkclient
+        self.zk.expire_session(expired.session_id)
+        # the holder is told that its lock is lost
+        self.assertTrue(wait_for(lambda: holder.lock_state() == Zookeeper.LOCK_LOST))
+        # and the next ones get a new session
+        self.assertTrue(self.client().getlock())
+        self.assertIsNot(self.agent.zkclient, expired)
+
+    def test_no_session(self):
+        self.agent.connect = refuse
+        self.zk.expire_session(self.agent.zkclient.session_id)
+        self.assertTrue(wait_for(lambda: not agent.session_alive(self.agent.zkclient)))
+        self.assertRaises(agent.AgentError, self.client)
+
+    def test_fallback(self):
+        confpath = os.path.join(self.tmpdir, "distributed-flock.json")
+        outpath = os.path.join(self.tmpdir, "out")
+        logpath = os.path.join(self.tmpdir, "zk-flock.log")
+        with open(confpath, "w") as f:
+            json.dump(dict(self.cfg, agent=self.path, logger={"path": logpath, "level": "DEBUG"}), f)
+
+        def log():
+            with open(logpath) as f:
+                return f.read()
+
+        def run():
+            if os.path.exists(outpath):
+                os.unlink(outpath)
+            args = [sys.executable, ZK_FLOCK, "-c", confpath, "-l", "0", "lock", "touch %s" % outpath]
+            return subprocess.call(args) == 0 and os.path.exists(outpath)
+
+        # through the agent, then on its own session
+        self.assertTrue(run())
+        self.assertIn("Connected to the agent", log())
+        self.agent.connect = refuse
+        self.zk.expire_session(self.agent.zkclient.session_id)
+        self.assertTrue(wait_for(lambda: not agent.session_alive(self.agent.zkclient)))
+        self.assertTrue(run())
+        self.assertIn("session has expired", log())
+
+
+if __name__ == "__main__":
+    unittest.main()
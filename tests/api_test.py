@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+
+import sys
+import threading
+import time
+import unittest
+
+import distributedflock
+from tests.fakezk import FakeZookeeper
+
+
+class LockTest(unittest.TestCase):
+    def setUp(self):
+        self.zk = FakeZookeeper().start()
+        distributedflock.configure(
+            host=[self.zk.address], timeout=5, app_id="app", backend="python"
+        )
+
+    def tearDown(self):
+        distributedflock.close()
+        self.zk.stop()
+
+    def test_context_manager(self):
+        with distributedflock.lock("name") as l:
+            self.assertTrue(l.check())
+            self.assertEqual(l.czxid, self.zk.nodes["/app/name"].czxid)
+            self.assertRaises(distributedflock.LockError, distributedflock.lock("name").__enter__)
+        self.assertNotIn("/app/name", self.zk.nodes)
+        self.assertFalse(l.check())
+
+    def test_decorator(self):
+        running, overlapped = [], []
+
+        @distributedflock.lock("name", wait=5)
+        def job():
+            if running:
+                overlapped.append(True)
+            running.append(True)
+            time.sleep(0.05)
+            running.pop()
+
+        threads = [threading.Thread(target=job) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(overlapped, [])
+
+    def test_shared_session(self):
+        first = distributedflock.lock("first")
+        second = distributedflock.lock("second", queue=True, wait=1)
+        self.assertTrue(first.acquire())
+        self.assertTrue(second.acquire())
+        self.assertEqual(
+            first.lockserver.zkclient.session_id, second.lockserver.zkclient.session_id
+        )
+        first.release()
+        second.release()
+
+    def test_release_retried(self):
+        l = distributedflock.lock("name")
+        self.assertTrue(l.acquire())
+        # the delete fails until Zookeeper is back
+        self.zk.accepting = False
+        self.zk.drop_connections()
+        threading.Timer(0.5, setattr, (self.zk, "accepting", True)).start()
+        l.release()
+        self.assertNotIn("/app/name", self.zk.nodes)
+        self.assertTrue(distributedflock.lock("name").acquire())
+
+    def test_release_failed(self):
+        distributedflock.configure(host=[self.zk.address], timeout=1, app_id="app", backend="python")
+        l = distributedflock.lock("name")
+        self.assertTrue(l.acquire())
+        self.zk.accepting = False
+        self.zk.drop_connections()
+        self.assertRaises(distributedflock.LockError, l.release)
+        # the session has been dropped and the node goes away with it
+        self.zk.accepting = True
+        self.assertTrue(distributedflock.lock("name", wait=5).acquire())
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio.run is required")
+    def test_async(self):
+        import asyncio
+
+        code = compile(
+            "async def hold(name):\n"
+            "    async with distributedflock.lock(name, wait=1) as l:\n"
+            "        return l.check()\n",
+            "<test>",
+            "exec",
+        )
+        scope = {"distributedflock": distributedflock}
+        exec(code, scope)
+        self.assertTrue(asyncio.run(scope["hold"]("name")))
+        self.assertNotIn("/app/name", self.zk.nodes)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio.run is required")
+    def test_async_cancelled(self):
+        import asyncio
+
+        code = compile(
+            "async def cancel(name, holder):\n"
+            "    task = asyncio.ensure_future(distributedflock.lock(name, wait=5).__aenter__())\n"
+            "    await asyncio.sleep(0.2)\n"
+            "    task.cancel()\n"
+            "    holder.release()\n"
+            "    try:\n"
+            "        await task\n"
+            "    except asyncio.CancelledError:\n"
+            "        pass\n",
+            "<test>",
+            "exec",
+        )
+        scope = {"asyncio": asyncio, "distributedflock": distributedflock}
+        exec(code, scope)
+        holder = distributedflock.lock("name")
+        self.assertTrue(holder.acquire())
+        asyncio.run(scope["cancel"]("name", holder))
+        # the lock taken after the cancellation is released
+        self.assertTrue(distributedflock.lock("name", wait=5).acquire())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of python-flock.
+#
+# python-flock is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-flock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Lock contention benchmark against the local Zookeeper stand-in.
+
+Every contender has its own session, like a separate zk-flock process.
+It reports percentiles of acquire latency, time to child exec and
+release-to-next-acquire handoff latency, and the number of Zookeeper
+requests per acquisition:
+
+    python -m tests.bench_contention -c 1,10,100 -m unique,wait,queue
+"""
+
+import json
+import optparse
+import subprocess
+import threading
+import time
+
+from distributedflock import Zookeeper
+from tests.fakezk import FakeZookeeper
+
+MODES = ("unique", "wait", "queue", "sequence")
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Contender(threading.Thread):
+    def __init__(self, cfg, mode, options, start_event):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.mode = mode
+        self.options = options
+        self.start_event = start_event
+        self.z = Zookeeper.ZKLockServer(**cfg)
+        self.result = None
+
+    def acquire(self):
+        if self.mode == "unique":
+            return self.z.getlock()
+        elif self.mode == "wait":
+            return self.z.getlock_wait(self.options.timeout)
+        elif self.mode == "queue":
+            return self.z.getlock_queued(self.options.timeout)
+        return self.z.getlock_semaphore(self.options.permits, self.options.timeout) is not None
+
+    def run(self):
+        self.start_event.wait()
+        started = time.time()
+        if not self.acquire():
+            self.result = (started, None, None, None)
+        else:
+            acquired = time.time()
+            child = subprocess.Popen(["true"])
+            executed = time.time()
+            time.sleep(self.options.hold)
+            released = time.time()
+            self.z.releaselock()
+            child.wait()
+            self.result = (started, acquired, executed, released)
+        self.z.destroy()
+
+
+def handoffs(results):
+    # every acquisition consumes the earliest release that happened before it
+    releases = sorted(r[3] for r in results if r[3] is not None)
+    latencies = []
+    for acquired in sorted(r[1] for r in results if r[1] is not None):
+        if releases and releases[0] <= acquired:
+            latencies.append(acquired - releases.pop(0))
+    return latencies
+
+
+def run(mode, contenders, options):
+    server = FakeZookeeper(latency=options.latency).start()
+    cfg = {
+        "host": [server.address],
+        "timeout": 30,
+        "app_id": "bench",
+        "name": "lock",
+        "backend": "python",
+    }
+    try:
+        start_event = threading.Event()
+        threads = [Contender(cfg, mode, options, start_event) for _ in range(contenders)]
+        for t in threads:
+            t.start()
+        requests = server.requests
+        start_event.set()
+        for t in threads:
+            t.join()
+        requests = server.requests - requests
+    finally:
+        server.stop()
+
+    results = [t.result for t in threads]
+    acquired = [r for r in results if r[1] is not None]
+    ms = lambda values, p: percentile(values, p) * 1e3
+    acquire = [r[1] - r[0] for r in acquired]
+    execs = [r[2] - r[0] for r in acquired]
+    handoff = handoffs(results)
+    return {
+        "mode": mode,
+        "contenders": contenders,
+        "acquired": len(acquired),
+        "acquire_p50_ms": ms(acquire, 50),
+        "acquire_p99_ms": ms(acquire, 99),
+        "exec_p50_ms": ms(execs, 50),
+        "exec_p99_ms": ms(execs, 99),
+        "handoff_p50_ms": ms(handoff, 50),
+        "handoff_p99_ms": ms(handoff, 99),
+        "requests_per_acquire": float(requests) / max(1, len(acquired)),
+    }
+
+
+# (name, label, format)
+COLUMNS = (
+    ("mode", "mode", "%-9s"),
+    ("contenders", "N", "%6d"),
+    ("acquired", "locked", "%6d"),
+    ("acquire_p50_ms", "acq p50", "%9.2f"),
+    ("acquire_p99_ms", "acq p99", "%9.2f"),
+    ("exec_p50_ms", "exec p50", "%9.2f"),
+    ("exec_p99_ms", "exec p99", "%9.2f"),
+    ("handoff_p50_ms", "hand p50", "%9.2f"),
+    ("handoff_p99_ms", "hand p99", "%9.2f"),
+    ("requests_per_acquire", "req/lock", "%9.1f"),
+)
+
+
+def header():
+    widths = [len(fmt % (0 if fmt[-1] != "s" else "")) for _, _, fmt in COLUMNS]
+    return " ".join(
+        label.ljust(width) if i == 0 else label.rjust(width)
+        for i, ((_, label, _), width) in enumerate(zip(COLUMNS, widths))
+    )
+
+
+def main():
+    parser = optparse.OptionParser("Usage: %prog [options]")
+    parser.add_option("-c", "--contenders", default="1,10,100,1000",
+                      help="comma separated numbers of contenders")
+    parser.add_option("-m", "--modes", default=",".join(MODES),
+                      help="comma separated modes: %s" % ", ".join(MODES))
+    parser.add_option("-l", "--latency", type=float, default=0.001,
+                      help="injected reply latency, sec (0.001)")
+    parser.add_option("-H", "--hold", type=float, default=0.001,
+                      help="lock hold time, sec (0.001)")
+    parser.add_option("-t", "--timeout", type=float, default=60,
+                      help="wait timeout of contenders, sec (60)")
+    parser.add_option("-n", "--permits", type=int, default=4,
+                      help="permits of the sequence mode (4)")
+    parser.add_option("-j", "--json", action="store_true", default=False,
+                      help="print results as JSON lines")
+    options, _ = parser.parse_args()
+
+    if not options.json:
+        print(header())
+    for mode in options.modes.split(","):
+        for contenders in map(int, options.contenders.split(",")):
+            result = run(mode, contenders, options)
+            if options.json:
+                print(json.dumps(result))
+            else:
+                print(" ".join(fmt % result[name] for name, _, fmt in COLUMNS))
+
+
+if __name__ == "__main__":
+    main()
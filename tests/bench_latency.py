@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of python-flock.
+#
+# python-flock is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-flock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Host selection benchmark against local Zookeeper stand-ins.
+
+Every stand-in delays its replies by the given latency, like servers
+in other datacenters. Every run connects, takes and releases a lock
+and disconnects, with hosts in random order and in the order of RTT:
+
+    python -m tests.bench_latency -l 0.02,0.01,0.0005 -n 50
+"""
+
+import json
+import optparse
+import os
+import shutil
+import tempfile
+import time
+
+from distributedflock import Zookeeper
+from tests.bench_contention import percentile
+from tests.fakezk import FakeZookeeper
+
+
+def run(hosts, options, rtt_ttl):
+    cfg = {
+        "host": hosts,
+        "timeout": 30,
+        "app_id": "bench",
+        "name": "lock",
+        "backend": "python",
+        "rtt_ttl": rtt_ttl,
+    }
+    durations = []
+    for _ in range(options.runs):
+        started = time.time()
+        z = Zookeeper.ZKLockServer(**cfg)
+        z.getlock()
+        z.releaselock()
+        z.destroy()
+        durations.append(time.time() - started)
+    return durations
+
+
+# (name, label, format)
+COLUMNS = (
+    ("order", "order", "%8s"),
+    ("runs", "runs", "%5d"),
+    ("p50", "p50,ms", "%8.1f"),
+    ("p90", "p90,ms", "%8.1f"),
+    ("max", "max,ms", "%8.1f"),
+)
+
+
+def main():
+    parser = optparse.OptionParser("Usage: %prog [options]")
+    parser.add_option("-l", "--latencies", default="0.02,0.01,0.0005",
+                      help="comma separated reply latencies of the hosts, sec")
+    parser.add_option("-n", "--runs", type=int, default=50,
+                      help="lock acquisitions in every order (50)")
+    parser.add_option("-j", "--json", action="store_true", default=False,
+                      help="print results as JSON lines")
+    options, _ = parser.parse_args()
+
+    servers = [FakeZookeeper(latency=float(l)).start() for l in options.latencies.split(",")]
+    hosts = [server.address for server in servers]
+    # the RTT cache of the benchmark starts empty
+    tmpdir = tempfile.mkdtemp()
+    os.environ["XDG_RUNTIME_DIR"] = tmpdir
+    try:
+        if not options.json:
+            print(" ".join(label.rjust(len(fmt % 0)) for _, label, fmt in COLUMNS))
+        for order, rtt_ttl in (("random", 0), ("rtt", 600)):
+            durations = sorted(d * 1e3 for d in run(hosts, options, rtt_ttl))
+            result = {
+                "order": order,
+                "runs": len(durations),
+                "p50": percentile(durations, 50),
+                "p90": percentile(durations, 90),
+                # the first run probes the hosts
+                "max": durations[-1],
+            }
+            if options.json:
+                print(json.dumps(result))
+            else:
+                print(" ".join(fmt % result[name] for name, _, fmt in COLUMNS))
+    finally:
+        for server in servers:
+            server.stop()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
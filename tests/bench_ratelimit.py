@@ -0,0 +1,151 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of python-flock.
+#
+# python-flock is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-flock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Start rate limiter benchmark against the local Zookeeper stand-in.
+
+Every contender has its own session and takes tokens in a loop for the
+given duration. It reports the rate of grants against the configured
+one and the number of Zookeeper writes and requests per grant. Every
+contender also pays a fixed cost: on start they all race to create
+the bucket and the queue, and at the end every waiter leaves the queue
+without a grant. So writes per grant are also counted in the middle
+of the run (steady), which excludes both:
+
+    python -m tests.bench_ratelimit -c 1,10,100 -r 20 -d 5
+"""
+
+import json
+import optparse
+import threading
+import time
+
+from distributedflock import Zookeeper
+from tests.fakezk import FakeZookeeper
+
+
+class Contender(threading.Thread):
+    def __init__(self, cfg, options, start_event, stop_time):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.options = options
+        self.start_event = start_event
+        self.stop_time = stop_time
+        self.z = Zookeeper.ZKLockServer(**cfg)
+        self.grants = []
+
+    def run(self):
+        self.start_event.wait()
+        while True:
+            timeout = self.stop_time[0] - time.time()
+            if timeout <= 0:
+                break
+            if self.z.take_token(self.options.rate, self.options.burst, timeout):
+                self.grants.append(time.time())
+        self.z.destroy()
+
+
+def run(contenders, options):
+    server = FakeZookeeper(latency=options.latency).start()
+    cfg = {
+        "host": [server.address],
+        "timeout": 30,
+        "app_id": "bench",
+        "name": "job",
+        "backend": "python",
+    }
+    try:
+        start_event = threading.Event()
+        stop_time = [None]
+        threads = [Contender(cfg, options, start_event, stop_time) for _ in range(contenders)]
+        for t in threads:
+            t.start()
+        requests, writes = server.requests, server.writes
+        started = time.time()
+        stop_time[0] = started + options.duration
+        start_event.set()
+        window = []
+        for at in (0.2, 0.8):
+            time.sleep(max(0, started + options.duration * at - time.time()))
+            window.append((server.writes, sum(len(t.grants) for t in threads)))
+        for t in threads:
+            t.join()
+        requests, writes = server.requests - requests, server.writes - writes
+    finally:
+        server.stop()
+
+    grants = sorted(g for t in threads for g in t.grants)
+    # the burst is granted at once, the rate is what follows it
+    sustained = grants[options.burst:]
+    rate = float("nan")
+    if len(sustained) > 1:
+        rate = (len(sustained) - 1) / (sustained[-1] - sustained[0])
+    return {
+        "contenders": contenders,
+        "rate": options.rate,
+        "grants": len(grants),
+        "sustained_rate": rate,
+        "writes_per_grant": float(writes) / max(1, len(grants)),
+        "steady_writes_per_grant": float(window[1][0] - window[0][0])
+        / max(1, window[1][1] - window[0][1]),
+        "requests_per_grant": float(requests) / max(1, len(grants)),
+    }
+
+
+# (name, label, format)
+COLUMNS = (
+    ("contenders", "N", "%6d"),
+    ("rate", "rate", "%8.1f"),
+    ("grants", "grants", "%7d"),
+    ("sustained_rate", "achieved", "%9.2f"),
+    ("writes_per_grant", "writes", "%7.2f"),
+    ("steady_writes_per_grant", "steady", "%7.2f"),
+    ("requests_per_grant", "requests", "%9.2f"),
+)
+
+
+def main():
+    parser = optparse.OptionParser("Usage: %prog [options]")
+    parser.add_option("-c", "--contenders", default="1,10,100",
+                      help="comma separated numbers of contenders")
+    parser.add_option("-r", "--rate", type=float, default=20,
+                      help="tokens per second (20)")
+    parser.add_option("-b", "--burst", type=int, default=1,
+                      help="bucket size (1)")
+    parser.add_option("-d", "--duration", type=float, default=5,
+                      help="duration of every run, sec (5)")
+    parser.add_option("-l", "--latency", type=float, default=0.001,
+                      help="injected reply latency, sec (0.001)")
+    parser.add_option("-j", "--json", action="store_true", default=False,
+                      help="print results as JSON lines")
+    options, _ = parser.parse_args()
+
+    if not options.json:
+        print(" ".join(label.rjust(len(fmt % 0)) for _, label, fmt in COLUMNS))
+    for contenders in map(int, options.contenders.split(",")):
+        result = run(contenders, options)
+        if options.json:
+            print(json.dumps(result))
+        else:
+            print(" ".join(fmt % result[name] for name, _, fmt in COLUMNS))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of python-flock.
+#
+# python-flock is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-flock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Startup benchmark: time from process start to child exec.
+
+Runs zk-flock against the local Zookeeper stand-in with --trace and
+reports the median duration of every startup phase:
+
+    python -m tests.bench_startup -n 50 --fast-start
+"""
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from tests.bench_contention import percentile
+from tests.fakezk import FakeZookeeper
+
+ZK_FLOCK = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "zk-flock"
+)
+
+
+def run(options):
+    server = FakeZookeeper(latency=options.latency).start()
+    tmpdir = tempfile.mkdtemp()
+    confpath = os.path.join(tmpdir, "distributed-flock.json")
+    tracepath = os.path.join(tmpdir, "trace")
+    with open(confpath, "w") as f:
+        json.dump(
+            {"host": [server.address], "timeout": 5, "app_id": "bench", "backend": "python"},
+            f,
+        )
+    args = [sys.executable, ZK_FLOCK, "-c", confpath, "-l", "0", "--trace", tracepath]
+    if options.fast_start:
+        args.append("-F")
+    try:
+        for i in range(options.runs):
+            subprocess.check_call(args + ["lock%d" % i, "true"])
+        with open(tracepath) as f:
+            return [json.loads(line) for line in f]
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = optparse.OptionParser("Usage: %prog [options]")
+    parser.add_option("-n", "--runs", type=int, default=20,
+                      help="number of zk-flock runs (20)")
+    parser.add_option("-l", "--latency", type=float, default=0.0,
+                      help="injected reply latency, sec (0)")
+    parser.add_option("-F", "--fast-start", action="store_true", default=False,
+                      help="run zk-flock with --fast-start")
+    options, _ = parser.parse_args()
+
+    traces = run(options)
+    durations = {}
+    for trace in traces:
+        for phase in trace["phases"]:
+            durations.setdefault(phase["phase"], []).append(phase["duration_ms"])
+    to_exec = [t["phases"][-1]["at_ms"] for t in traces]
+
+    print("%-12s %9s %9s" % ("phase", "p50 ms", "p99 ms"))
+    for phase in traces[0]["phases"]:
+        values = durations[phase["phase"]]
+        print("%-12s %9.2f %9.2f" % (phase["phase"], percentile(values, 50), percentile(values, 99)))
+    print("%-12s %9.2f %9.2f" % ("to exec", percentile(to_exec, 50), percentile(to_exec, 99)))
+
+
+if __name__ == "__main__":
+    main()
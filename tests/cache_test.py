@@ -0,0 +1,46 @@
+#! /usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from distributedflock import cache
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ["XDG_RUNTIME_DIR"] = self.tmpdir
+        self.path = os.path.join(cache.user_dir(), "test.marshal")
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def test_dump_load(self):
+        self.assertIsNone(cache.load(self.path))
+        cache.dump(self.path, {"a": 1})
+        self.assertEqual(cache.load(self.path), {"a": 1})
+        self.assertEqual(os.stat(cache.user_dir()).st_mode & 0o777, 0o700)
+        # no temporary files are left behind
+        self.assertEqual(os.listdir(cache.user_dir()), ["test.marshal"])
+
+    def test_open_dir(self):
+        cache.dump(self.path, {"a": 1})
+        os.chmod(cache.user_dir(), 0o777)
+        self.assertIsNone(cache.load(self.path))
+        self.assertRaises(OSError, cache.dump, self.path, {"a": 2})
+
+    def test_symlinked_dir(self):
+        target = os.path.join(self.tmpdir, "target")
+        os.mkdir(target, 0o700)
+        os.symlink(target, cache.user_dir())
+        self.assertRaises(OSError, cache.dump, self.path, {"a": 1})
+        self.assertEqual(os.listdir(target), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
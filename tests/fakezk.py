@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014+ Tyurin Anton <noxiouz@yandex.ru>
+#
+# This file is part of python-flock.
+#
+# python-flock is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-flock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Local stand-in for a Zookeeper server.
+
+It keeps the tree in memory and speaks enough of the wire protocol for
+zk-flock: sessions, ephemeral and sequential nodes, watches, multi and
+reconnection with an existing session. Latency can be injected into
+replies and sessions can be expired on demand:
+
+    server = FakeZookeeper(latency=0.005)
+    server.start()
+    cfg = {"host": [server.address], "timeout": 5, ...}
+    ...
+    server.expire_session(session_id)
+    server.stop()
+"""
+
+import os
+import socket
+import struct
+import threading
+import time
+
+try:
+    import queue
+    import socketserver
+except ImportError:  # python 2
+    import Queue as queue
+    import SocketServer as socketserver
+
+from distributedflock.ZKeeperAPI import constants as zk
+from distributedflock.ZKeeperAPI import protocol
+
+
+class Node(object):
+    def __init__(self, data, zxid, owner=0):
+        self.data = data or b""
+        self.czxid = self.mzxid = self.pzxid = zxid
+        self.ctime = self.mtime = int(time.time() * 1000)
+        self.version = 0
+        self.cversion = 0
+        self.owner = owner
+        self.children = set()
+
+    def stat(self):
+        return {
+            "czxid": self.czxid,
+            "mzxid": self.mzxid,
+            "ctime": self.ctime,
+            "mtime": self.mtime,
+            "version": self.version,
+            "cversion": self.cversion,
+            "aversion": 0,
+            "ephemeralOwner": self.owner,
+            "dataLength": len(self.data),
+            "numChildren": len(self.children),
+            "pzxid": self.pzxid,
+        }
+
+
+class Session(object):
+    def __init__(self, session_id, timeout):
+        self.id = session_id
+        self.passwd = os.urandom(16)
+        self.timeout = timeout
+        self.last_seen = time.time()
+        self.connection = None
+        self.data_watches = set()
+        self.child_watches = set()
+
+
+WRITE_OPCODES = (
+    protocol.CREATE,
+    protocol.CREATE2,
+    protocol.SETDATA,
+    protocol.DELETE,
+    protocol.MULTI,
+)
+
+
+def parent_of(path):
+    return path.rsplit("/", 1)[0] or "/"
+
+
+class Connection(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.zk = self.server.zk
+        self.session = None
+        self.replies = queue.Queue()
+        self.sender = threading.Thread(target=self._send_loop)
+        self.sender.daemon = True
+        self.sender.start()
+
+    def _send_loop(self):
+        while True:
+            send_at, data = self.replies.get()
+            if data is None:
+                return
+            delay = send_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.request.sendall(struct.pack(">i", len(data)) + data)
+            except socket.error:
+                return
+
+    def reply(self, data):
+        # replies are delayed, not the processing,
+        # so pipelined requests share the latency
+        self.replies.put((time.time() + self.zk.latency, data))
+
+    def event(self, event, path):
+        body = (
+            protocol.Writer()
+            .int(protocol.WATCH_XID)
+            .long(-1)
+            .int(zk.OK)
+            .int(event)
+            .int(protocol.STATE_SYNC_CONNECTED)
+            .string(path)
+        )
+        self.reply(body.getvalue())
+
+    def close(self):
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def _read_exactly(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self.request.recv(size)
+            if not chunk:
+                raise EOFError()
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def read_packet(self):
+        size = struct.unpack(">i", self._read_exactly(4))[0]
+        return protocol.Reader(self._read_exactly(size))
+
+    def srvr(self):
+        # four letter command, the reply isn't framed
+        time.sleep(self.zk.latency)
+        if self.zk.accepting:
+            reply = b"Zookeeper version: fake\nMode: standalone\n"
+        else:
+            reply = b"This ZooKeeper instance is not currently serving requests\n"
+        self.request.sendall(reply)
+
+    def handle(self):
+        try:
+            head = self._read_exactly(4)
+            if head == b"srvr":
+                self.srvr()
+                return
+            size = struct.unpack(">i", head)[0]
+            r = protocol.Reader(self._read_exactly(size))
+            if not self.zk.accepting:
+                return
+            while self.zk.silent:
+                self.read_packet()
+            r.int()
+            r.long()
+            timeout, session_id, passwd = r.int(), r.long(), r.buffer()
+            self.session = self.zk.attach(self, session_id, passwd, timeout)
+            w = protocol.Writer().int(0)
+            if self.session is None:
+                self.reply(w.int(0).long(0).buffer(b"\0" * 16).bool(False).getvalue())
+                return
+            self.reply(
+                w.int(self.session.timeout)
+                .long(self.session.id)
+                .buffer(self.session.passwd)
+                .bool(False)
+                .getvalue()
+            )
+            while True:
+                r = self.read_packet()
+                xid, opcode = r.int(), r.int()
+                if self.zk.silent:
+                    continue
+                if opcode == protocol.CLOSE:
+                    self.zk.close_session(self.session)
+                    self.reply(self.zk.header(xid, zk.OK))
+                    return
+                self.reply(self.zk.process(self.session, xid, opcode, r))
+        except (EOFError, socket.error, struct.error):
+            pass
+
+    def finish(self):
+        self.zk.detach(self)
+        self.replies.put((0, None))
+        self.sender.join()
+
+
+class FakeZookeeper(object):
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, session_timeout=None):
+        self.latency = latency
+        # overrides the timeout negotiated with clients (ms)
+        self.session_timeout = session_timeout
+        self.accepting = True
+        # requests are read and dropped, connections stay open
+        self.silent = False
+        self.lock = threading.RLock()
+        self.zxid = 0
+        # a multi transaction has a single zxid
+        self.multi_zxid = None
+        self.next_session_id = 1
+        self.nodes = {"/": Node(b"", 0)}
+        self.sessions = {}
+        self.requests = 0
+        # requests which change the tree, whether they succeed or not
+        self.writes = 0
+        self.stopped = threading.Event()
+
+        self.server = socketserver.ThreadingTCPServer(
+            (host, port), Connection, bind_and_activate=False
+        )
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.server.zk = self
+
+    @property
+    def address(self):
+        return "%s:%d" % self.server.server_address
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever).start()
+        reaper = threading.Thread(target=self._reap_sessions)
+        reaper.daemon = True
+        reaper.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            for session in list(self.sessions.values()):
+                if session.connection is not None:
+                    session.connection.close()
+
+    # Fault injection
+
+    def drop_connections(self):
+        """Break connections, sessions survive"""
+        with self.lock:
+            for session in self.sessions.values():
+                if session.connection is not None:
+                    session.connection.close()
+
+    def expire_session(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self.close_session(session)
+                if session.connection is not None:
+                    session.connection.close()
+
+    # Sessions
+
+    def attach(self, connection, session_id, passwd, timeout):
+        with self.lock:
+            if session_id == 0:
+                session = Session(self.next_session_id, self.session_timeout or timeout)
+                self.next_session_id += 1
+                self.sessions[session.id] = session
+            else:
+                session = self.sessions.get(session_id)
+                if session is None or session.passwd != passwd:
+                    return None
+                if session.connection is not None:
+                    session.connection.close()
+            session.connection = connection
+            session.last_seen = time.time()
+            return session
+
+    def detach(self, connection):
+        with self.lock:
+            session = connection.session
+            if session is not None and session.connection is connection:
+                session.connection = None
+                session.last_seen = time.time()
+
+    def close_session(self, session):
+        with self.lock:
+            if self.sessions.pop(session.id, None) is None:
+                return
+            for path in sorted(self.nodes, reverse=True):
+                if path in self.nodes and self.nodes[path].owner == session.id:
+                    self._delete(path)
+
+    def _reap_sessions(self):
+        while not self.stopped.wait(0.05):
+            now = time.time()
+            with self.lock:
+                for session in list(self.sessions.values()):
+                    if now - session.last_seen > session.timeout / 1e3:
+                        self.close_session(session)
+                        if session.connection is not None:
+                            session.connection.close()
+
+    # Tree
+
+    def _next_zxid(self):
+        if self.multi_zxid is not None:
+            return self.multi_zxid
+        self.zxid += 1
+        return self.zxid
+
+    def _fire(self, path, event, child_event=False):
+        for session in self.sessions.values():
+            watches = session.child_watches if child_event else session.data_watches
+            if path in watches:
+                watches.discard(path)
+                if session.connection is not None:
+                    session.connection.event(event, path)
+
+    def _create(self, session, path, data, flags):
+        parent = self.nodes.get(parent_of(path))
+        if parent is None:
+            raise zk.ZKError(zk.NONODE)
+        if parent.owner:
+            raise zk.ZKError(zk.NOCHILDRENFOREPHEMERALS)
+        if flags & zk.SEQUENCE:
+            path = "%s%010d" % (path, parent.cversion)
+        if path in self.nodes:
+            raise zk.ZKError(zk.NODEEXISTS)
+        zxid = self._next_zxid()
+        owner = session.id if flags & zk.EPHEMERAL else 0
+        self.nodes[path] = Node(data, zxid, owner)
+        parent.children.add(path.rsplit("/", 1)[1])
+        parent.cversion += 1
+        parent.pzxid = zxid
+        self._fire(path, protocol.EVENT_NODE_CREATED)
+        self._fire(parent_of(path), protocol.EVENT_NODE_CHILDREN_CHANGED, True)
+        return path
+
+    def _delete(self, path, version=-1):
+        node = self.nodes.get(path)
+        if node is None:
+            raise zk.ZKError(zk.NONODE)
+        if node.children:
+            raise zk.ZKError(zk.NOTEMPTY)
+        if version != -1 and node.version != version:
+            raise zk.ZKError(zk.BADVERSION)
+        zxid = self._next_zxid()
+        del self.nodes[path]
+        parent = self.nodes[parent_of(path)]
+        parent.children.discard(path.rsplit("/", 1)[1])
+        parent.cversion += 1
+        parent.pzxid = zxid
+        self._fire(path, protocol.EVENT_NODE_DELETED)
+        self._fire(path, protocol.EVENT_NODE_DELETED, True)
+        self._fire(parent_of(path), protocol.EVENT_NODE_CHILDREN_CHANGED, True)
+
+    def _set(self, path, data, version=-1):
+        node = self._get(path)
+        if version != -1 and node.version != version:
+            raise zk.ZKError(zk.BADVERSION)
+        node.data = data or b""
+        node.mzxid = self._next_zxid()
+        node.mtime = int(time.time() * 1000)
+        node.version += 1
+        self._fire(path, protocol.EVENT_NODE_DATA_CHANGED)
+        return node.stat()
+
+    def _get(self, path):
+        node = self.nodes.get(path)
+        if node is None:
+            raise zk.ZKError(zk.NONODE)
+        return node
+
+    def _check(self, path, version):
+        if version != -1 and self._get(path).version != version:
+            raise zk.ZKError(zk.BADVERSION)
+
+    def _multi(self, session, r):
+        ops = []
+        while True:
+            optype, done, _ = r.int(), r.bool(), r.int()
+            if done:
+                break
+            if optype == protocol.CREATE:
+                path, data, _, flags = r.string(), r.buffer(), r.acls(), r.int()
+                ops.append((optype, lambda p=path, d=data, f=flags: self._create(session, p, d, f)))
+            elif optype == protocol.DELETE:
+                path, version = r.string(), r.int()
+                ops.append((optype, lambda p=path, v=version: self._delete(p, v)))
+            elif optype == protocol.SETDATA:
+                path, data, version = r.string(), r.buffer(), r.int()
+                ops.append((optype, lambda p=path, d=data, v=version: self._set(p, d, v)))
+            elif optype == protocol.CHECK:
+                path, version = r.string(), r.int()
+                ops.append((optype, lambda p=path, v=version: self._check(p, v)))
+
+        # all or nothing: work on a copy of the tree
+        nodes, zxid, sessions = self.nodes, self.zxid, self.sessions
+        self.nodes = dict((path, _copy(node)) for path, node in nodes.items())
+        self.sessions = {}  # no watches fire until the transaction commits
+        results, failed = [], None
+        for optype, op in ops:
+            try:
+                results.append((optype, op()))
+            except zk.ZKError as err:
+                failed = len(results)
+                results.append((-1, err.errno))
+                break
+        tree = self.nodes
+        self.nodes, self.zxid, self.sessions = nodes, zxid, sessions
+
+        w = protocol.Writer()
+        if failed is not None:
+            for i in range(len(ops)):
+                if i < failed:
+                    err = zk.OK
+                elif i == failed:
+                    err = results[failed][1]
+                else:
+                    err = zk.RUNTIMEINCONSISTENCY
+                w.int(-1).bool(False).int(err).int(err)
+            w.int(-1).bool(True).int(-1)
+            return results[failed][1], w
+
+        # replay for real, so watches fire
+        del tree
+        self.multi_zxid = self._next_zxid()
+        try:
+            for optype, op in ops:
+                result = op()
+                w.int(optype).bool(False).int(zk.OK)
+                if optype == protocol.CREATE:
+                    w.string(result)
+                elif optype == protocol.SETDATA:
+                    w.stat(result)
+        finally:
+            self.multi_zxid = None
+        w.int(-1).bool(True).int(-1)
+        return zk.OK, w
+
+    def header(self, xid, err):
+        return struct.pack(">iqi", xid, self.zxid, err)
+
+    def process(self, session, xid, opcode, r):
+        with self.lock:
+            self.requests += 1
+            if opcode in WRITE_OPCODES:
+                self.writes += 1
+            session.last_seen = time.time()
+            try:
+                err, w = zk.OK, protocol.Writer()
+                if opcode in (protocol.PING, protocol.AUTH):
+                    pass
+                elif opcode in (protocol.CREATE, protocol.CREATE2):
+                    path, data, _, flags = r.string(), r.buffer(), r.acls(), r.int()
+                    path = self._create(session, path, data, flags)
+                    w.string(path)
+                    if opcode == protocol.CREATE2:
+                        w.stat(self.nodes[path].stat())
+                elif opcode == protocol.DELETE:
+                    self._delete(r.string(), r.int())
+                elif opcode == protocol.EXISTS:
+                    path, watch = r.string(), r.bool()
+                    if watch:
+                        session.data_watches.add(path)
+                    w.stat(self._get(path).stat())
+                elif opcode == protocol.GETDATA:
+                    path, watch = r.string(), r.bool()
+                    node = self._get(path)
+                    if watch:
+                        session.data_watches.add(path)
+                    w.buffer(node.data).stat(node.stat())
+                elif opcode == protocol.SETDATA:
+                    w.stat(self._set(r.string(), r.buffer(), r.int()))
+                elif opcode in (protocol.GETCHILDREN, protocol.GETCHILDREN2):
+                    path, watch = r.string(), r.bool()
+                    node = self._get(path)
+                    if watch:
+                        session.child_watches.add(path)
+                    w.strings(sorted(node.children))
+                    if opcode == protocol.GETCHILDREN2:
+                        w.stat(node.stat())
+                elif opcode == protocol.MULTI:
+                    err, w = self._multi(session, r)
+                elif opcode == protocol.SETWATCHES:
+                    self._set_watches(session, r)
+                else:
+                    err = zk.UNIMPLEMENTED
+            except zk.ZKError as e:
+                err, w = e.errno, protocol.Writer()
+            return self.header(xid, err) + w.getvalue()
+
+    def _set_watches(self, session, r):
+        relative_zxid = r.long()
+        data, exist, child = r.strings(), r.strings(), r.strings()
+        for path in data:
+            node = self.nodes.get(path)
+            if node is None:
+                session.connection.event(protocol.EVENT_NODE_DELETED, path)
+            elif node.mzxid > relative_zxid:
+                session.connection.event(protocol.EVENT_NODE_DATA_CHANGED, path)
+            else:
+                session.data_watches.add(path)
+        for path in exist:
+            if path in self.nodes:
+                session.connection.event(protocol.EVENT_NODE_CREATED, path)
+            else:
+                session.data_watches.add(path)
+        for path in child:
+            node = self.nodes.get(path)
+            if node is None:
+                session.connection.event(protocol.EVENT_NODE_DELETED, path)
+            elif node.pzxid > relative_zxid:
+                session.connection.event(protocol.EVENT_NODE_CHILDREN_CHANGED, path)
+            else:
+                session.child_watches.add(path)
+
+
+def _copy(node):
+    clone = Node(node.data, node.czxid, node.owner)
+    clone.__dict__.update(node.__dict__)
+    clone.children = set(node.children)
+    return clone
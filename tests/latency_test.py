@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from distributedflock.ZKeeperAPI import latency, pyzk
+from tests.fakezk import FakeZookeeper
+
+
+class LatencyTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = [FakeZookeeper(latency=l).start() for l in (0.05, 0.0, 0.02, 0.0)]
+        # the last one is out of the quorum
+        self.servers[3].accepting = False
+        self.hosts = [server.address for server in self.servers]
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ["XDG_RUNTIME_DIR"] = self.tmpdir
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_order(self):
+        ordered = latency.order_hosts(self.hosts, 60)
+        self.assertEqual(ordered, [self.hosts[i] for i in (1, 2, 0, 3)])
+
+    def test_cache(self):
+        path = latency.cache_path()
+        rtts = latency.measure(self.hosts, 60, path)
+        self.assertIsNone(rtts[self.hosts[3]])
+        self.servers[1].latency = 0.1
+        # cached ones aren't probed again until they expire
+        self.assertEqual(latency.measure(self.hosts, 60, path), rtts)
+        self.assertGreater(latency.measure(self.hosts, 0, path)[self.hosts[1]], 0.1)
+
+    def test_foreign_cache_dir(self):
+        path = latency.cache_path()
+        os.mkdir(os.path.dirname(path))
+        os.chmod(os.path.dirname(path), 0o777)
+        victim = os.path.join(self.tmpdir, "victim")
+        os.symlink(victim, path)
+        self.assertIsNone(latency.measure(self.hosts, 60, path)[self.hosts[3]])
+        # the cache is neither read nor written there
+        self.assertFalse(os.path.exists(victim))
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["rtt.marshal"])
+
+    def test_connect_nearest(self):
+        client = pyzk.ZKeeperClient(host=self.hosts, timeout=5, rtt_ttl=60)
+        try:
+            self.assertEqual(len(self.servers[1].sessions), 1)
+        finally:
+            client.disconnect()
+
+
+if __name__ == "__main__":
+    unittest.main()
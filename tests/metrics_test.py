@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from distributedflock import metrics, Zookeeper
+from tests.fakezk import FakeZookeeper
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.textfile = os.path.join(self.tmpdir, "zk-flock.prom")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        metrics.configure(None)
+
+    def read_series(self):
+        with open(self.textfile) as f:
+            return dict(
+                line.rsplit(" ", 1) for line in f.read().splitlines()
+                if not line.startswith("#")
+            )
+
+    def test_disabled(self):
+        self.assertFalse(metrics.configure({}).enabled)
+        self.assertFalse(metrics.configure({"prefix": "x"}).enabled)
+
+    def test_textfile_accumulates(self):
+        for _ in range(2):
+            registry = metrics.Registry(self.textfile)
+            registry.inc("acquire_attempts_total", mode="unique", result="fail")
+            registry.observe("hold_seconds", 0.2)
+            registry.flush()
+
+        series = self.read_series()
+        self.assertEqual(
+            float(series['zk_flock_acquire_attempts_total{mode="unique",result="fail"}']), 2
+        )
+        self.assertEqual(float(series['zk_flock_hold_seconds_bucket{le="0.1"}']), 0)
+        self.assertEqual(float(series['zk_flock_hold_seconds_bucket{le="0.5"}']), 2)
+        self.assertEqual(float(series["zk_flock_hold_seconds_count"]), 2)
+
+    def test_statsd(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.settimeout(5)
+        registry = metrics.Registry(statsd="127.0.0.1:%d" % sock.getsockname()[1])
+        registry.inc("lock_lost_total")
+        self.assertEqual(sock.recv(1024), b"zk_flock.lock_lost_total:1|c")
+        sock.close()
+
+    def test_lockserver(self):
+        zk = FakeZookeeper().start()
+        registry = metrics.configure({"textfile": self.textfile})
+        cfg = {
+            "host": [zk.address],
+            "timeout": 5,
+            "app_id": "app",
+            "name": "lock",
+            "backend": "python",
+        }
+        try:
+            first, second = Zookeeper.ZKLockServer(**cfg), Zookeeper.ZKLockServer(**cfg)
+            self.assertTrue(first.getlock())
+            self.assertFalse(second.getlock())
+            first.releaselock()
+            first.destroy()
+            second.destroy()
+        finally:
+            zk.stop()
+
+        _, series = registry.series()
+        self.assertEqual(
+            series['zk_flock_acquire_attempts_total{mode="unique",result="success"}'], 1
+        )
+        self.assertEqual(
+            series['zk_flock_acquire_attempts_total{mode="unique",result="fail"}'], 1
+        )
+        self.assertEqual(series["zk_flock_hold_seconds_count"], 1)
+        # the first create finds out there is no root yet
+        self.assertEqual(series['zk_flock_zk_op_seconds_count{op="create2"}'], 3)
+        self.assertEqual(series['zk_flock_zk_op_seconds_count{op="write"}'], 1)
+        self.assertEqual(
+            series['zk_flock_connection_state_changes_total{state="connected"}'], 2
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,22 @@
 #! /usr/bin/env python
 
+import json
 import os
-import shlex
+import pty
+import shutil
+import signal
 import subprocess
+import sys
+import tempfile
 import time
 import unittest
 
+from tests.fakezk import FakeZookeeper
+
+ZK_FLOCK = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "zk-flock"
+)
+
 
 def check_pid(pid):
     if pid < 0:
@@ -18,43 +29,398 @@ def check_pid(pid):
         return True
 
 
-class FirstTest(unittest.TestCase):
+def wait_for(predicate, timeout=15):
+    limit_time = time.time() + timeout
+    while time.time() < limit_time:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+
+class ZKFlockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.zk = FakeZookeeper().start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.confpath = os.path.join(self.tmpdir, "distributed-flock.json")
+        with open(self.confpath, "w") as f:
+            json.dump(
+                {
+                    "host": [self.zk.address],
+                    "timeout": 5,
+                    "app_id": "CONTENT",
+                    "backend": "python",
+                },
+                f,
+            )
+
+    def tearDown(self):
+        self.zk.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def zk_flock(self, lockname, cmd, *options, **kwargs):
+        args = [sys.executable, ZK_FLOCK, "-c", self.confpath, lockname, cmd]
+        return subprocess.Popen(args + list(options), **kwargs)
+
+
+class FirstTest(ZKFlockTestCase):
     def setUp(self):
-        args = shlex.split('python zk-flock ffffff "sleep 3600" -d')
-        self.flock_process = subprocess.Popen(args)
-        time.sleep(2)
-        x = subprocess.Popen(
-            'ps aux | grep "zk-flock" | grep sleep' "| grep -v grep | awk '{print $2}'",
-            shell=True,
-            stdout=subprocess.PIPE,
-        )
-        output = x.stdout.read()
-        self.PID = int(output)
-        x = subprocess.Popen(
-            "ps aux | grep sleep | grep -v grep" "| grep -v python | awk '{print $2}'",
-            shell=True,
-            stdout=subprocess.PIPE,
-        )
-        self.CHILD_PID = int(x.stdout.read())
+        ZKFlockTestCase.setUp(self)
+        pidfile = os.path.join(self.tmpdir, "pids")
+        cmd = "sh -c 'echo $PPID $$ > %s.tmp; mv %s.tmp %s; exec sleep 3600'" % (
+            (pidfile,) * 3
+        )
+        self.zk_flock("ffffff", cmd, "-d").wait()
+        self.assertTrue(wait_for(lambda: os.path.exists(pidfile)))
+        with open(pidfile) as f:
+            self.PID, self.CHILD_PID = map(int, f.read().split())
 
     def test_kill_observer(self):
         os.kill(self.PID, 15)
-        time.sleep(10)
-        self.assertFalse(check_pid(self.PID))
+        self.assertTrue(wait_for(lambda: not check_pid(self.PID)))
+        self.assertTrue(wait_for(lambda: not check_pid(self.CHILD_PID)))
 
     def test_kill_child(self):
         os.kill(self.CHILD_PID, 15)
-        time.sleep(10)
-        self.assertFalse(check_pid(self.PID))
+        self.assertTrue(wait_for(lambda: not check_pid(self.PID)))
 
 
-class ExitcodeTest(unittest.TestCase):
+class ExitcodeTest(ZKFlockTestCase):
     def test_exit_code(self):
-        args = shlex.split("python zk-flock ffffff \"bash -c 'exit 123'\"")
-        p = subprocess.Popen(args)
+        p = self.zk_flock("ffffff", "bash -c 'exit 123'")
         exit_code = p.wait()
         self.assertEqual(exit_code, 123)
 
+    def test_busy_exit_code(self):
+        holder = self.zk_flock("ffffff", "sleep 3600")
+        self.assertTrue(wait_for(lambda: "/CONTENT/ffffff" in self.zk.nodes))
+        p = self.zk_flock("ffffff", "true", "-x", "7")
+        self.assertEqual(p.wait(), 7)
+        holder.terminate()
+        holder.wait()
+
+    def test_multi_lock(self):
+        holder = self.zk_flock("b", "sleep 3600", "-l", "0")
+        self.assertTrue(wait_for(lambda: "/CONTENT/b" in self.zk.nodes))
+        self.assertEqual(self.zk_flock("a,b", "true", "-x", "7").wait(), 7)
+        self.assertNotIn("/CONTENT/a", self.zk.nodes)
+        holder.terminate()
+        holder.wait()
+        self.assertEqual(self.zk_flock("a,b", "true", "-l", "0").wait(), 0)
+
+
+class TeardownTest(ZKFlockTestCase):
+    def test_kill_group(self):
+        pidfile = os.path.join(self.tmpdir, "pid")
+        # the shell exits at once leaving its background job
+        cmd = "sh -c 'sleep 3600 & echo $! > %s.tmp; mv %s.tmp %s'" % ((pidfile,) * 3)
+        self.assertEqual(self.zk_flock("ffffff", cmd, "-l", "0").wait(), 0)
+        with open(pidfile) as f:
+            pid = int(f.read())
+        self.assertTrue(wait_for(lambda: not check_pid(pid), 2))
+
+    def test_minlocktime_elapsed(self):
+        started = time.time()
+        self.assertEqual(self.zk_flock("ffffff", "sleep 2", "-l", "2").wait(), 0)
+        # the child has held the lock for minlocktime already
+        self.assertLess(time.time() - started, 3.5)
+
+    def test_terminal(self):
+        master, slave = pty.openpty()
+        pidfile = os.path.join(self.tmpdir, "pid")
+        cmd = "sh -c 'echo $$ > %s.tmp; mv %s.tmp %s; exec sleep 3600'" % ((pidfile,) * 3)
+        try:
+            p = self.zk_flock("ffffff", cmd, stdin=slave, preexec_fn=os.setsid)
+            self.assertTrue(wait_for(lambda: os.path.exists(pidfile)))
+            with open(pidfile) as f:
+                pid = int(f.read())
+            # the child stays in the foreground group
+            self.assertEqual(os.getpgid(pid), p.pid)
+            p.terminate()
+            p.wait()
+            self.assertFalse(check_pid(pid))
+        finally:
+            os.close(master)
+            os.close(slave)
+
+
+class ModesTest(ZKFlockTestCase):
+    def test_conflicts(self):
+        for options in (
+            ["-q", "--shared"],
+            ["--shared", "--exclusive"],
+            ["-E", "1", "-A", "2"],
+            ["--priority", "0", "-n", "2"],
+            ["-r", "1", "-q"],
+            ["--yield-signal", "10"],
+        ):
+            p = self.zk_flock("ffffff", "true", *options, stderr=subprocess.PIPE)
+            _, err = p.communicate()
+            self.assertEqual(p.returncode, 2, options)
+            self.assertIn(b"error", err)
+        self.assertEqual(self.zk.requests, 0)
+
+    def test_rate_semaphore(self):
+        p = self.zk_flock("ffffff", "true", "-r", "1", "-n", "2", stdout=subprocess.PIPE)
+        out, _ = p.communicate()
+        self.assertEqual(p.returncode, 0)
+        self.assertEqual(out.strip(), b"ffffff_0")
+
+
+class RespawnTest(ZKFlockTestCase):
+    def runs(self, exit_after):
+        counter = os.path.join(self.tmpdir, "counter")
+        cmd = (
+            "sh -c 'echo $ZKFLOCK_FENCING_TOKEN >> %s; "
+            "[ $(wc -l < %s) -ge %d ] && exit 0; exit 3'" % (counter, counter, exit_after)
+        )
+        p = self.zk_flock("ffffff", cmd, "--respawn", "2", "--respawn-backoff", "0.05", "-l", "0")
+        returncode = p.wait()
+        with open(counter) as f:
+            return returncode, f.read().split()
+
+    def test_restart(self):
+        returncode, tokens = self.runs(3)
+        self.assertEqual(returncode, 0)
+        # all of them have run under the same lock
+        self.assertEqual(len(tokens), 3)
+        self.assertEqual(len(set(tokens)), 1)
+
+    def test_crash_loop(self):
+        returncode, tokens = self.runs(10)
+        self.assertEqual(returncode, 3)
+        self.assertEqual(len(tokens), 3)
+        self.assertNotIn("/CONTENT/ffffff", self.zk.nodes)
+
+    def test_rate(self):
+        # a token is good for a single start
+        p = self.zk_flock("ffffff", "true", "-r", "1", "--respawn", "1", stderr=subprocess.PIPE)
+        p.communicate()
+        self.assertEqual(p.returncode, 2)
+        self.assertNotIn("/CONTENT/ffffff.bucket", self.zk.nodes)
+
+
+class SessionLossTest(ZKFlockTestCase):
+    def test_ride_out_disconnect(self):
+        p = self.zk_flock("ffffff", "sleep 3600")
+        self.assertTrue(wait_for(lambda: "/CONTENT/ffffff" in self.zk.nodes))
+        self.zk.accepting = False
+        self.zk.drop_connections()
+        time.sleep(1)
+        self.zk.accepting = True
+        time.sleep(1)
+        self.assertIsNone(p.poll())
+
+        session_id = self.zk.nodes["/CONTENT/ffffff"].owner
+        self.zk.expire_session(session_id)
+        self.assertTrue(wait_for(lambda: p.poll() is not None))
+        self.assertEqual(p.returncode, 1)
+
+    def test_silent_link(self):
+        p = self.zk_flock("ffffff", "sleep 3600")
+        self.assertTrue(wait_for(lambda: "/CONTENT/ffffff" in self.zk.nodes))
+        owner = self.zk.nodes["/CONTENT/ffffff"].owner
+        # the link hangs instead of breaking, the session expires on the server
+        self.zk.silent = True
+        self.assertTrue(wait_for(lambda: p.poll() is not None))
+        self.assertEqual(p.returncode, 1)
+        # the child has been killed before anybody else could take the lock
+        self.assertIn(owner, self.zk.sessions)
+
+
+class TraceTest(ZKFlockTestCase):
+    def test_fast_start_trace(self):
+        tracepath = os.path.join(self.tmpdir, "trace")
+        env = dict(os.environ, XDG_RUNTIME_DIR=self.tmpdir)
+        for _ in range(2):
+            p = self.zk_flock("ffffff", "true", "-F", "--trace", tracepath, env=env)
+            self.assertEqual(p.wait(), 0)
+
+        with open(tracepath) as f:
+            traces = [json.loads(line) for line in f]
+        self.assertEqual(len(traces), 2)
+        self.assertEqual(
+            [phase["phase"] for phase in traces[0]["phases"]],
+            ["import", "config", "logger", "connect", "acquire", "exec"],
+        )
+        at = [phase["at_ms"] for phase in traces[0]["phases"]]
+        self.assertEqual(at, sorted(at))
+        # the parsed config has been cached by the first run
+        self.assertTrue(os.listdir(os.path.join(self.tmpdir, "zk-flock-%d" % os.getuid())))
+
+    def test_fast_start_foreign_cache_dir(self):
+        # the cache directory has been created in advance and a symlink planted in it
+        cachedir = os.path.join(self.tmpdir, "zk-flock-%d" % os.getuid())
+        os.mkdir(cachedir)
+        os.chmod(cachedir, 0o777)
+        victim = os.path.join(self.tmpdir, "victim")
+        with open(victim, "w") as f:
+            f.write("precious")
+        cachepath = os.path.abspath(self.confpath).replace("/", "_") + ".marshal"
+        os.symlink(victim, os.path.join(cachedir, cachepath))
+
+        env = dict(os.environ, XDG_RUNTIME_DIR=self.tmpdir)
+        self.assertEqual(self.zk_flock("ffffff", "true", "-F", env=env).wait(), 0)
+        with open(victim) as f:
+            self.assertEqual(f.read(), "precious")
+        # nothing has been written there
+        self.assertEqual(os.listdir(cachedir), [cachepath])
+        self.assertTrue(os.path.islink(os.path.join(cachedir, cachepath)))
+
+
+class StandbyTest(ZKFlockTestCase):
+    def test_activation(self):
+        statepath = os.path.join(self.tmpdir, "state")
+        cmd = (
+            "sh -c 'echo standby > %s; read token <&$ZKFLOCK_STANDBY_FD; "
+            "echo $token > %s; exec sleep 3600'" % (statepath, statepath)
+        )
+        holder = self.zk_flock("s", "sleep 3600", "-l", "0")
+        self.assertTrue(wait_for(lambda: "/CONTENT/s" in self.zk.nodes))
+        p = self.zk_flock("s", cmd, "-w", "30", "-S", "-l", "0")
+
+        def state():
+            with open(statepath) as f:
+                return f.read().strip()
+
+        self.assertTrue(wait_for(lambda: os.path.exists(statepath) and state()))
+        self.assertEqual(state(), "standby")
+        holder.terminate()
+        holder.wait()
+        self.assertTrue(wait_for(lambda: state().isdigit()))
+        self.assertEqual(int(state()), self.zk.nodes["/CONTENT/s"].czxid)
+        p.terminate()
+        self.assertEqual(p.wait(), 1)
+        self.assertNotIn("/CONTENT/s", self.zk.nodes)
+
+
+class PartitionsTest(ZKFlockTestCase):
+    def test_reassign(self):
+        outs = [os.path.join(self.tmpdir, "out%d" % i) for i in range(2)]
+        cmd = (
+            "sh -c 'trap \"cp $ZKFLOCK_PARTITIONS_FILE %s\" HUP; "
+            "echo $ZKFLOCK_PARTITIONS > %s; while true; do sleep 0.05; done'"
+        )
+
+        def partitions(path):
+            with open(path) as f:
+                return f.read().strip()
+
+        first = self.zk_flock("p", cmd % (outs[0], outs[0]), "-P", "4", "-l", "0")
+        self.assertTrue(wait_for(lambda: os.path.exists(outs[0])))
+        self.assertEqual(partitions(outs[0]), "0,1,2,3")
+        second = self.zk_flock("p", cmd % (outs[1], outs[1]), "-P", "4", "-l", "0")
+        self.assertTrue(wait_for(lambda: os.path.exists(outs[1])))
+        # the first one has been told to give up a half
+        self.assertTrue(wait_for(lambda: len(partitions(outs[0]).split(",")) == 2))
+        self.assertEqual(
+            sorted((partitions(outs[0]) + "," + partitions(outs[1])).split(",")),
+            ["0", "1", "2", "3"],
+        )
+        for p in (first, second):
+            p.terminate()
+            p.wait()
+
+    def test_respawn(self):
+        out = os.path.join(self.tmpdir, "out")
+        fail = os.path.join(self.tmpdir, "fail")
+        cmd = (
+            "sh -c 'echo $ZKFLOCK_PARTITIONS >> %s; "
+            "while [ ! -e %s ]; do sleep 0.05; done; rm %s; exit 3'" % (out, fail, fail)
+        )
+        first = self.zk_flock(
+            "p", cmd, "-P", "4", "--partition-signal", "0", "--respawn", "1",
+            "--respawn-backoff", "0.05", "-l", "0",
+        )
+        self.assertTrue(wait_for(lambda: os.path.exists(out)))
+        second = self.zk_flock("p", "sleep 3600", "-P", "4", "-l", "0")
+        self.assertTrue(wait_for(lambda: len(self.zk.nodes["/CONTENT/p.members"].children) == 2))
+        time.sleep(0.5)
+        open(fail, "w").close()
+
+        def runs():
+            with open(out) as f:
+                return f.read().split()
+
+        # the restarted child owns a half
+        self.assertTrue(wait_for(lambda: len(runs()) == 2))
+        self.assertEqual(runs()[0], "0,1,2,3")
+        self.assertEqual(len(runs()[1].split(",")), 2)
+        for p in (first, second):
+            p.terminate()
+            p.wait()
+
+
+class PriorityTest(ZKFlockTestCase):
+    def test_yield(self):
+        out = os.path.join(self.tmpdir, "out")
+        cmd = "sh -c 'trap \"echo yielded > %s; exit 0\" USR1; while true; do sleep 0.05; done'"
+        holder = self.zk_flock(
+            "p", cmd % out, "--priority", "0", "--yield-signal", str(signal.SIGUSR1), "-l", "0"
+        )
+        self.assertTrue(wait_for(lambda: "/CONTENT/p" in self.zk.nodes))
+        # a more urgent waiter asks the holder to finish early
+        urgent = self.zk_flock("p", "true", "--priority", "1", "-w", "10", "-l", "0")
+        self.assertEqual(urgent.wait(), 0)
+        self.assertEqual(holder.wait(), 0)
+        with open(out) as f:
+            self.assertEqual(f.read().strip(), "yielded")
+
+
+class ManifestTest(ZKFlockTestCase):
+    def test_manifest(self):
+        tokenpath = os.path.join(self.tmpdir, "token")
+        manifest = os.path.join(self.tmpdir, "manifest.json")
+        with open(manifest, "w") as f:
+            json.dump(
+                [
+                    {"name": "a", "command": "sh -c 'echo $ZKFLOCK_FENCING_TOKEN > %s'" % tokenpath},
+                    {"name": "b", "command": "sleep 3600"},
+                    {"name": "c", "command": "true", "exitcode": 7},
+                ],
+                f,
+            )
+        holder = self.zk_flock("c", "sleep 3600", "-l", "0")
+        self.assertTrue(wait_for(lambda: "/CONTENT/c" in self.zk.nodes))
+
+        args = [sys.executable, ZK_FLOCK, "-c", self.confpath, "-l", "0", "-M", manifest]
+        p = subprocess.Popen(args)
+        self.assertTrue(wait_for(lambda: "/CONTENT/b" in self.zk.nodes))
+        # the first child is done, the second one still holds its lock
+        self.assertTrue(wait_for(lambda: "/CONTENT/a" not in self.zk.nodes))
+        with open(tokenpath) as f:
+            self.assertTrue(f.read().strip().isdigit())
+        self.assertIsNone(p.poll())
+        # all of the locks share one session
+        owner = self.zk.nodes["/CONTENT/b"].owner
+        self.assertNotEqual(owner, self.zk.nodes["/CONTENT/c"].owner)
+        self.assertEqual(len(self.zk.sessions), 2)
+
+        p.terminate()
+        self.assertEqual(p.wait(), 7)
+        self.assertNotIn("/CONTENT/b", self.zk.nodes)
+        holder.terminate()
+        holder.wait()
+
+    def test_unsupported(self):
+        manifest = os.path.join(self.tmpdir, "manifest.json")
+        with open(manifest, "w") as f:
+            json.dump([{"name": "a", "command": "true", "partitions": 4}], f)
+        args = [sys.executable, ZK_FLOCK, "-c", self.confpath, "-M", manifest]
+        p = subprocess.Popen(args, stdout=subprocess.PIPE)
+        out, _ = p.communicate()
+        self.assertEqual(p.returncode, 1)
+        self.assertIn(b"partitions", out)
+
+        with open(manifest, "w") as f:
+            json.dump([{"name": "a", "command": "true"}], f)
+        for options in (["-P", "4"], ["-S"], ["--priority", "1", "--yield-signal", "10"]):
+            p = subprocess.Popen(args + options, stderr=subprocess.PIPE)
+            _, err = p.communicate()
+            self.assertEqual(p.returncode, 2, options)
+            self.assertIn(b"-M", err)
+        self.assertEqual(self.zk.requests, 0)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,477 @@
+#! /usr/bin/env python
+
+import threading
+import time
+import unittest
+
+from distributedflock import Zookeeper, status
+from tests.fakezk import FakeZookeeper
+
+
+class ZKLockServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.zk = FakeZookeeper().start()
+        self.lockservers = []
+
+    def tearDown(self):
+        for z in self.lockservers:
+            z.destroy()
+        self.zk.stop()
+
+    def lockserver(self, name="lock", **config):
+        cfg = {
+            "host": [self.zk.address],
+            "timeout": 5,
+            "app_id": "app",
+            "name": name,
+            "backend": "python",
+        }
+        cfg.update(config)
+        z = Zookeeper.ZKLockServer(**cfg)
+        self.lockservers.append(z)
+        return z
+
+
+class UniqueLockTest(ZKLockServerTestCase):
+    def test_exclusive(self):
+        first, second = self.lockserver(), self.lockserver()
+        self.assertTrue(first.getlock())
+        self.assertFalse(second.getlock())
+        self.assertTrue(first.check_lock())
+        self.assertFalse(second.check_lock())
+
+    def test_round_trips(self):
+        first = self.lockserver()
+        self.assertTrue(first.getlock())
+        self.assertIsNotNone(first.czxid)
+        # the handshake and the lock itself, the root exists already
+        second = self.lockserver("other")
+        self.assertTrue(second.getlock())
+        self.assertEqual(second.round_trips, 2)
+        self.assertEqual(second.czxid, self.zk.nodes["/app/other"].czxid)
+
+    def test_wait(self):
+        first, second = self.lockserver(), self.lockserver()
+        self.assertTrue(first.getlock())
+        threading.Timer(0.2, first.releaselock).start()
+        self.assertTrue(second.getlock_wait(5))
+
+    def test_lock_lost(self):
+        z = self.lockserver()
+        self.assertTrue(z.getlock())
+        lost = threading.Event()
+        self.assertTrue(z.set_async_check_lock(lost.set))
+        self.zk.expire_session(z.zkclient.session_id)
+        self.assertTrue(lost.wait(5))
+        self.assertFalse(z.check_lock())
+
+
+class SessionLossTest(ZKLockServerTestCase):
+    def wait_state(self, z, state, timeout=5):
+        limit_time = time.time() + timeout
+        while z.lock_state() != state and time.time() < limit_time:
+            time.sleep(0.05)
+        return z.lock_state()
+
+    def test_ride_out_disconnect(self):
+        z = self.lockserver()
+        self.assertTrue(z.getlock())
+        changed = threading.Event()
+        self.assertTrue(z.set_async_check_lock(changed.set))
+
+        self.zk.accepting = False
+        self.zk.drop_connections()
+        self.assertTrue(changed.wait(5))
+        self.assertEqual(self.wait_state(z, Zookeeper.LOCK_UNKNOWN), Zookeeper.LOCK_UNKNOWN)
+        self.zk.accepting = True
+        self.assertEqual(self.wait_state(z, Zookeeper.LOCK_HELD), Zookeeper.LOCK_HELD)
+
+        # the watcher survives the reconnection
+        changed.clear()
+        self.zk.expire_session(z.zkclient.session_id)
+        self.assertEqual(self.wait_state(z, Zookeeper.LOCK_LOST), Zookeeper.LOCK_LOST)
+        self.assertTrue(changed.wait(5))
+
+    def test_disconnect_silent_server(self):
+        z = self.lockserver(timeout=1)
+        self.assertTrue(z.getlock())
+        # CLOSE is never answered
+        self.zk.silent = True
+        started = time.time()
+        z.zkclient.disconnect()
+        self.assertLess(time.time() - started, 2)
+
+
+class MultiLockTest(ZKLockServerTestCase):
+    def multi(self, names):
+        cfg = {"host": [self.zk.address], "timeout": 5, "app_id": "app", "backend": "python"}
+        z = Zookeeper.MultiLockServer(names, **cfg)
+        self.lockservers.append(z)
+        return z
+
+    def test_all_or_nothing(self):
+        self.assertTrue(self.lockserver("b").getlock())
+        z = self.multi(["a", "b"])
+        self.assertFalse(z.getlock())
+        self.assertNotIn("/app/a", self.zk.nodes)
+
+        self.lockservers[0].releaselock()
+        self.assertTrue(z.getlock())
+        # one transaction
+        self.assertEqual(z.czxid, self.zk.nodes["/app/a"].czxid)
+        self.assertEqual(z.czxid, self.zk.nodes["/app/b"].czxid)
+
+    def test_ordered_fallback(self):
+        holder = self.lockserver("b")
+        self.assertTrue(holder.getlock())
+        z = self.multi(["b", "a"])
+        z.zkclient.supports_multi = False
+        self.assertFalse(z.getlock())
+        self.assertNotIn("/app/a", self.zk.nodes)
+
+        threading.Timer(0.2, holder.releaselock).start()
+        self.assertTrue(z.getlock_wait(5))
+        self.assertTrue(z.check_lock())
+
+    def test_any_lost(self):
+        z = self.multi(["a", "b"])
+        self.assertTrue(z.getlock())
+        lost = threading.Event()
+        self.assertTrue(z.set_async_check_lock(lost.set))
+        self.lockserver().zkclient.delete("/app/b")
+        self.assertTrue(lost.wait(5))
+        self.assertEqual(z.lock_state(), Zookeeper.LOCK_LOST)
+
+
+class QueueLockTest(ZKLockServerTestCase):
+    def test_fifo(self):
+        holder = self.lockserver()
+        self.assertTrue(holder.getlock_queued())
+        order = []
+
+        def waiter(z):
+            self.assertTrue(z.getlock_queued(10))
+            order.append(z)
+            z.releaselock()
+
+        waiters = []
+        for i in range(3):
+            z = self.lockserver()
+            t = threading.Thread(target=waiter, args=(z,))
+            t.start()
+            # let it join the queue before the next one
+            while len(self.zk.nodes["/app/lock.queue"].children) < i + 2:
+                time.sleep(0.01)
+            waiters.append((z, t))
+
+        holder.releaselock()
+        for _, t in waiters:
+            t.join()
+        self.assertEqual(order, [z for z, _ in waiters])
+
+    def test_timeout_leaves_queue(self):
+        holder, waiter = self.lockserver(), self.lockserver()
+        self.assertTrue(holder.getlock_queued())
+        self.assertFalse(waiter.getlock_queued(0.1))
+        self.assertEqual(len(self.zk.nodes["/app/lock.queue"].children), 1)
+
+    def test_excludes_unique(self):
+        plain, queued = self.lockserver(), self.lockserver()
+        self.assertTrue(plain.getlock())
+        self.assertFalse(queued.getlock_queued(0.1))
+        plain.releaselock()
+        self.assertTrue(queued.getlock_queued())
+        self.assertFalse(plain.getlock())
+        # the queue is left along with the lock
+        queued.releaselock()
+        self.assertEqual(self.zk.nodes["/app/lock.queue"].children, set())
+        self.assertTrue(plain.getlock())
+
+
+class ReadWriteLockTest(ZKLockServerTestCase):
+    def test_readers_share(self):
+        readers = [self.lockserver(), self.lockserver()]
+        self.assertTrue(all(z.getlock_shared() for z in readers))
+        self.assertFalse(self.lockserver().getlock_exclusive())
+
+    def test_writer_blocks_later_readers(self):
+        reader, writer = self.lockserver(), self.lockserver()
+        self.assertTrue(reader.getlock_shared())
+        acquired = threading.Event()
+
+        def write():
+            if writer.getlock_exclusive(10):
+                acquired.set()
+
+        t = threading.Thread(target=write)
+        t.start()
+        while len(self.zk.nodes["/app/lock.rwlock"].children) < 2:
+            time.sleep(0.01)
+        # readers don't overtake the waiting writer
+        self.assertFalse(self.lockserver().getlock_shared())
+        self.assertFalse(acquired.is_set())
+
+        reader.releaselock()
+        t.join()
+        self.assertTrue(acquired.is_set())
+        self.assertTrue(writer.check_lock())
+
+    def test_writer_excludes_unique(self):
+        plain, writer = self.lockserver(), self.lockserver()
+        self.assertTrue(plain.getlock())
+        self.assertFalse(writer.getlock_exclusive(0.1))
+        plain.releaselock()
+        self.assertTrue(writer.getlock_exclusive())
+        self.assertFalse(plain.getlock())
+        writer.releaselock()
+        self.assertEqual(self.zk.nodes["/app/lock.rwlock"].children, set())
+
+
+class ElectionTest(ZKLockServerTestCase):
+    def elect(self, scores, timeout=0):
+        results = {}
+
+        def contender(z, score):
+            results[score] = z.getlock_elected(score, 0.5, timeout)
+
+        threads = []
+        for score in scores:
+            t = threading.Thread(target=contender, args=(self.lockserver(), score))
+            t.start()
+            threads.append(t)
+        return results, threads
+
+    def test_least_loaded_wins(self):
+        results, threads = self.elect([0.5, 0.1, 0.9])
+        for t in threads:
+            t.join()
+        self.assertEqual(results, {0.5: False, 0.1: True, 0.9: False})
+        self.assertEqual(self.zk.nodes["/app/lock.election"].children, set())
+
+    def test_next_best_waits(self):
+        results, threads = self.elect([0.5, 0.1], timeout=10)
+        while not results:
+            time.sleep(0.01)
+        self.assertEqual(results, {0.1: True})
+        # the next best candidate gets the lock once it's released
+        self.lockservers[1].releaselock()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, {0.1: True, 0.5: True})
+
+
+class PriorityTest(ZKLockServerTestCase):
+    def join(self, priority, results):
+        z = self.lockserver()
+
+        def waiter():
+            results.append((priority, z.getlock_priority(priority, 10)))
+            z.releaselock()
+
+        count = len(self.zk.nodes["/app/lock.priority"].children)
+        t = threading.Thread(target=waiter)
+        t.start()
+        # let it join the queue before the next one
+        while len(self.zk.nodes["/app/lock.priority"].children) == count:
+            time.sleep(0.01)
+        return t
+
+    def test_urgent_first(self):
+        holder = self.lockserver()
+        self.assertTrue(holder.getlock_priority(0))
+        results = []
+        threads = [self.join(priority, results) for priority in (0, 1, 5, 1)]
+        holder.releaselock()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [(5, True), (1, True), (1, True), (0, True)])
+        self.assertEqual(self.zk.nodes["/app/lock.priority"].children, set())
+
+    def test_yield(self):
+        holder = self.lockserver()
+        self.assertTrue(holder.getlock_priority(1))
+        asked = threading.Event()
+        self.assertTrue(holder.watch_urgent(asked.set))
+        results = []
+        threads = [self.join(1, results)]
+        self.assertFalse(asked.wait(0.2))
+        threads.append(self.join(2, results))
+        self.assertTrue(asked.wait(5))
+        holder.releaselock()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [(2, True), (1, True)])
+
+
+class AffinityTest(ZKLockServerTestCase):
+    def host(self, hostname):
+        z = self.lockserver()
+        z.hostname = hostname
+        return z
+
+    def test_last_holder_first(self):
+        warm = self.host("warm")
+        self.assertTrue(warm.getlock_affinity(0.5))
+        self.assertEqual(self.zk.nodes["/app/lock.holder"].data, b"warm")
+        warm.releaselock()
+
+        results = []
+        cold = self.host("cold")
+        t = threading.Thread(target=lambda: results.append(cold.getlock_affinity(0.5)))
+        t.start()
+        # the last holder doesn't back off
+        self.assertTrue(warm.getlock_affinity(0.5))
+        t.join()
+        self.assertEqual(results, [False])
+
+    def test_takeover(self):
+        self.assertTrue(self.host("warm").getlock_affinity(0.5))
+        self.lockservers[0].releaselock()
+        started = time.time()
+        self.assertTrue(self.host("cold").getlock_affinity(0.3))
+        self.assertGreaterEqual(time.time() - started, 0.3)
+        self.assertEqual(self.zk.nodes["/app/lock.holder"].data, b"cold")
+
+
+class RateLimitTest(ZKLockServerTestCase):
+    def test_burst(self):
+        z = self.lockserver()
+        self.assertEqual([z.take_token(1, 3) for _ in range(4)], [True, True, True, False])
+        self.assertFalse(z.locked)
+
+    def test_wait_for_token(self):
+        z = self.lockserver()
+        self.assertTrue(z.take_token(10))
+        started = time.time()
+        self.assertTrue(self.lockserver().take_token(10, 1, 5))
+        self.assertGreaterEqual(time.time() - started, 0.08)
+        # the waiter has left the queue
+        self.assertEqual(self.zk.nodes["/app/lock.bucket.queue"].children, set())
+
+    def test_waiters_keep_rate(self):
+        granted = []
+
+        def waiter(z):
+            if z.take_token(20, 1, 5):
+                granted.append(time.time())
+
+        threads = [threading.Thread(target=waiter, args=(self.lockserver(),)) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(granted), 5)
+        granted.sort()
+        self.assertGreaterEqual(granted[-1] - granted[0], 4 / 20.0 - 0.02)
+
+    def test_waiters_go_first(self):
+        self.assertTrue(self.lockserver().take_token(1, 2))
+        # somebody waits in the queue, so the token left is theirs
+        queued = self.lockserver()
+        self.assertIsNotNone(queued._enqueue("/app/lock.bucket.queue")[0])
+        self.assertFalse(self.lockserver().take_token(1, 2, 0.3))
+        # unless the newcomer doesn't wait at all
+        self.assertTrue(self.lockserver().take_token(1, 2))
+
+
+class SemaphoreTest(ZKLockServerTestCase):
+    def test_slots(self):
+        holders = [self.lockserver() for _ in range(3)]
+        self.assertEqual([z.getlock_semaphore(3) for z in holders], [0, 1, 2])
+        self.assertIsNone(self.lockserver().getlock_semaphore(3))
+
+        holders[1].releaselock()
+        self.assertEqual(self.lockserver().getlock_semaphore(3), 1)
+
+    def test_wait_for_slot(self):
+        holder, waiter = self.lockserver(), self.lockserver()
+        self.assertEqual(holder.getlock_semaphore(1), 0)
+        threading.Timer(0.2, holder.releaselock).start()
+        self.assertEqual(waiter.getlock_semaphore(1, 5), 0)
+
+    def test_older_versions(self):
+        # older versions take the plain node of a slot alone
+        legacy = self.lockserver("lock_0")
+        self.assertTrue(legacy.getlock())
+        self.assertEqual(self.lockserver().getlock_semaphore(2), 1)
+        waiter = self.lockserver()
+        self.assertIsNone(waiter.getlock_semaphore(2))
+        legacy.releaselock()
+        self.assertEqual(waiter.getlock_semaphore(2, 5), 0)
+        self.assertFalse(legacy.getlock())
+        waiter.releaselock()
+        self.assertEqual(self.zk.nodes["/app/lock.semaphore"].children, set(["slot-1"]))
+
+
+class PartitionsTest(ZKLockServerTestCase):
+    def test_balanced(self):
+        workers = [self.lockserver() for _ in range(3)]
+        for z in workers:
+            z.join_partitions(8)
+        # the earlier ones learn about the later ones by the watcher
+        for z in workers:
+            z.watch_partitions(lambda partitions: None)
+        owned = [z.partitions for z in workers]
+        self.assertEqual(sorted(sum(owned, [])), list(range(8)))
+        self.assertTrue(all(len(partitions) <= 3 for partitions in owned))
+        self.assertTrue(all(z.check_lock() for z in workers))
+
+    def test_rebalance(self):
+        first = self.lockserver()
+        self.assertEqual(first.join_partitions(4), [0, 1, 2, 3])
+        changes = []
+        cond_var = threading.Condition()
+
+        def on_change(partitions):
+            with cond_var:
+                changes.append(partitions)
+                cond_var.notify()
+
+        def wait_change(n):
+            with cond_var:
+                while len(changes) < n:
+                    cond_var.wait(5)
+            return changes[n - 1]
+
+        self.assertTrue(first.watch_partitions(on_change))
+        second = self.lockserver()
+        joined = second.join_partitions(4)
+        self.assertEqual(len(joined), 2)
+        self.assertEqual(sorted(wait_change(1) + joined), [0, 1, 2, 3])
+        second.destroy()
+        self.assertEqual(wait_change(2), [0, 1, 2, 3])
+
+
+class StatusTest(ZKLockServerTestCase):
+    def test_collect(self):
+        unique = self.lockserver("unique")
+        self.assertTrue(unique.getlock())
+        slots = [self.lockserver("slots") for _ in range(2)]
+        self.assertEqual([z.getlock_semaphore(3) for z in slots], [0, 1])
+        holder, waiter = self.lockserver("queue"), self.lockserver("queue")
+        self.assertTrue(holder.getlock_queued())
+        t = threading.Thread(target=waiter.getlock_queued, args=(10,))
+        t.start()
+        while len(self.zk.nodes["/app/queue.queue"].children) < 2:
+            time.sleep(0.01)
+
+        client = unique.zkclient
+        trips = client.round_trips
+        rows = status.collect(client, "app")
+        # the listing and three batches whatever the number of locks
+        self.assertEqual(client.round_trips - trips, 4)
+        self.assertEqual(
+            [(r["name"], r["mode"], r["waiters"]) for r in rows],
+            [("queue", "queue", 1), ("slots", "semaphore", None),
+             ("slots", "semaphore", None), ("unique", "unique", None)],
+        )
+        self.assertEqual(rows[0]["session"], "0x%x" % holder.zkclient.session_id)
+        self.assertEqual(rows[-1]["host"], unique.hostname)
+        self.assertTrue(0 <= rows[-1]["age"] < 10)
+
+        holder.releaselock()
+        t.join()
+
+
+if __name__ == "__main__":
+    unittest.main()